@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+# vim: set encoding=utf-8 et sw=4 sts=4 :
+
+# Benchmarks for the pymind request path.
+#
+# Usage:
+#   benchmark.py [options] [SCENARIO ...]   load test a local pymind daemon
+#   benchmark.py -m [options] [NAME ...]    run in-process micro benchmarks
+#
+# The load test forks a PyminDaemon (listening only in 127.0.0.1) with
+# a synthetic handlers tree and runs each scenario against it, using a closed
+# loop load generator (-c requests are always in flight). For each scenario
+# and payload size it reports the requests per second and the 50 and 99
+# percentiles of the latency.
+#
+# Micro benchmarks measure parse_command(), Dispatcher.dispatch(),
+# serializer.serialize() and the whole PyminDaemon.process() path, without
+# any networking involved.
+#
+# Everything runs with pymin.service.util in DEBUG mode, so no system
+# commands are ever executed. Use -l to list scenarios and micro benchmarks.
+
+import os
+import sys
+import time
+import errno
+import random
+import select
+import signal
+import socket
+import logging
+import optparse
+
+from pymin.service import util
+util.DEBUG = True # never run real commands
+from pymin.dispatcher import Handler, handler, Dispatcher, parse_command
+from pymin.service.util import ParametersHandler, DictSubHandler
+from pymin.validation import Item, Field, UnicodeString
+from pymin.eventloop import monotonic
+from pymin.pymindaemon import PyminDaemon
+from pymin import serializer, dispatcher
+
+
+# Synthetic handlers tree
+#########################
+
+class Host(Item):
+    name = Field(UnicodeString(not_empty=True))
+    ip = Field(UnicodeString(not_empty=True))
+    mac = Field(UnicodeString(not_empty=True))
+
+class HostHandler(DictSubHandler):
+    handler_help = u"Manage hosts"
+    _cont_subhandler_attr = 'hosts'
+    _cont_subhandler_class = Host
+
+class Level(Handler):
+    def __init__(self, depth):
+        if depth:
+            self.level = Level(depth - 1)
+    @handler(u'Return the arguments')
+    def get(self, *args):
+        return args
+
+class BenchRoot(ParametersHandler):
+    r"""BenchRoot([hosts]) -> BenchRoot :: Synthetic root handler.
+
+    It has some simple commands and some service-like subhandlers, built
+    using the same helpers used by the real services.
+    """
+
+    def __init__(self, hosts=100):
+        self.params = dict([('param%d' % i, u'value %d' % i)
+                            for i in range(20)])
+        self.hosts = dict()
+        for i in range(hosts):
+            name = u'host%d' % i
+            self.hosts[name] = Host(name, u'10.0.%d.%d' % (i / 256, i % 256),
+                                    u'00:11:22:33:%02x:%02x' % (i / 256,
+                                                                i % 256))
+        self.host = HostHandler(self)
+        self.deep = Level(8)
+
+    @handler(u'Echo the message passed as argument')
+    def echo(self, message):
+        return message
+
+    @handler(u'Return a table of ROWS rows')
+    def rows(self, rows):
+        return [(i, u'name%d' % i, u'10.0.0.%d' % (i % 256), u'comment')
+                for i in range(int(rows))]
+
+    @handler(u'Pretend to commit the configuration')
+    def commit(self):
+        util.call(('true',))
+
+
+# Scenarios
+###########
+
+def payload(size):
+    r"payload(size) -> str :: Get a printable argument of size bytes."
+    return ''.join([chr(ord('a') + i % 26) for i in range(size)])
+
+def quoted(size):
+    r"quoted(size) -> str :: Get a quoted argument with escapes."
+    units = ('ab', '\\"', 'cd', '\\n', ' ')
+    arg = list()
+    for i in range(size / 2):
+        arg.append(units[i % len(units)])
+    return '"%s"' % ''.join(arg)
+
+# name -> (description, [(size, command), ...])
+scenarios = dict(
+    echo = (u'echo with a plain argument of SIZE bytes',
+        [(n, 'echo %s' % payload(n)) for n in (16, 256, 4096, 32768)]),
+    quoted = (u'echo with a quoted argument of SIZE bytes with escapes',
+        [(n, 'echo %s' % quoted(n)) for n in (16, 256, 4096, 32768)]),
+    rows = (u'response with SIZE rows',
+        [(n, 'rows %d' % n) for n in (1, 10, 100, 1000)]),
+    deep = (u'command routed through SIZE levels of handlers',
+        [(n, 'deep %sget x' % ('level ' * n)) for n in (0, 4, 8)]),
+    params = (u'parameter get (SIZE is ignored)',
+        [(0, 'get param1')]),
+    hosts = (u'show all the hosts (SIZE is the number of hosts)',
+        [(100, 'host show')]),
+    set = (u'parameter set, a command that modifies the state',
+        [(0, 'set param1 new-value')]),
+    batch = (u'batch of SIZE host get commands',
+        [(n, '@batch\n%s@end' % ''.join(['host get host%d\n' % i
+                                            for i in range(n)]))
+         for n in (1, 10, 100)]),
+)
+
+default_scenarios = ('echo', 'quoted', 'rows', 'deep', 'params', 'hosts',
+                     'set', 'batch')
+
+
+# Daemon
+########
+
+def start_daemon(options):
+    r"start_daemon(options) -> (pid, port) :: Fork a local daemon."
+    port = options.port or random.randint(20000, 60000)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            logging.disable(logging.CRITICAL)
+            PyminDaemon(BenchRoot(), ('127.0.0.1', port), timer=options.timer,
+                        stream_addr=('127.0.0.1', port),
+                        workers=options.workers).run()
+        finally:
+            os._exit(0)
+    # wait for the daemon to answer
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.settimeout(0.1)
+    for i in range(100):
+        s.sendto('echo ping', ('127.0.0.1', port))
+        try:
+            s.recv(65535)
+            break
+        except socket.timeout:
+            pass
+    else:
+        stop_daemon(pid)
+        raise RuntimeError("Can't start the daemon")
+    if options.workers:
+        time.sleep(2) # let the workers start
+    return (pid, port)
+
+def stop_daemon(pid):
+    r"stop_daemon(pid) -> None :: Stop the local daemon."
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+
+
+# Load generators
+#################
+
+def percentile(values, q):
+    r"percentile(values, q) -> float :: q percentile of sorted values."
+    if not values:
+        return 0.0
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+def udp_load(port, command, requests, concurrency, timeout=1.0):
+    r"""udp_load(port, command, requests, concurrency[, timeout])
+
+    Send command 'requests' times using 'concurrency' UDP sockets, each one
+    with a request in flight. Returns (elapsed, latencies, lost), where
+    latencies is the list of the latencies of the answered requests and lost
+    is the number of requests not answered in 'timeout' seconds.
+    """
+    addr = ('127.0.0.1', port)
+    poll = select.poll()
+    socks = dict()
+    for i in range(concurrency):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.setblocking(False)
+        socks[s.fileno()] = [s, None]
+        poll.register(s.fileno(), select.POLLIN)
+    latencies = list()
+    lost = 0
+    sent = 0
+    start = monotonic()
+    def send(entry):
+        entry[1] = monotonic()
+        entry[0].sendto(command, addr)
+    for entry in socks.values()[:requests]:
+        send(entry)
+        sent += 1
+    while len(latencies) + lost < requests:
+        for (fd, ev) in poll.poll(timeout * 1000 / 10):
+            entry = socks[fd]
+            try:
+                entry[0].recv(65535)
+            except socket.error, e:
+                if e.args[0] == errno.EAGAIN:
+                    continue
+                raise
+            latencies.append(monotonic() - entry[1])
+            entry[1] = None
+            if sent < requests:
+                send(entry)
+                sent += 1
+        now = monotonic()
+        for entry in socks.values():
+            if entry[1] is not None and now - entry[1] > timeout:
+                lost += 1
+                entry[1] = None
+                if sent < requests:
+                    send(entry)
+                    sent += 1
+    elapsed = monotonic() - start
+    for (s, t) in socks.values():
+        s.close()
+    return (elapsed, latencies, lost)
+
+def tcp_load(port, command, requests, concurrency):
+    r"""tcp_load(port, command, requests, concurrency)
+
+    Send command 'requests' times using one TCP connection, pipelining up to
+    'concurrency' requests. Returns (elapsed, latencies, lost) (lost is
+    always 0, see udp_load()).
+    """
+    s = socket.create_connection(('127.0.0.1', port))
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    f = s.makefile('rb')
+    request = command + '\n'
+    latencies = list()
+    in_flight = list()
+    sent = 0
+    start = monotonic()
+    while len(latencies) < requests:
+        batch = min(concurrency - len(in_flight), requests - sent)
+        if batch > 0:
+            now = monotonic()
+            s.sendall(request * batch)
+            in_flight.extend([now] * batch)
+            sent += batch
+        (status, length) = f.readline().split()
+        f.read(int(length))
+        latencies.append(monotonic() - in_flight.pop(0))
+    elapsed = monotonic() - start
+    s.close()
+    return (elapsed, latencies, 0)
+
+def run_load(options, names):
+    r"run_load(options, names) -> None :: Run the load test scenarios."
+    load = udp_load
+    if options.transport == 'tcp':
+        load = tcp_load
+    (pid, port) = start_daemon(options)
+    try:
+        print '%-8s %6s %8s %10s %9s %9s %6s' % ('scenario', 'size',
+                'requests', 'req/s', 'p50 ms', 'p99 ms', 'lost')
+        for name in names:
+            for (size, command) in scenarios[name][1]:
+                if options.transport == 'udp' and len(command) > 65000:
+                    continue
+                # warm up
+                load(port, command, min(options.requests / 10 + 1, 100),
+                     options.concurrency)
+                (elapsed, latencies, lost) = load(port, command,
+                                    options.requests, options.concurrency)
+                latencies.sort()
+                print '%-8s %6d %8d %10.1f %9.3f %9.3f %6d' % (name, size,
+                        options.requests, len(latencies) / elapsed,
+                        percentile(latencies, 0.5) * 1000,
+                        percentile(latencies, 0.99) * 1000, lost)
+                sys.stdout.flush()
+    finally:
+        stop_daemon(pid)
+
+
+# Micro benchmarks
+##################
+
+def micro_parse(parse=parse_command):
+    for name in ('echo', 'quoted'):
+        for (size, command) in scenarios[name][1]:
+            yield ('%s %d' % (name, size), parse, (unicode(command),))
+
+def micro_parse_ref():
+    return micro_parse(dispatcher._parse_command_reference)
+
+def micro_dispatch():
+    d = Dispatcher(BenchRoot())
+    for (size, command) in scenarios['deep'][1] + scenarios['params'][1]:
+        yield (command.split()[0] + ' %d' % size, d.dispatch,
+               (unicode(command),))
+
+def micro_route():
+    d = Dispatcher(BenchRoot())
+    for (size, command) in scenarios['deep'][1] + scenarios['params'][1]:
+        (route, kwargs) = parse_command(unicode(command))
+        yield (command.split()[0] + ' %d' % size, d.lookup, (route, kwargs))
+
+def micro_serialize():
+    root = BenchRoot(hosts=1000)
+    for n in (1, 10, 100, 1000):
+        yield ('%d rows' % n, serializer.serialize, (root.rows(n),))
+    yield ('1000 hosts', serializer.serialize, (root.hosts.values(),))
+    def msgpack(obj):
+        return ''.join(serializer.iterserialize(obj, format='msgpack'))
+    for n in (10, 1000):
+        yield ('%d rows msgpack' % n, msgpack, (root.rows(n),))
+    yield ('1000 hosts msgpack', msgpack, (root.hosts.values(),))
+
+def micro_process():
+    daemon = PyminDaemon(BenchRoot(), ('127.0.0.1', 0), background=False)
+    def reply(response):
+        pass
+    for name in ('echo', 'rows', 'params', 'hosts'):
+        (size, command) = scenarios[name][1][min(1,
+                                            len(scenarios[name][1]) - 1)]
+        yield ('%s %d' % (name, size), daemon.process, (command, reply))
+
+# name -> (description, generator of (label, function, args))
+micro_benchmarks = dict(
+    parse = (u'parse_command() with plain and quoted arguments',
+             micro_parse),
+    parse_ref = (u'the original (character by character) parse_command()',
+                 micro_parse_ref),
+    dispatch = (u'Dispatcher.dispatch() of simple and deep commands',
+                micro_dispatch),
+    route = (u'Dispatcher.lookup() of already parsed commands', micro_route),
+    serialize = (u'serializer.serialize() of tables', micro_serialize),
+    process = (u'PyminDaemon.process(), without networking', micro_process),
+)
+
+default_micro_benchmarks = ('parse', 'route', 'dispatch', 'serialize', 'process')
+
+def timeit(func, args, min_time=0.2):
+    r"""timeit(func, args[, min_time]) -> float :: Time a call, in seconds.
+
+    func(*args) is called in loops of increasing size until a loop takes at
+    least min_time seconds, and then the best of 3 loops is returned.
+    """
+    n = 1
+    while True:
+        start = monotonic()
+        for i in xrange(n):
+            func(*args)
+        elapsed = monotonic() - start
+        if elapsed >= min_time:
+            break
+        n *= 2
+    best = elapsed
+    for r in range(2):
+        start = monotonic()
+        for i in xrange(n):
+            func(*args)
+        best = min(best, monotonic() - start)
+    return best / n
+
+def run_micro(options, names):
+    r"run_micro(options, names) -> None :: Run the micro benchmarks."
+    logging.disable(logging.CRITICAL)
+    print '%-10s %-20s %12s %12s' % ('benchmark', 'case', 'us/call',
+                                     'calls/s')
+    for name in names:
+        for (label, func, args) in micro_benchmarks[name][1]():
+            t = timeit(func, args, options.min_time)
+            print '%-10s %-20s %12.2f %12.1f' % (name, label, t * 1e6, 1 / t)
+            sys.stdout.flush()
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [NAME ...]')
+    parser.add_option('-m', '--micro', action='store_true', default=False,
+                      help='run micro benchmarks instead of the load test')
+    parser.add_option('-l', '--list', action='store_true', default=False,
+                      help='list the scenarios and micro benchmarks')
+    parser.add_option('-n', '--requests', type='int', default=2000,
+                      help='requests per scenario and size [%default]')
+    parser.add_option('-c', '--concurrency', type='int', default=4,
+                      help='requests in flight [%default]')
+    parser.add_option('-t', '--transport', choices=('udp', 'tcp'),
+                      default='udp', help='udp or tcp [%default]')
+    parser.add_option('-w', '--workers', type='int', default=0,
+                      help='daemon pre-forked workers [%default]')
+    parser.add_option('-i', '--timer', type='float', default=1,
+                      help='daemon timer interval in seconds [%default]')
+    parser.add_option('-p', '--port', type='int', default=0,
+                      help='daemon port [random]')
+    parser.add_option('-T', '--min-time', type='float', default=0.2,
+                      help='micro benchmarks minimum loop time [%default]')
+    parser.add_option('-s', '--seed', type='int', default=0,
+                      help='random seed [%default]')
+    (options, names) = parser.parse_args()
+    random.seed(options.seed)
+    if options.list:
+        print 'Scenarios:'
+        for name in default_scenarios:
+            print '  %-10s %s' % (name, scenarios[name][0])
+        print 'Micro benchmarks:'
+        for name in default_micro_benchmarks:
+            print '  %-10s %s' % (name, micro_benchmarks[name][0])
+        return
+    available = scenarios
+    if options.micro:
+        available = micro_benchmarks
+    for name in names:
+        if name not in available:
+            parser.error('unknown benchmark: %s' % name)
+    if options.micro:
+        run_micro(options, names or default_micro_benchmarks)
+    else:
+        run_load(options, names or default_scenarios)
+
+if __name__ == '__main__':
+    main()
+
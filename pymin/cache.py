@@ -0,0 +1,144 @@
+# vim: set encoding=utf-8 et sw=4 sts=4 :
+
+r"""
+Responses cache.
+
+This module provides a ResponseCache class to keep already built responses
+(lists of strings) of read-only commands, so repeated requests don't need
+to call the handlers and serialize the results again.
+
+Please see ResponseCache class documentation for more info.
+"""
+
+import logging ; log = logging.getLogger('pymin.cache')
+
+__all__ = ('ResponseCache',)
+
+# Linked list node fields
+_PREV, _NEXT, _KEY, _RESPONSE, _SIZE = range(5)
+
+class ResponseCache:
+    r"""ResponseCache([max_size]) -> ResponseCache instance :: LRU cache.
+
+    Keep responses (lists of strings) using up to max_size bytes (the sum of
+    the lengths of the strings). When there is no room for a new response,
+    the least recently used ones are evicted. Responses bigger than a quarter
+    of max_size are not cached.
+
+    Responses are valid only for a particular version of the state they were
+    built from: when get() or put() are called with a new version, the whole
+    cache is cleared. The number of hits and misses is counted.
+    """
+
+    def __init__(self, max_size=4194304):
+        r"""Initialize the ResponseCache object.
+
+        See ResponseCache class documentation for more info.
+        """
+        log.debug(u'ResponseCache(%r)', max_size)
+        self.max_size = max_size
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.clear()
+
+    def clear(self):
+        r"clear() -> None :: Remove all the responses."
+        self.size = 0
+        # key -> node
+        self._nodes = dict()
+        # circular doubly linked list of nodes, most recently used first,
+        # each node is a list [prev, next, key, response, size]
+        self._root = root = [None, None, None, None, 0]
+        root[_PREV] = root[_NEXT] = root
+
+    def __len__(self):
+        r"len(cache) -> int :: Get the number of cached responses."
+        return len(self._nodes)
+
+    def _check_version(self, version):
+        r"_check_version(version) -> None :: Clear the cache if outdated."
+        if version != self.version:
+            if self._nodes:
+                log.debug(u'ResponseCache: version %r, clearing', version)
+                self.clear()
+            self.version = version
+
+    def get(self, version, key):
+        r"""get(version, key) -> list/None :: Get a cached response.
+
+        None is returned if there is no response for key (for this version of
+        the state).
+        """
+        self._check_version(version)
+        node = self._nodes.get(key)
+        if node is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # move it to the front
+        node[_PREV][_NEXT] = node[_NEXT]
+        node[_NEXT][_PREV] = node[_PREV]
+        self._link(node)
+        return node[_RESPONSE]
+
+    def put(self, version, key, response):
+        r"put(version, key, response) -> None :: Cache a response for key."
+        self._check_version(version)
+        size = 0
+        for chunk in response:
+            size += len(chunk)
+        if size > self.max_size / 4:
+            return
+        if key in self._nodes:
+            self._remove(self._nodes[key])
+        while self.size + size > self.max_size:
+            self._remove(self._root[_PREV])
+        node = [None, None, key, response, size]
+        self._link(node)
+        self._nodes[key] = node
+        self.size += size
+
+    def _link(self, node):
+        r"_link(node) -> None :: Put a node at the front of the list."
+        root = self._root
+        node[_PREV] = root
+        node[_NEXT] = root[_NEXT]
+        root[_NEXT][_PREV] = node
+        root[_NEXT] = node
+
+    def _remove(self, node):
+        r"_remove(node) -> None :: Remove a node."
+        node[_PREV][_NEXT] = node[_NEXT]
+        node[_NEXT][_PREV] = node[_PREV]
+        del self._nodes[node[_KEY]]
+        self.size -= node[_SIZE]
+
+
+if __name__ == '__main__':
+
+    c = ResponseCache(100)
+    assert c.get(1, 'a') is None
+    c.put(1, 'a', ['OK 3\n', 'a\r\n'])
+    assert c.get(1, 'a') == ['OK 3\n', 'a\r\n']
+    assert (c.hits, c.misses, c.size, len(c)) == (1, 1, 8, 1), \
+                (c.hits, c.misses, c.size, len(c))
+    # too big
+    c.put(1, 'big', ['x' * 26])
+    assert c.get(1, 'big') is None
+    # LRU eviction
+    for k in 'bcdefghijklm':
+        c.put(1, k, ['x' * 8])
+        c.get(1, 'a')
+    assert c.size <= 100, c.size
+    assert c.get(1, 'a') is not None
+    assert c.get(1, 'b') is None
+    assert c.get(1, 'm') is not None
+    # replace
+    c.put(1, 'm', ['y'])
+    assert c.get(1, 'm') == ['y']
+    # new version
+    c.get(2, 'a')
+    assert (len(c), c.size) == (0, 0), (len(c), c.size)
+    print 'hits:', c.hits, 'misses:', c.misses
+
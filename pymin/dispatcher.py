@@ -194,6 +194,10 @@ def handler(help):
     This is a decorator to mark a callable object as a dispatcher handler.
 
     help - Help string for the handler.
+
+    Handlers can be asynchronous, returning a pymin.executor.Future instead
+    of the result (for example, generators decorated with
+    pymin.executor.coroutine, which should be applied before this decorator).
     """
     if not help:
         raise TypeError("'help' should not be empty")
@@ -204,26 +208,27 @@ def handler(help):
         # positional and keyword arguments, but checking for the correct
         # arguments and raising an exception in case the arguments doesn't
         # match.
-        # So we create a dummy function, with the same signature as the
-        # wrapped one, so we can check later (at "dispatch-time") if the
-        # real function call will be successful. If the dummy function don't
-        # raise a TypeError, the arguments are just fine.
-        env = dict()
-        argspec = inspect.getargspec(f)
+        # So we precompute the function signature and just call the real
+        # function. Only if it raises a TypeError we check (at
+        # "dispatch-time") if the arguments were wrong (when they are, the
+        # function is never really executed) or the error was raised by the
+        # function itself.
+        # Coroutines (see pymin.executor.coroutine()) keep the original
+        # function, which has the real signature.
+        argspec = inspect.getargspec(getattr(f, 'coroutine_function', f))
         signature = inspect.formatargspec(*argspec)
-        # The dummy function
-        exec "def f%s: pass" % signature in env
-        signature_check = env['f']
+        sig = _Signature(f.__name__, argspec)
         # The wrapper to check the signature at "dispatch-time"
         def wrapper(*args, **kwargs):
-            # First we check if the arguments passed are OK.
             try:
-                signature_check(*args, **kwargs)
-            except TypeError, e:
+                return f(*args, **kwargs)
+            except TypeError:
+                e = sig.check(args, kwargs)
+                if e is None:
+                    # The arguments are fine, it's a real error
+                    raise
                 # If not, we raise an appropriate error.
                 raise WrongArgumentsError(f, e)
-            # If they are fine, we call the real function
-            return f(*args, **kwargs)
         # Some flag to mark our handlers for simple checks
         wrapper._dispatcher_handler = True
         # The help string we asked for in the first place =)
@@ -242,11 +247,114 @@ def handler(help):
         return wrapper
     return make_wrapper
 
+class _Signature:
+    r"""_Signature(name, argspec) -> _Signature instance :: Arguments checker.
+
+    Check if a function called 'name' with the signature 'argspec' (as
+    returned by inspect.getargspec()) can be called with some arguments,
+    without calling it. The errors are the same Python would report.
+    """
+
+    def __init__(self, name, (args, varargs, varkw, defaults)):
+        r"Initialize the object, see class documentation for more info."
+        self.name = name
+        self.nargs = len(args)
+        self.ndefaults = len(defaults or ())
+        self.varargs = varargs is not None
+        self.varkw = varkw is not None
+        # argument name -> position (unpacked tuple arguments have no name)
+        self.positions = dict([(a, i) for (i, a) in enumerate(args)
+                                    if isinstance(a, basestring)])
+        # Number of arguments without a default value
+        self.required = self.nargs - self.ndefaults
+
+    def check(self, args, kwargs):
+        r"""check(args, kwargs) -> TypeError/None :: Check the arguments.
+
+        If the function can't be called using the positional arguments
+        'args' and the keyword arguments 'kwargs', return the TypeError
+        Python would raise, if it can, return None.
+        """
+        given = len(args)
+        nargs = self.nargs
+        if not (nargs or self.varargs or self.varkw):
+            if given or kwargs:
+                return TypeError('%s() takes no arguments (%d given)'
+                                    % (self.name, given + len(kwargs)))
+            return None
+        if given > nargs and not self.varargs:
+            quant = 'exactly'
+            if self.ndefaults:
+                quant = 'at most'
+            return self._count_error(quant, nargs, given + len(kwargs))
+        filled = list()
+        for k in kwargs:
+            i = self.positions.get(k)
+            if i is None:
+                if not self.varkw:
+                    return TypeError("%s() got an unexpected keyword "
+                                     "argument '%s'" % (self.name, k))
+            elif i < given:
+                return TypeError("%s() got multiple values for keyword "
+                                 "argument '%s'" % (self.name, k))
+            else:
+                filled.append(i)
+        required = self.required
+        if given < required:
+            for i in xrange(given, required):
+                if i not in filled:
+                    quant = 'exactly'
+                    if self.varargs or self.ndefaults:
+                        quant = 'at least'
+                    return self._count_error(quant, required,
+                                             min(given, nargs) + len(filled))
+        return None
+
+    def _count_error(self, quant, n, given):
+        r"_count_error(quant, n, given) -> TypeError :: Wrong arguments count."
+        pl = 's'
+        if n == 1:
+            pl = ''
+        return TypeError('%s() takes %s %d argument%s (%d given)'
+                                % (self.name, quant, n, pl, given))
+
 def is_handler(handler):
     r"is_handler(handler) -> bool :: Tell if a object is a handler."
     return callable(handler) and hasattr(handler, '_dispatcher_handler') \
                 and handler._dispatcher_handler
 
+# Generation of the handlers tree, it's incremented each time a handler is
+# attached to (or detached from) a Handler, so the Dispatchers know when their
+# routes tables are outdated
+_routes_generation = 0
+
+def _is_route(obj):
+    r"_is_route(obj) -> bool :: Tell if obj can be part of a command route."
+    return isinstance(obj, Handler) or is_handler(obj)
+
+def _routes_changed():
+    r"_routes_changed() -> None :: Invalidate all the routes tables."
+    global _routes_generation
+    _routes_generation += 1
+
+def _class_routes(cls):
+    r"""_class_routes(cls) -> tuple :: Get the routes defined by a class.
+
+    The names of the class attributes (inherited ones included) which are
+    commands or subhandlers are looked up only the first time, then they are
+    kept in the class (in the '_class_routes' attribute).
+    """
+    routes = cls.__dict__.get('_class_routes')
+    if routes is None:
+        routes = list()
+        for a in dir(cls):
+            if a == 'parent': continue # Skip parents in SubHandlers
+            if _is_route(getattr(cls, a)):
+                routes.append(a)
+        routes = tuple(routes)
+        cls._class_routes = routes
+    return routes
+
 class Handler:
     r"""Handler() -> Handler instance :: Base class for all dispatcher handlers.
 
@@ -257,10 +365,41 @@ class Handler:
 
     handler_help = u'Undocumented handler'
 
+    def __setattr__(self, name, value):
+        r"__setattr__(name, value) -> None :: Invalidate routes if needed."
+        if _is_route(value) or _is_route(self.__dict__.get(name)):
+            _routes_changed()
+        self.__dict__[name] = value
+
+    def __delattr__(self, name):
+        r"__delattr__(name) -> None :: Invalidate routes if needed."
+        if name not in self.__dict__:
+            raise AttributeError(name)
+        if _is_route(self.__dict__[name]):
+            _routes_changed()
+        del self.__dict__[name]
+
+    def _routes(self):
+        r"""_routes() -> list :: Get the commands and subhandlers.
+
+        A sorted list of (name, object) tuples is returned. The routes
+        defined by the class are taken from its index (see _class_routes()),
+        so only the instance attributes are inspected each time.
+        """
+        names = set(_class_routes(self.__class__))
+        for (a, h) in self.__dict__.items():
+            if a != 'parent' and _is_route(h):
+                names.add(a)
+            else: # instance attributes hide class attributes
+                names.discard(a)
+        names = list(names)
+        names.sort()
+        return [(a, getattr(self, a)) for a in names]
+
     @handler(u'List available commands')
     def commands(self):
         r"""commands() -> generator :: List the available commands."""
-        return (a for a in dir(self) if is_handler(getattr(self, a)))
+        return (a for (a, h) in self._routes() if is_handler(h))
 
     @handler(u'Show available commands with their help')
     def help(self, command=None):
@@ -272,11 +411,8 @@ class Handler:
         """
         if command is None:
             d = dict()
-            for a in dir(self):
-                h = getattr(self, a)
-                if a == 'parent': continue # Skip parents in SubHandlers
-                if is_handler(h) or isinstance(h, Handler):
-                    d[a] = h.handler_help
+            for (a, h) in self._routes():
+                d[a] = h.handler_help
             return d
         # A command was specified
         if command == 'parent': # Skip parents in SubHandlers
@@ -289,15 +425,20 @@ class Handler:
         return handler.handler_help
 
     def handle_timer(self):
-        r"""handle_timer() -> None :: Do periodic tasks.
+        r"""handle_timer() -> bool :: Do periodic tasks.
+
+        Returns True if the handler state changed (so cached responses are
+        discarded), False otherwise. Handlers returning None (that don't tell)
+        are assumed to have changed their state.
 
         By default we do nothing but calling handle_timer() on subhandlers.
         """
-        for a in dir(self):
-            if a == 'parent': continue # Skip parents in SubHandlers
-            h = getattr(self, a)
+        changed = False
+        for (a, h) in self._routes():
             if isinstance(h, Handler):
-                h.handle_timer()
+                if h.handle_timer() is not False:
+                    changed = True
+        return changed
 
 def parse_command(command):
     r"""parse_command(command) -> (args, kwargs) :: Parse a command.
@@ -375,6 +516,107 @@ def parse_command(command):
     Missing quote: "hello world
     Missing value: hello=
     """
+    seq = []
+    dic = {}
+    buff = [] # parts of the current token
+    keyword = None
+    state = _SEP
+    for m in _command_re.finditer(command):
+        kind = m.lastindex
+        if kind is None: # Escape at the end of the command, ignored
+            continue
+        c = m.group(kind)
+        # Escaped character
+        if kind == _ESCAPE:
+            # Not yet registered the token
+            if state is _SEP and buff:
+                _register_token(buff, keyword, seq, dic)
+                buff = []
+                keyword = None
+                state = _TOKEN
+            buff.append(_escaped_chars.get(c, c))
+            continue
+        # Inside quotes everything but the closing quote is literal
+        if state is _DQUOTE or state is _SQUOTE:
+            if c == state:
+                state = _TOKEN
+            else:
+                buff.append(c)
+            continue
+        if kind == _SEPARATORS:
+            state = _SEP
+            continue
+        # Looking for spaces, the previous token (if any) is finished
+        if state is _SEP:
+            # Not the first item (even if was a escape seq), see
+            # _parse_command_reference()
+            if buff and m.start() != 2:
+                if kind == _EQUAL: # Keyword found
+                    keyword = u''.join(buff)
+                    buff = []
+                    continue
+                _register_token(buff, keyword, seq, dic)
+                buff = []
+                keyword = None
+            state = _TOKEN
+        # Getting a token
+        if kind == _QUOTE:
+            state = _quote_states[c]
+        # Check if a keyword is added
+        elif kind == _EQUAL and keyword is None and buff:
+            keyword = u''.join(buff)
+            buff = []
+            state = _SEP
+        else:
+            buff.append(c)
+    if state is _DQUOTE or state is _SQUOTE:
+        raise ParseError(command, u'missing closing quote (%s)' % state)
+    if not buff and keyword is not None:
+        raise ParseError(command,
+                        u'keyword argument (%s) without value' % keyword)
+    if buff:
+        _register_token(buff, keyword, seq, dic)
+    return (seq, dic)
+
+# parse_command() states
+_SEP, _TOKEN, _DQUOTE, _SQUOTE = u' ', u'', u'"', u"'"
+_quote_states = {u'"': _DQUOTE, u"'": _SQUOTE}
+
+# parse_command() chunks, each one is a group (its lastindex)
+(_ESCAPE, _SEPARATORS, _QUOTE, _EQUAL, _CHARS) = range(1, 6)
+_command_re = re.compile(ur'\\(.)?'                 # _ESCAPE
+                         ur'|([ \t\v\n]+)'           # _SEPARATORS
+                         ur'|(["\'])'                 # _QUOTE
+                         ur'|(=)'                     # _EQUAL
+                         ur'|([^ \t\v\n"\'=\\]+)',    # _CHARS
+                         re.DOTALL | re.UNICODE)
+
+# Escaped sequences (any other escaped character is taken literally)
+_escaped_chars = {u'a': u'\a', u'n': u'\n', u'r': u'\r', u'b': u'\b',
+                  u'v': u'\v', u't': u'\t', u'N': u'\\N'}
+
+def _register_token(buff, keyword, seq, dic):
+    r"_register_token(buff, keyword, seq, dic) -> None :: Add a token."
+    token = u''.join(buff)
+    if token == u'\\N':
+        token = None
+    if keyword is not None:
+        dic[keyword.encode('utf-8')] = token
+    else:
+        seq.append(token)
+
+def _parse_command_reference(command):
+    r"""_parse_command_reference(command) -> (args, kwargs) :: Parse a command.
+
+    This is the original (and much slower) character by character
+    implementation of parse_command(), kept as a reference to test that
+    both give exactly the same results.
+
+    Note that the check to avoid registering a token started by an escape
+    sequence at the beginning of the command is done by position, so a
+    token of one character followed by one separator at the beginning of
+    the command is joined with the next token ('a b' is parsed as 'ab').
+    """
     SEP, TOKEN, DQUOTE, SQUOTE, EQUAL = u' ', None, u'"', u"'", u'=' # states
     separators = (u' ', u'\t', u'\v', u'\n') # token separators
     escaped_chars = (u'a', u'n', u'r', u'b', u'v', u't') # escaped sequences
@@ -496,6 +738,15 @@ class Dispatcher:
     complex and deep as you want.
 
     If some command can't be dispatched, a CommandError subclass is raised.
+
+    To avoid inspecting the handlers on each command, the tree of Handler
+    instances is compiled into a routes table the first time a command is
+    looked up. The table is compiled again only when a handler is attached
+    to or detached from a Handler instance (i.e. when an attribute holding a
+    handler is set or deleted). Routes not found in the table (like objects
+    that are not Handler instances or attributes provided by __getattr__)
+    are still looked up by inspecting the objects, so changes to class
+    attributes of already compiled handlers are the only ones not noticed.
     """
 
     def __init__(self, root):
@@ -505,6 +756,10 @@ class Dispatcher:
         """
         log.debug(u'Dispatcher(%r)', root)
         self.root = root
+        # Compiled routes table, see _routes()
+        self._table = None
+        self._table_root = None
+        self._table_generation = None
 
     def dispatch(self, route):
         r"""dispatch(route) -> None :: Dispatch a command string.
@@ -516,40 +771,128 @@ class Dispatcher:
         route - *unicode* string with the command route.
         """
         log.debug('Dispatcher.dispatch(%r)', route)
-        command = list()
+        (handler, command, args, kwargs) = self.resolve(route)
+        log.debug(u'Dispatcher.dispatch: %r is a handler, calling it with '
+                    u'args=%r, kwargs=%r', handler, args, kwargs)
+        r = handler(*args, **kwargs)
+        log.debug(u'Dispatcher.dispatch: handler returned %s', r)
+        return r
+
+    def resolve(self, route):
+        r"""resolve(route) -> (handler, command, args, kwargs) :: Find handler.
+
+        This method searches for a suitable callable object in the routes
+        "tree" (without calling it), or raises a CommandError subclass if the
+        command can't be dispatched.
+
+        It returns a tuple with the handler, the command (the list of path
+        components used to reach the handler), and the positional and
+        keyword arguments the handler should be called with.
+
+        route - *unicode* string with the command route.
+        """
+        log.debug('Dispatcher.resolve(%r)', route)
         (route, kwargs) = parse_command(route)
-        log.debug(u'Dispatcher.dispatch: route=%r, kwargs=%r', route, kwargs)
+        return self.lookup(route, kwargs)
+
+    def lookup(self, route, kwargs):
+        r"""lookup(route, kwargs) -> (handler, command, args, kwargs)
+
+        Find the handler of an already parsed command (see parse_command()).
+        This is the same as resolve(), but route is the list of (unicode)
+        arguments of the command and kwargs the dictionary of keyword
+        arguments.
+        """
+        log.debug(u'Dispatcher.lookup: route=%r, kwargs=%r', route, kwargs)
         if not route:
-            log.debug(u'Dispatcher.dispatch: command not specified')
+            log.debug(u'Dispatcher.lookup: command not specified')
             raise CommandNotSpecifiedError()
+        table = self._routes()
         handler = self.root
+        depth = 0
+        for name in route:
+            if table is None:
+                break
+            entry = table.get(name)
+            if entry is None:
+                break
+            (handler, table) = entry
+            depth += 1
+            if table is _leaf:
+                return (handler, route[:depth], route[depth:], kwargs)
+        # Not in the routes table (or an error), inspect the objects
+        return self._walk(handler, route[:depth], route[depth:], kwargs)
+
+    def _walk(self, handler, command, route, kwargs):
+        r"""_walk(handler, command, route, kwargs) -> (handler, ...)
+
+        Look for the handler of a command inspecting the objects attributes,
+        starting at 'handler', which was reached using the list of path
+        components 'command'. 'route' has the path components still to be
+        followed. The return value is the same as lookup().
+        """
         while not is_handler(handler):
-            log.debug(u'Dispatcher.dispatch: handler=%r, route=%r',
+            log.debug(u'Dispatcher.lookup: handler=%r, route=%r',
                         handler, route)
             if len(route) is 0:
                 if isinstance(handler, Handler):
-                    log.debug(u'Dispatcher.dispatch: command is a handler')
+                    log.debug(u'Dispatcher.lookup: command is a handler')
                     raise CommandIsAHandlerError(command)
-                log.debug(u'Dispatcher.dispatch: command not found')
+                log.debug(u'Dispatcher.lookup: command not found')
                 raise CommandNotFoundError(command)
             command.append(route[0])
-            log.debug(u'Dispatcher.dispatch: command=%r', command)
+            log.debug(u'Dispatcher.lookup: command=%r', command)
             if route[0] == 'parent':
-                log.debug(u'Dispatcher.dispatch: is parent => not found')
+                log.debug(u'Dispatcher.lookup: is parent => not found')
                 raise CommandNotFoundError(command)
             if not hasattr(handler, route[0].encode('utf-8')):
                 if isinstance(handler, Handler) and len(command) > 1:
-                    log.debug(u'Dispatcher.dispatch: command not in handler')
+                    log.debug(u'Dispatcher.lookup: command not in handler')
                     raise CommandNotInHandlerError(command)
-                log.debug(u'Dispatcher.dispatch: command not found')
+                log.debug(u'Dispatcher.lookup: command not found')
                 raise CommandNotFoundError(command)
             handler = getattr(handler, route[0].encode('utf-8'))
             route = route[1:]
-        log.debug(u'Dispatcher.dispatch: %r is a handler, calling it with '
-                    u'route=%r, kwargs=%r', handler, route, kwargs)
-        r = handler(*route, **kwargs)
-        log.debug(u'Dispatcher.dispatch: handler returned %s', r)
-        return r
+        return (handler, command, route, kwargs)
+
+    def _routes(self):
+        r"""_routes() -> dict :: Get the routes table, compiling it if needed.
+
+        The routes table is a dictionary with the names of the commands and
+        subhandlers of the root handler as keys, and (object, table) tuples
+        as values, where table is the routes table of that object (_leaf if
+        the object is a command, or None if the object can't be compiled).
+        None is returned if the root handler can't be compiled.
+        """
+        if self._table_generation != _routes_generation \
+                or self._table_root is not self.root:
+            log.debug(u'Dispatcher._routes: compiling routes table')
+            self._table_generation = _routes_generation
+            self._table_root = self.root
+            self._table = self._compile(self.root, set())
+        return self._table
+
+    def _compile(self, handler, seen):
+        r"""_compile(handler, seen) -> dict :: Compile the handler routes.
+
+        Only Handler instances are compiled; seen is the set of ids of the
+        handlers being compiled, to avoid looping forever if the tree has
+        cycles.
+        """
+        if not isinstance(handler, Handler) or id(handler) in seen:
+            return None
+        seen.add(id(handler))
+        table = dict()
+        for (a, h) in handler._routes():
+            if is_handler(h):
+                table[a] = (h, _leaf)
+            elif isinstance(h, Handler):
+                table[a] = (h, self._compile(h, seen))
+        seen.remove(id(handler))
+        return table
+
+# Marker for commands in the routes tables
+_leaf = object()
 
 
 if __name__ == '__main__':
@@ -652,6 +995,67 @@ if __name__ == '__main__':
         assert False, 'It should raised a WrongArgumentsError'
     except WrongArgumentsError, e:
         print 'Bad arguments:', e
+    # Routes changes
+    t = d._routes()
+    assert d._routes() is t
+    r = d.lookup([u'inst', u'subclass', u'subcmd', u'x'], {})
+    assert r[1:] == ([u'inst', u'subclass', u'subcmd'], [u'x'], {}), r
+    root = d.root
+    root.new = TestClassSubHandler()
+    assert d._routes() is not t
+    r = d.lookup([u'new', u'subcmd'], {})
+    assert r[1:] == ([u'new', u'subcmd'], [], {}), r
+    t = d._routes()
+    root.value = 1
+    assert d._routes() is t
+    del root.new
+    assert d._routes() is not t
+    try:
+        d.dispatch('new subcmd')
+        assert False, 'It should raised a CommandNotFoundError'
+    except CommandNotFoundError, e:
+        print 'Not found:', e
+    try:
+        d.dispatch('inst subclass parent')
+        assert False, 'It should raised a CommandNotFoundError'
+    except CommandNotFoundError, e:
+        print 'Not found:', e
+    # Instance attributes are listed too, and hide the class ones
+    root.extra = TestClassSubHandler()
+    root.extra.cmd = test_func
+    root.extra.subcmd = None
+    r = list(d.dispatch('extra commands'))
+    assert r == ['cmd', 'commands', 'help'], r
+    r = d.dispatch('help')
+    assert sorted(r) == ['commands', 'extra', 'func', 'help', 'inst'], r
+    assert TestClassSubHandler._class_routes == ('commands', 'help', 'subcmd')
+    # Signatures checks should match the real TypeErrors
+    def f0(): pass
+    def f1(a): pass
+    def f2(a, b=1): pass
+    def f3(a, b, c=1, d=2): pass
+    def f4(a, *args): pass
+    def f5(a, b=1, *args, **kwargs): pass
+    def f6(a, b, **kwargs): pass
+    calls = [((), {}), ((1,), {}), ((1, 2), {}), ((1, 2, 3), {}),
+             ((1, 2, 3, 4, 5), {}), ((), dict(a=1)), ((1,), dict(a=1)),
+             ((), dict(b=1)), ((1,), dict(b=1)), ((1,), dict(c=1)),
+             ((), dict(x=1)), ((1, 2), dict(x=1)), ((), dict(a=1, b=2)),
+             ((), dict(a=1, c=2)), ((), dict(b=1, c=2)),
+             ((1, 2, 3), dict(d=1)), ((1,), dict(d=1)),
+             ((1, 2, 3, 4, 5), dict(a=1))]
+    for f in (f0, f1, f2, f3, f4, f5, f6):
+        sig = _Signature(f.__name__, inspect.getargspec(f))
+        for (args, kwargs) in calls:
+            try:
+                f(*args, **kwargs)
+                expected = None
+            except TypeError, e:
+                expected = str(e)
+            e = sig.check(args, kwargs)
+            if e is not None:
+                e = str(e)
+            assert e == expected, (f.__name__, args, kwargs, e, expected)
     print
     print
 
@@ -698,6 +1102,34 @@ if __name__ == '__main__':
     assert p == ([u'Not\\N'], {}), p
     p = parse_command(r'\None')
     assert p == ([u'\\None'], {}), p
+
+    # parse_command() should give exactly the same results as the reference
+    # implementation
+    import random
+    def check_parse(command):
+        try:
+            expected = _parse_command_reference(command)
+        except ParseError, e:
+            expected = unicode(e)
+        try:
+            result = parse_command(command)
+        except ParseError, e:
+            result = unicode(e)
+        assert result == expected, (command, result, expected)
+    corpus = [u'', u' ', u'a', u'a b', u'a  b', u'ab c', u' \\ta', u'\\t\\ta',
+              u'a=b =c', u'a "" b', u'\\\\N', u'x \\N=1', u'a=\\tb', u'a\\',
+              u'"a\\', u'a=', u'a= ', u'a ="b c"', u'"a=b"=c', u"'a\"b'",
+              u'"a\'b"\'c"d\'', u'\\"a"', u'=', u'==', u'a==b', u' =a',
+              u'a = b', u'x \\"=y', u'k="\\N"', u'\xf1and\xfa=\xe1rbol',
+              u'a\tb\vc\nd\re', u'\\a\\b\\c\\v\\r\\n\\t\\N\\\\ \\ ',
+              u'vpn key add k pub="' + u'AbC+/=' * 100 + u'"']
+    for command in corpus:
+        check_parse(command)
+    rnd = random.Random(1)
+    alphabet = u'ab  \t\v\n"\'==\\\\Nnt\xf1'
+    for i in range(20000):
+        check_parse(u''.join([rnd.choice(alphabet)
+                              for j in range(rnd.randint(0, 12))]))
     try:
         p = parse_command('hello=')
         assert False, p + ' should raised a ParseError'
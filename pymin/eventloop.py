@@ -6,13 +6,72 @@ A simple event loop.
 Please see EventLoop class documentation for more info.
 """
 
+import os
+import math
+import fcntl
+import heapq
 import select
 import errno
 import signal
-from select import POLLIN, POLLPRI, POLLERR
+import itertools
+import collections
 import logging ; log = logging.getLogger('pymin.eventloop')
 
-__all__ = ('EventLoop', 'LoopInterruptedError')
+__all__ = ('EventLoop', 'Timer', 'LoopInterruptedError', 'monotonic',
+           'READ', 'WRITE', 'ERROR', 'PollBackend', 'EpollBackend',
+           'backends', 'best_backend')
+
+# Events reported by the backends
+READ = 1
+WRITE = 2
+ERROR = 4
+
+def _os_times_monotonic():
+    r"""monotonic() -> float :: Get a monotonic clock value (in seconds).
+
+    The returned value is the elapsed real time since an arbitrary point
+    in the past, so it's only useful to compare it with other values
+    returned by this function. It's not affected by system clock
+    updates.
+    """
+    return os.times()[4]
+
+def _clock_gettime_monotonic():
+    r"""_clock_gettime_monotonic() -> callable :: Get a clock_gettime() clock.
+
+    os.times() has a poor resolution (usually 10ms), so if it's possible,
+    the POSIX CLOCK_MONOTONIC clock is used (through ctypes). None is
+    returned if it's not available.
+    """
+    try:
+        import ctypes
+        import ctypes.util
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        lib = ctypes.CDLL(ctypes.util.find_library('rt')
+                            or ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = lib.clock_gettime
+        clock_gettime.argtypes = (ctypes.c_int, ctypes.POINTER(timespec))
+        CLOCK_MONOTONIC = 1 # Linux value
+        def monotonic():
+            ts = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)):
+                return _os_times_monotonic()
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        monotonic.__doc__ = _os_times_monotonic.__doc__
+        monotonic()
+        return monotonic
+    except (ImportError, OSError, AttributeError, TypeError):
+        return None
+
+try:
+    from time import monotonic
+except ImportError:
+    monotonic = None
+    if os.uname()[0] == 'Linux':
+        monotonic = _clock_gettime_monotonic()
+    if monotonic is None:
+        monotonic = _os_times_monotonic
 
 class LoopInterruptedError(RuntimeError):
     r"""
@@ -38,22 +97,263 @@ class LoopInterruptedError(RuntimeError):
         r"str(obj) -> String representation."
         return 'Loop interrupted: %s' % self.select_error
 
-# Flag to know if a signal was caught
-signals = list()
+def get_fileno(file):
+    r"get_fileno(file) -> int :: Get the file descriptor of a file object."
+    if hasattr(file, 'fileno'):
+        return file.fileno()
+    return file
+
+class Timer:
+    r"""Timer(when, interval, callback, args) -> Timer instance.
+
+    This class represents a scheduled call to 'callback' (with the 'args'
+    positional arguments). 'when' is the monotonic() time when the callback
+    should be called and 'interval' is the number of seconds between calls
+    for periodic timers (or None if the timer should be fired only once).
+
+    You shouldn't create Timer objects directly, they are returned by
+    EventLoop.call_later() and EventLoop.call_every(). The only useful thing
+    you can do with a Timer is cancel() it.
+    """
+
+    def __init__(self, when, interval, callback, args):
+        r"""Initialize the Timer object.
+
+        See Timer class documentation for more info.
+        """
+        self.when = when
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        r"""cancel() -> None :: Cancel the timer.
+
+        The callback will not be called anymore (even if it's a periodic
+        timer).
+        """
+        log.debug(u'Timer.cancel(): %r', self)
+        self.cancelled = True
+
+    def __repr__(self):
+        r"repr(obj) -> Object representation."
+        return 'Timer(when=%r, interval=%r, callback=%r, cancelled=%r)' \
+                    % (self.when, self.interval, self.callback, self.cancelled)
+
+class PollBackend:
+    r"""PollBackend() -> PollBackend instance.
+
+    Polling backend based on the poll() system call. It's available almost
+    everywhere, but each wakeup costs time proportional to the number of
+    registered file descriptors. Edge-triggered registration is not
+    supported (level-triggered is used instead, which is always correct for
+    edge-triggered users, because they read until there is nothing left).
+
+    All backends provide the same interface: register(), unregister(),
+    poll() and close(). Events are expressed as a combination of the READ,
+    WRITE and ERROR module constants.
+    """
+
+    name = 'poll'
+
+    supports_edge = False
+
+    def available(cls):
+        r"available() -> bool :: Tell if the backend can be used."
+        return hasattr(select, 'poll')
+    available = classmethod(available)
+
+    def __init__(self):
+        r"""Initialize the PollBackend object.
+
+        See PollBackend class documentation for more info.
+        """
+        self._poll = select.poll()
+
+    def register(self, fd, events, edge=False):
+        r"""register(fd, events[, edge]) -> None :: Watch fd for events.
+
+        If fd is already registered, its events are replaced.
+        """
+        mask = select.POLLERR
+        if events & READ:
+            mask |= select.POLLIN | select.POLLPRI
+        if events & WRITE:
+            mask |= select.POLLOUT
+        self._poll.register(fd, mask)
+
+    def unregister(self, fd):
+        r"unregister(fd) -> None :: Stop watching fd."
+        self._poll.unregister(fd)
+
+    def poll(self, timeout=None):
+        r"""poll([timeout]) -> list of (fd, events) :: Wait for events.
+
+        timeout is expressed in milliseconds, None means wait forever.
+        """
+        result = list()
+        for (fd, mask) in self._poll.poll(timeout):
+            events = 0
+            if mask & (select.POLLIN | select.POLLPRI):
+                events |= READ
+            if mask & select.POLLOUT:
+                events |= WRITE
+            if mask & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                events |= ERROR
+            result.append((fd, events))
+        return result
+
+    def close(self):
+        r"close() -> None :: Release the backend resources."
+        pass
+
+class EpollBackend:
+    r"""EpollBackend() -> EpollBackend instance.
+
+    Polling backend based on Linux's epoll facility. The cost of each wakeup
+    is proportional to the number of ready file descriptors, not to the
+    number of registered ones, so it scales to thousands of descriptors.
+    Both level-triggered and edge-triggered registrations are supported.
+
+    epoll refuses to watch regular files (and some devices, like /dev/null),
+    which are always ready, so they are watched using a PollBackend instead
+    (in level-triggered mode). When some of them are ready, the epoll
+    descriptors are checked without waiting.
+
+    See PollBackend for the backends interface documentation.
+    """
+
+    name = 'epoll'
+
+    supports_edge = True
+
+    def available(cls):
+        r"available() -> bool :: Tell if the backend can be used."
+        return hasattr(select, 'epoll')
+    available = classmethod(available)
+
+    def __init__(self):
+        r"""Initialize the EpollBackend object.
+
+        See EpollBackend class documentation for more info.
+        """
+        self._epoll = select.epoll()
+        self._registered = set()
+        # PollBackend for the files epoll can't watch (created when needed)
+        self._fallback = None
+        self._fallback_fds = set()
+
+    def register(self, fd, events, edge=False):
+        r"""register(fd, events[, edge]) -> None :: Watch fd for events.
 
-# Alarm Signal handler
-def signal_handler(signum, stack_frame):
-    global signals
-    signals.append(signum)
+        If fd is already registered, its events are replaced. If edge is
+        True, the file descriptor is registered in edge-triggered mode.
+        """
+        mask = select.EPOLLERR | select.EPOLLHUP
+        if events & READ:
+            mask |= select.EPOLLIN | select.EPOLLPRI
+        if events & WRITE:
+            mask |= select.EPOLLOUT
+        if edge:
+            mask |= select.EPOLLET
+        if fd in self._fallback_fds:
+            self._fallback.register(fd, events)
+        elif fd in self._registered:
+            self._epoll.modify(fd, mask)
+        else:
+            try:
+                self._epoll.register(fd, mask)
+            except IOError, e:
+                if e.errno != errno.EPERM:
+                    raise
+                log.debug(u'EpollBackend: fd %r not supported by epoll, '
+                            u'using poll', fd)
+                if self._fallback is None:
+                    self._fallback = PollBackend()
+                self._fallback.register(fd, events)
+                self._fallback_fds.add(fd)
+                return
+            self._registered.add(fd)
+
+    def unregister(self, fd):
+        r"unregister(fd) -> None :: Stop watching fd."
+        if fd in self._fallback_fds:
+            self._fallback_fds.discard(fd)
+            self._fallback.unregister(fd)
+            return
+        self._registered.discard(fd)
+        try:
+            self._epoll.unregister(fd)
+        except (IOError, ValueError):
+            # the file descriptor was already closed
+            pass
+
+    def poll(self, timeout=None):
+        r"""poll([timeout]) -> list of (fd, events) :: Wait for events.
+
+        timeout is expressed in milliseconds, None means wait forever.
+        """
+        result = list()
+        if self._fallback_fds:
+            result = self._fallback.poll(0)
+            if result:
+                timeout = 0
+        if timeout is None:
+            timeout = -1
+        else:
+            timeout = timeout / 1000.0
+        for (fd, mask) in self._epoll.poll(timeout):
+            events = 0
+            if mask & (select.EPOLLIN | select.EPOLLPRI):
+                events |= READ
+            if mask & select.EPOLLOUT:
+                events |= WRITE
+            if mask & (select.EPOLLERR | select.EPOLLHUP):
+                events |= ERROR
+            result.append((fd, events))
+        return result
+
+    def close(self):
+        r"close() -> None :: Release the backend resources."
+        self._epoll.close()
+
+# Available backends, in order of preference
+backends = (EpollBackend, PollBackend)
+
+def best_backend():
+    r"""best_backend() -> backend instance :: Get the best available backend.
+
+    The first available backend in the 'backends' list is used.
+    """
+    for backend in backends:
+        if backend.available():
+            log.debug(u'best_backend() -> %s', backend.name)
+            return backend()
+    raise RuntimeError('No polling backend available')
 
 class EventLoop:
-    r"""EventLoop(file[, handler[, signals]]]) -> EventLoop.
+    r"""EventLoop([file[, handler[, signals[, backend]]]]) -> EventLoop.
 
     This class implements a simple event loop based on select module.
-    It "listens" to activity a single 'file' object (a file, a pipe,
-    a socket, or even a simple file descriptor) and calls a 'handler'
-    function (or the handle() method if you prefer subclassing) every
-    time the file is ready for reading (or has an error).
+    It "listens" to activity on any number of file objects (files, pipes,
+    sockets, or even simple file descriptors) and calls a callback every
+    time a file is ready for reading (or has an error) or writing. Timers
+    can be scheduled too, using call_later() and call_every().
+
+    Files are watched using add_reader() and add_writer(), which take
+    the file to watch, the callback and optional extra positional arguments
+    to pass to the callback (the callback is called only with the extra
+    arguments). To stop watching a file use remove_reader() and
+    remove_writer(). If the 'edge' keyword argument is True, the file is
+    watched in edge-triggered mode if the backend supports it, so the
+    callback should read (or write) until there is nothing left to do.
+
+    For convenience (and backward compatibility), a main 'file' can be
+    passed to the constructor. It's monitored for reading, and a 'handler'
+    function (or the handle() method if you prefer subclassing) is called
+    every time the file is ready for reading (or has an error). The handler
+    receives the event loop as the only argument.
 
     'signals' is a dictionary with signals to be handled by the loop,
     where keys are signal numbers and values are callbacks (which takes
@@ -61,6 +361,22 @@ class EventLoop:
     the captured signal number). Callbacks can be None if all signals
     are handled by the handle_signal() member function.
 
+    Signals are not handled inside the (asynchronous) signal handler.
+    Instead, the interpreter writes a byte to an internal pipe as soon as
+    a signal arrives (see signal.set_wakeup_fd(), the "self-pipe trick"),
+    and the pipe is watched by the loop as any other file, so a signal that
+    arrives just before polling still wakes the loop up immediately. The
+    signal handler only records the signal as pending, and the signal
+    callbacks are called from the loop as any other callback. Signals are
+    coalesced: if the same signal is received several times before the loop
+    gets a chance to handle it, the callback is called only once. The same
+    pipe is used by call_soon_threadsafe() to wake up the loop when other
+    threads schedule calls.
+
+    'backend' is the polling backend to use (see PollBackend and
+    EpollBackend). If it's None, the best available backend is used (see
+    best_backend()).
+
     This is a really simple example of usage using a hanlder callable:
 
     >>> import os
@@ -89,53 +405,371 @@ class EventLoop:
     This example loops until the user enter interrupts the program (by
     pressing Ctrl-C) or untile the program is terminated by a TERM signal
     (kill) when stop() is called and the event loop is exited.
+
+    And finally, an example watching several files and using timers:
+
+    >>> def echo(fd, name):
+    >>>     os.write(1, '%s: %r\n' % (name, os.read(fd, 100)))
+    >>> (r, w) = os.pipe()
+    >>> p = EventLoop()
+    >>> p.add_reader(0, echo, 0, 'stdin')
+    >>> p.add_reader(r, echo, r, 'pipe')
+    >>> p.call_every(1, os.write, w, 'tick')
+    >>> p.call_later(10, p.stop)
+    >>> p.loop()
     """
 
-    def __init__(self, file, handler=None, signals=None):
+    def __init__(self, file=None, handler=None, signals=None, backend=None):
         r"""Initialize the EventLoop object.
 
         See EventLoop class documentation for more info.
         """
-        log.debug(u'EventLoop(%r, %r, %r)', file, handler, signals)
-        self.poll = select.poll()
+        log.debug(u'EventLoop(%r, %r, %r, %r)', file, handler, signals,
+                    backend)
+        if backend is None:
+            backend = best_backend()
+        self.backend = backend
         self._stop = False
-        self.__register(file)
+        # fd -> (file, callback, args)
+        self._readers = dict()
+        self._writers = dict()
+        # fd -> registered events mask
+        self._events = dict()
+        # fds registered in edge-triggered mode
+        self._edge = set()
+        # heap of (when, sequence, timer)
+        self._timers = list()
+        self._timers_seq = itertools.count()
+        self._file = None
+        if file is not None:
+            self.__register(file)
         self.handler = handler
         self.signals = dict()
+        # signals received but not handled yet
+        self._pending_signals = set()
+        # calls scheduled from other threads
+        self._threadsafe_calls = collections.deque()
+        # self-pipe used to deliver signals and calls from other threads
+        self._wakeup_pipe = None
+        # True if the self-pipe is the interpreter's signals wakeup fd
+        self._signal_wakeup_fd = False
+        self._open_wakeup_pipe()
         if signals is None:
             signals = dict()
         for (signum, sighandler) in signals.items():
             self.set_signal(signum, sighandler)
 
     def __register(self, file):
-        r"__register(file) -> None :: Register a new file for polling."
+        r"__register(file) -> None :: Register the main file for polling."
         self._file = file
-        self.poll.register(self.fileno, POLLIN | POLLPRI | POLLERR)
+        self.add_reader(file, self._handle_file)
+
+    def _handle_file(self):
+        r"_handle_file() -> None :: Main file events callback."
+        self.handle()
+
+    def _update_events(self, fd, edge=None):
+        r"_update_events(fd[, edge]) -> None :: Update the events of fd."
+        events = 0
+        if fd in self._readers:
+            events |= READ
+        if fd in self._writers:
+            events |= WRITE
+        if edge is not None and edge != (fd in self._edge):
+            if edge:
+                self._edge.add(fd)
+            else:
+                self._edge.discard(fd)
+        elif events == self._events.get(fd, 0):
+            return
+        if events:
+            log.debug(u'EventLoop._update_events: fd=%s events=%s', fd, events)
+            self.backend.register(fd, events, fd in self._edge)
+            self._events[fd] = events
+        else:
+            log.debug(u'EventLoop._update_events: fd=%s unregistered', fd)
+            self.backend.unregister(fd)
+            self._edge.discard(fd)
+            del self._events[fd]
+
+    def _pop_edge(self, kwargs):
+        r"_pop_edge(kwargs) -> bool/None :: Get the 'edge' keyword argument."
+        edge = kwargs.pop('edge', None)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments: %s'
+                                % ', '.join(kwargs.keys()))
+        return edge
+
+    def add_reader(self, file, callback, *args, **kwargs):
+        r"""add_reader(file, callback[, *args][, edge]) -> None :: Watch reads.
+
+        Start watching 'file' (a file object or descriptor) for reading.
+        When 'file' is ready for reading (or has an error), callback(*args)
+        is called. If the file was already watched for reading, the old
+        callback is replaced. If edge is True, the file is watched in
+        edge-triggered mode (if the backend supports it).
+        """
+        log.debug(u'EventLoop.add_reader(%r, %r, %r, %r)', file, callback,
+                    args, kwargs)
+        edge = self._pop_edge(kwargs)
+        fd = get_fileno(file)
+        self._readers[fd] = (file, callback, args)
+        self._update_events(fd, edge)
+
+    def remove_reader(self, file):
+        r"""remove_reader(file) -> bool :: Stop watching file reads.
+
+        Returns True if the file was being watched, False otherwise.
+        """
+        log.debug(u'EventLoop.remove_reader(%r)', file)
+        fd = get_fileno(file)
+        if fd not in self._readers:
+            return False
+        del self._readers[fd]
+        self._update_events(fd)
+        return True
+
+    def add_writer(self, file, callback, *args, **kwargs):
+        r"""add_writer(file, callback[, *args][, edge]) -> None :: Watch writes.
+
+        Start watching 'file' (a file object or descriptor) for writing.
+        When 'file' is ready for writing, callback(*args) is called. If the
+        file was already watched for writing, the old callback is replaced.
+        If edge is True, the file is watched in edge-triggered mode (if the
+        backend supports it).
+        """
+        log.debug(u'EventLoop.add_writer(%r, %r, %r, %r)', file, callback,
+                    args, kwargs)
+        edge = self._pop_edge(kwargs)
+        fd = get_fileno(file)
+        self._writers[fd] = (file, callback, args)
+        self._update_events(fd, edge)
+
+    def remove_writer(self, file):
+        r"""remove_writer(file) -> bool :: Stop watching file writes.
+
+        Returns True if the file was being watched, False otherwise.
+        """
+        log.debug(u'EventLoop.remove_writer(%r)', file)
+        fd = get_fileno(file)
+        if fd not in self._writers:
+            return False
+        del self._writers[fd]
+        self._update_events(fd)
+        return True
+
+    def call_later(self, delay, callback, *args):
+        r"""call_later(delay, callback[, *args]) -> Timer :: Schedule a call.
+
+        Call callback(*args) once, after 'delay' seconds (which can be
+        a float). A Timer object is returned, which can be used to cancel
+        the call.
+        """
+        log.debug(u'EventLoop.call_later(%r, %r, %r)', delay, callback, args)
+        return self._add_timer(Timer(monotonic() + delay, None, callback,
+                                        args))
+
+    def call_every(self, interval, callback, *args):
+        r"""call_every(interval, callback[, *args]) -> Timer :: Periodic call.
+
+        Call callback(*args) every 'interval' seconds (which can be a float),
+        starting 'interval' seconds from now. A Timer object is returned,
+        which can be used to cancel the periodic calls.
+
+        If the loop is too busy and some calls are missed, they are skipped
+        (i.e. the callback is never called twice in a row to catch up).
+        """
+        log.debug(u'EventLoop.call_every(%r, %r, %r)', interval, callback,
+                    args)
+        if interval <= 0:
+            raise ValueError('interval must be positive')
+        return self._add_timer(Timer(monotonic() + interval, interval,
+                                        callback, args))
+
+    def _add_timer(self, timer):
+        r"_add_timer(timer) -> Timer :: Push a timer into the timers heap."
+        heapq.heappush(self._timers, (timer.when, self._timers_seq.next(),
+                                        timer))
+        return timer
+
+    def _poll_timeout(self):
+        r"""_poll_timeout() -> int/None :: Milliseconds until the next timer.
+
+        None is returned if there are no timers to wait for.
+        """
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+        if not self._timers:
+            return None
+        timeout = (self._timers[0][0] - monotonic()) * 1000
+        if timeout <= 0:
+            return 0
+        return int(math.ceil(timeout))
+
+    def _run_timers(self):
+        r"_run_timers() -> None :: Call the callbacks of expired timers."
+        now = monotonic()
+        while self._timers and self._timers[0][0] <= now:
+            (when, seq, timer) = heapq.heappop(self._timers)
+            if timer.cancelled:
+                continue
+            if timer.interval is not None:
+                timer.when += timer.interval
+                if timer.when <= now:
+                    timer.when = now + timer.interval
+                self._add_timer(timer)
+            log.debug(u'EventLoop._run_timers: calling %r', timer)
+            timer.callback(*timer.args)
+
+    def _run_callbacks(self, events):
+        r"_run_callbacks(events) -> None :: Call the files callbacks."
+        for (fd, ev) in events:
+            # callbacks can remove readers/writers, so we check each time
+            if ev & (READ | ERROR) and fd in self._readers:
+                (file, callback, args) = self._readers[fd]
+                log.debug(u'EventLoop.loop: fd %s readable (%s)', fd, ev)
+                callback(*args)
+                # errors are reported to the reader only
+                ev &= ~ERROR
+            if ev & (WRITE | ERROR) and fd in self._writers:
+                (file, callback, args) = self._writers[fd]
+                log.debug(u'EventLoop.loop: fd %s writable (%s)', fd, ev)
+                callback(*args)
+
+    def _signal_handler(self, signum, stack_frame):
+        r"""_signal_handler(signum, stack_frame) -> None :: Signal handler.
+
+        Record the signal as pending. The loop was already woken up by the
+        interpreter, writing to the self-pipe (if the loop couldn't set it
+        as the wakeup fd, because it was not created in the main thread,
+        the self-pipe is written here).
+        """
+        self._pending_signals.add(signum)
+        if not self._signal_wakeup_fd:
+            self._wakeup()
+
+    def _wakeup(self):
+        r"""_wakeup() -> None :: Write to the self-pipe to wake the loop up."""
+        try:
+            os.write(self._wakeup_pipe[1], '\0')
+        except OSError, e:
+            # The pipe is full, the loop will wake up anyway
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def _handle_wakeup(self):
+        r"""_handle_wakeup() -> None :: Handle the self-pipe codes.
+
+        Signals are handled first, then calls scheduled by other threads.
+        """
+        while True:
+            try:
+                chunk = os.read(self._wakeup_pipe[0], 512)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            if not chunk:
+                break
+        while self._pending_signals:
+            # it's not pending anymore, new signals will wake us up again
+            signum = self._pending_signals.pop()
+            if signum not in self.signals:
+                continue
+            log.debug(u'EventLoop.loop: processing signal %d...', signum)
+            self.handle_signal(signum)
+        while self._threadsafe_calls:
+            (callback, args) = self._threadsafe_calls.popleft()
+            log.debug(u'EventLoop.loop: calling %r%r', callback, args)
+            callback(*args)
+
+    def _open_wakeup_pipe(self):
+        r"_open_wakeup_pipe() -> None :: Create and register the self-pipe."
+        self._wakeup_pipe = os.pipe()
+        for fd in self._wakeup_pipe:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        self.add_reader(self._wakeup_pipe[0], self._handle_wakeup)
+
+    def _set_wakeup_fd(self):
+        r"_set_wakeup_fd() -> None :: Use the self-pipe for signals."
+        if self._signal_wakeup_fd:
+            return
+        try:
+            signal.set_wakeup_fd(self._wakeup_pipe[1])
+            self._signal_wakeup_fd = True
+        except ValueError:
+            log.debug(u'EventLoop: not in the main thread, signals wake up '
+                        u'the loop from the Python signal handler')
+
+    def _unset_wakeup_fd(self):
+        r"_unset_wakeup_fd() -> None :: Stop using the self-pipe for signals."
+        if not self._signal_wakeup_fd:
+            return
+        self._signal_wakeup_fd = False
+        prev = signal.set_wakeup_fd(-1)
+        if prev != self._wakeup_pipe[1]:
+            # another loop took it over, give it back
+            signal.set_wakeup_fd(prev)
+
+    def call_soon_threadsafe(self, callback, *args):
+        r"""call_soon_threadsafe(callback[, *args]) -> None :: Call from loop.
+
+        Schedule callback(*args) to be called by the loop as soon as
+        possible. This is the only EventLoop method that can be safely
+        called from other threads, and it's the way other threads should
+        hand results back to the loop.
+        """
+        self._threadsafe_calls.append((callback, args))
+        self._wakeup()
 
     def set_signal(self, signum, sighandler):
+        r"""set_signal(signum, sighandler) -> callable :: Handle a signal.
+
+        Handle the signal 'signum' calling sighandler(loop, signum) (or
+        handle_signal() if sighandler is None). The previous handler is
+        returned (or None if the signal was not handled).
+        """
         prev = self.signals.get(signum, None)
         # If the signal was not already handled, handle it
         if signum not in self.signals:
-            signal.signal(signum, signal_handler)
+            self._set_wakeup_fd()
+            signal.signal(signum, self._signal_handler)
+            # Don't interrupt system calls (they are restarted)
+            signal.siginterrupt(signum, False)
         self.signals[signum] = sighandler
         return prev
 
     def get_signal_handler(self, signum):
+        r"get_signal_handler(signum) -> callable :: Get a signal handler."
         return self.signals[signum]
 
     def unset_signal(self, signum):
-        prev = self.signals[signum]
+        r"""unset_signal(signum) -> callable :: Stop handling a signal.
+
+        The default signal handler is restored and the previous handler is
+        returned.
+        """
+        prev = self.signals.pop(signum)
         # Restore the default handler
         signal.signal(signum, signal.SIG_DFL)
+        self._pending_signals.discard(signum)
+        if not self.signals:
+            self._unset_wakeup_fd()
         return prev
 
     def set_file(self, file):
         r"""set_file(file) -> None :: New file object to be monitored
 
-        Unregister the previous file object being monitored and register
+        Unregister the previous main file object being monitored and register
         a new one.
         """
-        self.poll.unregister(self.fileno)
+        if self._file is not None:
+            self.remove_reader(self._file)
         self.__register(file)
 
     def get_file(self):
@@ -146,9 +780,7 @@ class EventLoop:
 
     def get_fileno(self):
         r"get_fileno() -> int :: Get the current file descriptor"
-        if hasattr(self.file, 'fileno'):
-            return self.file.fileno()
-        return self.file
+        return get_fileno(self.file)
 
     fileno = property(get_fileno, doc='File descriptor (never a file object)')
 
@@ -168,34 +800,75 @@ class EventLoop:
         then only 1 event is processed and then this method returns.
         """
         log.debug(u'EventLoop.loop(%s)', once)
-        # List of pending signals
-        global signals
         while True:
+            events = ()
             try:
-                log.debug(u'EventLoop.loop: polling')
-                res = self.poll.poll()
-            except select.error, e:
+                timeout = self._poll_timeout()
+                log.debug(u'EventLoop.loop: polling (timeout=%s)', timeout)
+                events = self.backend.poll(timeout)
+            except (select.error, IOError), e:
                 # The error is not an interrupt caused by a signal, then raise
-                if e.args[0] != errno.EINTR or not signals:
+                # (signals are delivered through the self-pipe, so we don't
+                # have to do anything special about them here)
+                if e.args[0] != errno.EINTR:
                     raise LoopInterruptedError(e)
-            # If we have signals to process, we just do it
-            have_signals = bool(signals)
-            while signals:
-                signum = signals.pop(0)
-                log.debug(u'EventLoop.loop: processing signal %d...', signum)
-                self.handle_signal(signum)
-            # No signals to process, execute the regular handler
-            if not have_signals:
-                log.debug(u'EventLoop.loop: processing event...')
-                self.handle()
+            # Process files events (signals included)
+            if events:
+                log.debug(u'EventLoop.loop: processing events...')
+                self._run_callbacks(events)
+            # Process expired timers
+            self._run_timers()
             # Look if we have to stop
             if self._stop or once:
                 log.debug(u'EventLoop.loop: stopped')
                 self._stop = False
                 break
 
+    def close(self):
+        r"""close() -> None :: Release the event loop resources.
+
+        The event loop can't be used after it's closed.
+        """
+        log.debug(u'EventLoop.close()')
+        for signum in self.signals.keys():
+            self.unset_signal(signum)
+        self._unset_wakeup_fd()
+        if self._wakeup_pipe is not None:
+            self.remove_reader(self._wakeup_pipe[0])
+            for fd in self._wakeup_pipe:
+                os.close(fd)
+            self._wakeup_pipe = None
+        self.backend.close()
+
+    def close_after_fork(self):
+        r"""close_after_fork() -> None :: Release the loop resources in a child.
+
+        After a fork(), the child process shares the polling backend and the
+        self-pipe with its parent, so close() can't be used in the child (it
+        would modify the parent's event loop). This method releases only the
+        child's copies of the loop resources and restores the default signal
+        handlers. The event loop can't be used after it's closed.
+        """
+        log.debug(u'EventLoop.close_after_fork()')
+        for signum in self.signals.keys():
+            signal.signal(signum, signal.SIG_DFL)
+        self.signals.clear()
+        self._pending_signals.clear()
+        self._threadsafe_calls.clear()
+        self._unset_wakeup_fd()
+        if self._wakeup_pipe is not None:
+            for fd in self._wakeup_pipe:
+                os.close(fd)
+            self._wakeup_pipe = None
+        self._readers.clear()
+        self._writers.clear()
+        self._events.clear()
+        self._edge.clear()
+        self._timers = list()
+        self.backend.close()
+
     def handle(self):
-        r"handle() -> None :: Handle file descriptor events."
+        r"handle() -> None :: Handle main file descriptor events."
         self.handler(self)
 
     def handle_signal(self, signum):
@@ -217,16 +890,76 @@ if __name__ == '__main__':
         data = os.read(event_loop.fileno, 100)
         os.write(1, 'Received message: %r\n' % data)
 
+    # Regular files can't be watched by epoll
+    import tempfile
+    f = tempfile.TemporaryFile()
+    f.write('file data')
+    f.seek(0)
+    data = list()
+    p = EventLoop(f, lambda l: data.append(os.read(l.fileno, 100)))
+    p.loop(once=True)
+    assert data == ['file data'], data
+    (r, w) = os.pipe()
+    os.write(w, 'x')
+    p.add_reader(r, lambda: data.append(os.read(r, 100)))
+    p.loop(once=True)
+    assert sorted(data) == ['', 'file data', 'x'], data
+    p.remove_reader(r)
+    p.remove_reader(f)
+    os.close(r)
+    os.close(w)
+    f.close()
+
     p = EventLoop(0, handle)
 
     os.write(1, 'Say something once:\n')
     p.loop(once=True)
     os.write(1, 'Great!\n')
 
+    # Timers and multiple files
+    (r, w) = os.pipe()
+    ticks = list()
+    def tick(n):
+        ticks.append(n)
+        os.write(w, 'tick %d' % n)
+    def echo(fd, name):
+        os.write(1, '%s: %r\n' % (name, os.read(fd, 100)))
+    p = EventLoop()
+    p.add_reader(r, echo, r, 'pipe')
+    t = p.call_every(0.1, tick, 1)
+    p.call_later(0.05, tick, 0)
+    p.call_later(0.35, t.cancel)
+    p.call_later(0.5, p.stop)
+    p.loop()
+    assert ticks == [0, 1, 1, 1], ticks
+    assert p.remove_reader(r)
+    assert not p.remove_reader(r)
+    os.close(r)
+    os.close(w)
+
+    # Signals wake the loop up, coalesced
+    got = list()
+    def on_signal(loop, signum):
+        got.append(signum)
+        loop.stop()
+    p = EventLoop(signals={signal.SIGUSR2: on_signal})
+    def kill():
+        os.kill(os.getpid(), signal.SIGUSR2)
+        os.kill(os.getpid(), signal.SIGUSR2)
+    p.call_later(0, kill)
+    p.call_later(5, p.stop)
+    start = monotonic()
+    p.loop()
+    assert got == [signal.SIGUSR2], got
+    assert monotonic() - start < 1, monotonic() - start
+    p.close()
+
     class Test(EventLoop):
         def handle(self):
             data = os.read(self.fileno, 100)
             os.write(1, 'Received message: %r\n' % data)
+            if not data:
+                self.stop()
         def handle_signal(self, signum):
             os.write(1, 'Signal %d received, stopping\n' % signum)
             self.stop()
@@ -0,0 +1,401 @@
+# vim: set encoding=utf-8 et sw=4 sts=4 :
+
+r"""
+Run blocking calls outside the event loop.
+
+This module provides a Future class, representing the result of an
+asynchronous operation, an Executor class, that runs callables in a pool of
+worker threads and hands their results back to an EventLoop, and a coroutine
+decorator, to write asynchronous operations as generators that yield
+futures.
+
+Please see Future and Executor classes and coroutine() documentation for
+more info.
+"""
+
+import sys
+import Queue
+import threading
+import logging ; log = logging.getLogger('pymin.executor')
+
+__all__ = ('Future', 'FutureNotDoneError', 'Executor', 'Return',
+           'coroutine', 'chain')
+
+class FutureNotDoneError(RuntimeError):
+    r"""FutureNotDoneError() -> FutureNotDoneError instance.
+
+    This exception is raised when trying to get the result of a Future that
+    is not done yet.
+    """
+    pass
+
+class Future:
+    r"""Future() -> Future instance :: Result of an asynchronous operation.
+
+    A Future is a placeholder for a result that is not available yet. When
+    the operation finishes, set_result() or set_exception() should be called,
+    and all the callbacks registered with add_done_callback() are called
+    with the future as the only argument.
+
+    Callbacks can be added from any thread, but they are called by the thread
+    that completes the future, so futures should be completed only from the
+    event loop thread (see Executor for a way to complete futures from other
+    threads).
+
+    Example:
+
+    >>> f = Future()
+    >>> def done(f):
+    >>>     print 'Result:', f.result()
+    >>> f.add_done_callback(done)
+    >>> f.set_result(42) # prints "Result: 42"
+    """
+
+    def __init__(self):
+        r"""Initialize the Future object.
+
+        See Future class documentation for more info.
+        """
+        self._done = False
+        self._result = None
+        self._exc_info = None
+        self._callbacks = list()
+        self._lock = threading.Lock()
+
+    def done(self):
+        r"done() -> bool :: Tell if the operation finished."
+        return self._done
+
+    def result(self):
+        r"""result() -> object :: Get the result of the operation.
+
+        If the operation raised an exception, the exception is re-raised
+        (with its original traceback). If the operation is not done yet,
+        a FutureNotDoneError is raised.
+        """
+        if not self._done:
+            raise FutureNotDoneError()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self):
+        r"""exception() -> exception/None :: Get the operation exception.
+
+        None is returned if the operation finished successfully. If the
+        operation is not done yet, a FutureNotDoneError is raised.
+        """
+        if not self._done:
+            raise FutureNotDoneError()
+        if self._exc_info is None:
+            return None
+        return self._exc_info[1]
+
+    def set_result(self, result):
+        r"set_result(result) -> None :: Mark the future as done with result."
+        assert not self._done, 'Future already done'
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception, exc_info=None):
+        r"""set_exception(exception[, exc_info]) -> None :: Mark as failed.
+
+        exc_info is a (type, value, traceback) tuple as returned by
+        sys.exc_info(), used to preserve the original traceback.
+        """
+        assert not self._done, 'Future already done'
+        if exc_info is None:
+            exc_info = (exception.__class__, exception, None)
+        self._exc_info = exc_info
+        self._finish()
+
+    def add_done_callback(self, callback):
+        r"""add_done_callback(callback) -> None :: Call callback when done.
+
+        callback(future) is called when the future is done. If the future is
+        already done, the callback is called immediately.
+        """
+        self._lock.acquire()
+        try:
+            done = self._done
+            if not done:
+                self._callbacks.append(callback)
+        finally:
+            self._lock.release()
+        if done:
+            callback(self)
+
+    def _finish(self):
+        r"_finish() -> None :: Mark the future as done and call callbacks."
+        self._lock.acquire()
+        try:
+            self._done = True
+            callbacks = self._callbacks
+            self._callbacks = list()
+        finally:
+            self._lock.release()
+        for callback in callbacks:
+            callback(self)
+
+    def __repr__(self):
+        r"repr(obj) -> Object representation."
+        if not self._done:
+            return 'Future(pending)'
+        if self._exc_info is not None:
+            return 'Future(exception=%r)' % (self._exc_info[1],)
+        return 'Future(result=%r)' % (self._result,)
+
+class Executor:
+    r"""Executor(loop[, workers]) -> Executor instance.
+
+    Run callables in a pool of 'workers' threads. The results are handed back
+    to the EventLoop 'loop' (using call_soon_threadsafe()), so the futures
+    returned by submit() are always completed (and their callbacks called)
+    in the event loop thread.
+
+    Callables are started in the same order they are submitted. If there is
+    only one worker (the default), they are run one at a time, so they are
+    serialized, which is what you want if they modify shared state.
+
+    Example:
+
+    >>> e = Executor(loop)
+    >>> f = e.submit(subprocess.call, ('sleep', '5'))
+    >>> f.add_done_callback(lambda f: loop.stop())
+    >>> loop.loop()
+    """
+
+    def __init__(self, loop, workers=1):
+        r"""Initialize the Executor object.
+
+        See Executor class documentation for more info.
+        """
+        log.debug(u'Executor(%r, %r)', loop, workers)
+        self.loop = loop
+        self._queue = Queue.Queue()
+        self._threads = list()
+        for i in range(workers):
+            t = threading.Thread(target=self._worker,
+                                 name='pymin-executor-%d' % i)
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, func, *args, **kwargs):
+        r"""submit(func[, *args[, **kwargs]]) -> Future :: Run func in a worker.
+
+        func(*args, **kwargs) is called in a worker thread. A Future is
+        returned, which will hold the result (or the raised exception).
+        """
+        log.debug(u'Executor.submit(%r, %r, %r)', func, args, kwargs)
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def _worker(self):
+        r"_worker() -> None :: Worker threads main function."
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            (future, func, args, kwargs) = job
+            try:
+                result = func(*args, **kwargs)
+            except:
+                exc_info = sys.exc_info()
+                self.loop.call_soon_threadsafe(future.set_exception,
+                                               exc_info[1], exc_info)
+                del exc_info
+            else:
+                self.loop.call_soon_threadsafe(future.set_result, result)
+
+    def shutdown(self, wait=True):
+        r"""shutdown([wait]) -> None :: Stop the worker threads.
+
+        Already submitted callables are run before the workers stop. If wait
+        is True, wait for the workers to finish.
+        """
+        log.debug(u'Executor.shutdown(%r)', wait)
+        for t in self._threads:
+            self._queue.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
+        self._threads = list()
+
+class Return(Exception):
+    r"""Return([value]) -> Return instance :: Finish a coroutine.
+
+    Generators can't return values, so coroutines (see coroutine()) raise
+    this exception to finish with value as the result.
+    """
+
+    def __init__(self, value=None):
+        r"Initialize the object, see class documentation for more info."
+        Exception.__init__(self, value)
+        self.value = value
+
+def coroutine(func):
+    r"""coroutine(func) -> function wrapper :: Make a generator asynchronous.
+
+    This is a decorator to write asynchronous operations as generators. The
+    generator yields futures (for example the ones returned by
+    Executor.submit()) and it's resumed when they are done, getting their
+    results as the value of the yield expression (or their exceptions raised
+    by it). The generator finishes by raising Return(value) or returning.
+
+    The wrapper returns a Future, which holds the result of the generator
+    (or the exception it raised). The generator runs until the first yield
+    when the wrapper is called, and then each time a yielded future is done
+    (in the thread that completes it, usually the event loop thread).
+
+    Example:
+
+    >>> @coroutine
+    >>> def add_slowly(executor, a, b):
+    >>>     a = yield executor.submit(slow_identity, a)
+    >>>     b = yield executor.submit(slow_identity, b)
+    >>>     raise Return(a + b)
+    >>> f = add_slowly(executor, 1, 2)
+    """
+    def wrapper(*args, **kwargs):
+        future = Future()
+        _resume(func(*args, **kwargs), future, None)
+        return future
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    wrapper.__dict__.update(func.__dict__)
+    # The original function, to get its signature
+    wrapper.coroutine_function = func
+    return wrapper
+
+def _resume(gen, future, done):
+    r"""_resume(gen, future, done) -> None :: Run a coroutine generator.
+
+    The generator gen is resumed with the outcome of the done future (or
+    started if done is None) and run until it yields a future that is not
+    done yet or it finishes, completing future with its result.
+    """
+    while True:
+        try:
+            if done is None:
+                yielded = gen.next()
+            elif done._exc_info is not None:
+                yielded = gen.throw(*done._exc_info)
+            else:
+                yielded = gen.send(done._result)
+        except StopIteration:
+            future.set_result(None)
+            return
+        except Return, r:
+            future.set_result(r.value)
+            return
+        except:
+            exc_info = sys.exc_info()
+            future.set_exception(exc_info[1], exc_info)
+            del exc_info
+            return
+        if not isinstance(yielded, Future):
+            done = Future()
+            done.set_exception(TypeError('coroutine %r yielded %r, not a '
+                                         'Future' % (gen, yielded)))
+        elif yielded.done():
+            done = yielded
+        else:
+            yielded.add_done_callback(lambda f: _resume(gen, future, f))
+            return
+
+def chain(future, func):
+    r"""chain(future, func) -> Future :: Process the result of a future.
+
+    func(future) is called when future is done, and the returned Future holds
+    the value returned by func (or the exception it raised). If func returns
+    a Future, the returned Future holds its result instead.
+    """
+    result = Future()
+    def copy(f):
+        if f._exc_info is not None:
+            result.set_exception(f._exc_info[1], f._exc_info)
+        else:
+            result.set_result(f._result)
+    def done(f):
+        try:
+            value = func(f)
+        except:
+            exc_info = sys.exc_info()
+            result.set_exception(exc_info[1], exc_info)
+            del exc_info
+            return
+        if isinstance(value, Future):
+            value.add_done_callback(copy)
+        else:
+            result.set_result(value)
+    future.add_done_callback(done)
+    return result
+
+
+if __name__ == '__main__':
+
+    import time
+    from pymin.eventloop import EventLoop
+
+    results = list()
+
+    f = Future()
+    f.add_done_callback(lambda f: results.append(f.result()))
+    f.set_result(1)
+    assert results == [1], results
+    f.add_done_callback(lambda f: results.append(f.result() + 1))
+    assert results == [1, 2], results
+
+    loop = EventLoop()
+    e = Executor(loop)
+    def slow(n):
+        time.sleep(0.1)
+        return n
+    def fail():
+        raise ValueError('failed')
+    f1 = e.submit(slow, 10)
+    f2 = e.submit(fail)
+    f1.add_done_callback(lambda f: results.append(f.result()))
+    f2.add_done_callback(lambda f: results.append(f.exception()))
+    f2.add_done_callback(lambda f: loop.stop())
+    loop.loop()
+    assert results[2] == 10, results
+    assert isinstance(results[3], ValueError), results
+    try:
+        f2.result()
+        assert False, 'It should raised a ValueError'
+    except ValueError, e2:
+        print 'Exception:', e2
+    # Coroutines
+    @coroutine
+    def add_slowly(a, b):
+        a = yield e.submit(slow, a)
+        try:
+            yield e.submit(fail)
+        except ValueError:
+            pass
+        b = yield e.submit(slow, b)
+        raise Return(a + b)
+    @coroutine
+    def twice(n):
+        r = yield add_slowly(n, n)
+        s = yield chain(add_slowly(r, r), lambda f: f.result() * 10)
+        raise Return(s)
+    @coroutine
+    def bad():
+        yield 1
+    f3 = twice(1)
+    assert not f3.done()
+    f3.add_done_callback(lambda f: loop.stop())
+    loop.loop()
+    assert f3.result() == 40, f3
+    f4 = bad()
+    assert isinstance(f4.exception(), TypeError), f4
+    f5 = coroutine(lambda: iter(()))()
+    assert f5.done() and f5.result() is None, f5
+    e.shutdown()
+    loop.close()
+    print 'Results:', results
+
@@ -14,12 +14,59 @@ class Item(ValidatedClass, Sequence):
 
     Please see pymin.seqtools and pymin.validatedclass modules help for
     more details.
+
+    The tuple representing the object is cached, and the cache is
+    invalidated each time a validated field is set (including updates).
     """
 
+    def __setattr__(self, name, value):
+        r"Set an attribute, invalidating the cached tuple if it's a field."
+        if name in self.validated_fields:
+            self.__dict__.pop('_as_tuple', None)
+        ValidatedClass.__setattr__(self, name, value)
+
+    def __getstate__(self):
+        r"__getstate__() -> dict :: Get the state to pickle (without caches)."
+        state = self.__dict__.copy()
+        state.pop('_as_tuple', None)
+        return state
+
     def as_tuple(self):
         r"""as_tuple() -> tuple - Return tuple representing the object.
 
         The tuple returned preserves the validated fields declaration order.
         """
-        return tuple([getattr(self, n) for n in self.validated_fields])
+        t = self.__dict__.get('_as_tuple')
+        if t is None:
+            t = tuple([getattr(self, n) for n in self.validated_fields])
+            self.__dict__['_as_tuple'] = t
+        return t
+
+
+if __name__ == '__main__':
+
+    import pickle
+    from formencode.validators import Int, UnicodeString
+    from pymin.validatedclass import Field
+
+    class Host(Item):
+        name = Field(UnicodeString(not_empty=True))
+        port = Field(Int(if_missing=None))
+
+    h = Host(u'pc', 80)
+    t = h.as_tuple()
+    assert t == (u'pc', 80), t
+    assert h.as_tuple() is t
+    assert list(h) == [u'pc', 80] and h[1] == 80 and len(h) == 2
+    h.update(port=8080)
+    assert h.as_tuple() == (u'pc', 8080), h.as_tuple()
+    h.name = u'server'
+    assert h.as_tuple() == (u'server', 8080), h.as_tuple()
+    h._delete = True # not a field, the cache is kept
+    assert h.as_tuple() == (u'server', 8080), h.as_tuple()
+    assert '_as_tuple' in h.__dict__
+    h2 = pickle.loads(pickle.dumps(h, 2))
+    assert '_as_tuple' not in h2.__dict__, h2.__dict__
+    assert h2.as_tuple() == (u'server', 8080) and h2._delete
+    print h2.as_tuple()
 
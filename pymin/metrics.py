@@ -0,0 +1,378 @@
+# vim: set encoding=utf-8 et sw=4 sts=4 :
+
+r"""
+Requests metrics.
+
+This module provides a Metrics class to keep per command counters and
+latency histograms, split in the phases each request goes through (parsing,
+routing, executing, serializing, sending). It can export the metrics in the
+Prometheus text format, and a PrometheusServer class is provided to serve
+them using a local (UNIX) socket.
+
+Please see Metrics, Sample, Histogram and PrometheusServer classes
+documentation for more info.
+"""
+
+import bisect
+import socket
+import logging ; log = logging.getLogger('pymin.metrics')
+
+from pymin.eventloop import monotonic
+from pymin import transport
+
+__all__ = ('Metrics', 'Sample', 'Histogram', 'PrometheusServer')
+
+class Histogram:
+    r"""Histogram([buckets]) -> Histogram instance :: Latency histogram.
+
+    Count observed values (in seconds) in buckets, where each bucket is
+    defined by its upper bound (values must be sorted). Values bigger than
+    the last bucket upper bound are counted in an extra (infinite) bucket.
+    The sum and maximum of all observed values are kept too.
+    """
+
+    # Default buckets upper bounds, from 50us to 10s
+    buckets = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+               0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=None):
+        r"""Initialize the Histogram object.
+
+        See Histogram class documentation for more info.
+        """
+        if buckets is not None:
+            self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        r"observe(value) -> None :: Count a new value."
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        r"""quantile(q) -> float :: Estimate the q quantile (0 <= q <= 1).
+
+        The value is interpolated linearly inside the bucket where the
+        quantile falls (and can't be bigger than the maximum observed
+        value).
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for (i, n) in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = 0.0
+                if i > 0:
+                    lower = self.buckets[i-1]
+                if i == len(self.buckets):
+                    return self.max
+                upper = self.buckets[i]
+                return min(lower + (upper - lower) * (rank - seen) / n,
+                           self.max)
+            seen += n
+        return self.max
+
+    def mean(self):
+        r"mean() -> float :: Get the mean of the observed values."
+        if not self.count:
+            return 0.0
+        return self.sum / self.count
+
+    def merge(self, other):
+        r"""merge(other) -> None :: Add the values observed by other.
+
+        other is a Histogram with the same buckets.
+        """
+        if other.buckets != self.buckets:
+            raise ValueError('Histograms buckets differ')
+        for (i, n) in enumerate(other.counts):
+            self.counts[i] += n
+        self.count += other.count
+        self.sum += other.sum
+        if other.max > self.max:
+            self.max = other.max
+
+class Sample:
+    r"""Sample(metrics) -> Sample instance :: Timings of a single request.
+
+    A Sample measures the time spent by a request in each phase. Each time
+    a phase is finished, lap(phase) should be called, which takes note of the
+    time elapsed since the previous lap (or since the sample was created).
+    When the request is finished, done(path, error) records the timings in
+    the Metrics object.
+
+    Samples can be used from any thread, but done() should be called from
+    the same thread that uses the Metrics object.
+    """
+
+    def __init__(self, metrics):
+        r"""Initialize the Sample object.
+
+        See Sample class documentation for more info.
+        """
+        self.metrics = metrics
+        self.start = self.last = monotonic()
+        self.laps = list()
+
+    def lap(self, phase):
+        r"lap(phase) -> None :: Finish a phase."
+        now = monotonic()
+        self.laps.append((phase, now - self.last))
+        self.last = now
+
+    def done(self, path, error=False):
+        r"""done(path[, error]) -> None :: Record the request timings.
+
+        path is the command path (the space separated command names) and
+        error tells if the request failed. The total time of the request is
+        recorded as the 'total' phase.
+        """
+        self.metrics.record(path, self.laps, monotonic() - self.start, error)
+
+class Metrics:
+    r"""Metrics() -> Metrics instance :: Requests metrics.
+
+    Keep a count of requests and errors and a latency Histogram per phase
+    for each command path. Use sample() to measure a request.
+    """
+
+    # Phases, in the order they happen
+    phases = ('parse', 'route', 'queue', 'execute', 'serialize', 'send',
+              'total')
+
+    def __init__(self):
+        r"""Initialize the Metrics object.
+
+        See Metrics class documentation for more info.
+        """
+        # path -> [requests, errors]
+        self.counters = dict()
+        # (path, phase) -> Histogram
+        self.histograms = dict()
+
+    def sample(self):
+        r"sample() -> Sample :: Start measuring a request."
+        return Sample(self)
+
+    def record(self, path, laps, total, error=False):
+        r"""record(path, laps, total[, error]) -> None :: Record a request.
+
+        laps is a list of (phase, seconds) and total is the total time the
+        request took.
+        """
+        counters = self.counters.get(path)
+        if counters is None:
+            counters = self.counters[path] = [0, 0]
+        counters[0] += 1
+        if error:
+            counters[1] += 1
+        for (phase, seconds) in laps:
+            self.observe(path, phase, seconds)
+        self.observe(path, 'total', total)
+
+    def observe(self, path, phase, seconds):
+        r"observe(path, phase, seconds) -> None :: Record a phase duration."
+        histogram = self.histograms.get((path, phase))
+        if histogram is None:
+            histogram = self.histograms[(path, phase)] = Histogram()
+        histogram.observe(seconds)
+
+    def merge(self, other):
+        r"""merge(other) -> None :: Add the requests recorded by other.
+
+        other is a Metrics object (for example, the one of another process
+        serving requests for the same daemon).
+        """
+        for (path, (requests, errors)) in other.counters.items():
+            counters = self.counters.get(path)
+            if counters is None:
+                counters = self.counters[path] = [0, 0]
+            counters[0] += requests
+            counters[1] += errors
+        for (key, h) in other.histograms.items():
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(h.buckets)
+            histogram.merge(h)
+
+    def rows(self, phase='total'):
+        r"""rows([phase]) -> list :: Get a table with the metrics of a phase.
+
+        Each row has the command path, the number of requests and errors, and
+        the mean, 50 and 99 percentiles and maximum time (in milliseconds)
+        spent in the phase.
+        """
+        rows = list()
+        for path in sorted(self.counters.keys()):
+            h = self.histograms.get((path, phase))
+            if h is None:
+                continue
+            (requests, errors) = self.counters[path]
+            rows.append((path, requests, errors) + tuple(['%.3f' % (v * 1000)
+                        for v in (h.mean(), h.quantile(0.5), h.quantile(0.99),
+                                  h.max)]))
+        return rows
+
+    def prometheus(self):
+        r"prometheus() -> str :: Get the metrics in Prometheus text format."
+        lines = list()
+        for (name, index, help) in (
+                ('pymin_requests_total', 0, 'Requests received.'),
+                ('pymin_errors_total', 1, 'Requests that failed.')):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s counter' % name)
+            for path in sorted(self.counters.keys()):
+                lines.append('%s{command="%s"} %d' % (name, _label(path),
+                                self.counters[path][index]))
+        name = 'pymin_request_duration_seconds'
+        lines.append('# HELP %s Time spent by requests in each phase.' % name)
+        lines.append('# TYPE %s histogram' % name)
+        for (path, phase) in sorted(self.histograms.keys()):
+            h = self.histograms[(path, phase)]
+            labels = 'command="%s",phase="%s"' % (_label(path), phase)
+            accum = 0
+            for (bound, n) in zip(h.buckets + ('+Inf',), h.counts):
+                accum += n
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels,
+                                bound, accum))
+            lines.append('%s_sum{%s} %r' % (name, labels, h.sum))
+            lines.append('%s_count{%s} %d' % (name, labels, h.count))
+        return '\n'.join(lines) + '\n'
+
+def _label(value):
+    r"_label(value) -> str :: Escape a Prometheus label value."
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+                .replace('\n', '\\n')
+
+class PrometheusServer:
+    r"""PrometheusServer(loop, path, metrics) -> PrometheusServer instance.
+
+    Listen for connections in the UNIX socket 'path' using the EventLoop
+    'loop'. Each time a client connects, the metrics (in Prometheus text
+    format) are written and the connection is closed, so the metrics can be
+    read using something like 'socat - UNIX-CONNECT:path'.
+    """
+
+    def __init__(self, loop, path, metrics):
+        r"""Initialize the PrometheusServer object.
+
+        See PrometheusServer class documentation for more info.
+        """
+        log.debug(u'PrometheusServer(%r, %r, %r)', loop, path, metrics)
+        self.loop = loop
+        self.path = path
+        self.metrics = metrics
+        self.sock = transport.unix_listener(path)
+        self.sock.setblocking(False)
+        # sock -> data not written yet
+        self.connections = dict()
+        loop.add_reader(self.sock, self._handle_accept)
+
+    def _handle_accept(self):
+        r"_handle_accept() -> None :: Accept a connection and dump the metrics."
+        try:
+            (sock, addr) = self.sock.accept()
+        except socket.error, e:
+            if e.args[0] not in transport._retry_errors:
+                log.warning(u"PrometheusServer: can't accept connection: %s",
+                                e)
+            return
+        sock.setblocking(False)
+        self.connections[sock] = self.metrics.prometheus()
+        self._handle_write(sock)
+
+    def _handle_write(self, sock):
+        r"_handle_write(sock) -> None :: Write the metrics to a client."
+        data = self.connections[sock]
+        try:
+            sent = sock.send(data)
+        except socket.error, e:
+            if e.args[0] in transport._retry_errors:
+                self.loop.add_writer(sock, self._handle_write, sock)
+                return
+            sent = len(data)
+        self.connections[sock] = data = data[sent:]
+        if not data:
+            self.loop.remove_writer(sock)
+            sock.close()
+            del self.connections[sock]
+        else:
+            self.loop.add_writer(sock, self._handle_write, sock)
+
+    def close(self):
+        r"close() -> None :: Stop listening and close all the connections."
+        log.debug(u'PrometheusServer.close()')
+        self.loop.remove_reader(self.sock)
+        self.sock.close()
+        transport.remove_socket_file(self.path)
+        for sock in self.connections.keys():
+            self.loop.remove_writer(sock)
+            sock.close()
+        self.connections.clear()
+
+    def close_after_fork(self):
+        r"""close_after_fork() -> None :: Close the sockets in a child process.
+
+        Only the child's copies of the sockets are closed, the event loop is
+        not used and the UNIX socket file is not removed.
+        """
+        self.sock.close()
+        for sock in self.connections.keys():
+            sock.close()
+        self.connections.clear()
+
+
+if __name__ == '__main__':
+
+    h = Histogram()
+    for i in range(100):
+        h.observe(0.001 * (i + 1))
+    assert h.count == 100, h.count
+    assert abs(h.mean() - 0.0505) < 1e-9, h.mean()
+    assert h.max == 0.1, h.max
+    p50 = h.quantile(0.5)
+    assert 0.025 <= p50 <= 0.05, p50
+    assert h.quantile(1) == 0.1, h.quantile(1)
+    print 'p50:', p50, 'p99:', h.quantile(0.99)
+
+    m = Metrics()
+    s = m.sample()
+    s.lap('parse')
+    s.lap('execute')
+    s.done(u'dhcp host show')
+    s = m.sample()
+    s.done(u'dhcp host show', error=True)
+    s = m.sample()
+    s.done(u'echo "x"')
+    assert m.counters == {u'dhcp host show': [2, 1], u'echo "x"': [1, 0]}, \
+                m.counters
+    rows = m.rows()
+    assert [r[:3] for r in rows] == [(u'dhcp host show', 2, 1),
+                                     (u'echo "x"', 1, 0)], rows
+    assert [r[:3] for r in m.rows('parse')] == [(u'dhcp host show', 2, 1)]
+    text = m.prometheus()
+    assert 'pymin_requests_total{command="dhcp host show"} 2\n' in text, text
+    assert 'pymin_errors_total{command="echo \\"x\\""} 0\n' in text, text
+    assert ('pymin_request_duration_seconds_bucket{command="dhcp host show",'
+            'phase="total",le="+Inf"} 2\n') in text, text
+    print text
+
+    # merge
+    m2 = Metrics()
+    m2.sample().done(u'echo "x"', error=True)
+    m2.sample().done(u'ip show')
+    m.merge(m2)
+    assert m.counters == {u'dhcp host show': [2, 1], u'echo "x"': [2, 1],
+                          u'ip show': [1, 0]}, m.counters
+    assert m.histograms[(u'echo "x"', 'total')].count == 2
+    assert m.histograms[(u'ip show', 'total')].count == 1
+
@@ -0,0 +1,1091 @@
+# vim: set encoding=utf-8 et sw=4 sts=4 :
+
+r"""
+Persistent data stores.
+
+This module provides stores to keep the persistent data of the handlers
+(see pymin.service.util.Persistent). A store saves and restores named
+objects.
+
+The PickleStore class keeps each object in a pickle file, and the LogStore
+class also appends the changes made to the objects to a log file, so small
+changes of big objects are dumped quickly. The SqliteStore class keeps the
+objects in a SQLite database, storing dictionaries one row per item, so big
+dictionaries are loaded lazily (see LazyDict) and only the changed items are
+written. Please see their documentation for more info.
+"""
+
+import os
+import errno
+import hashlib
+import threading
+from cStringIO import StringIO
+from os import path
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+import logging ; log = logging.getLogger('pymin.persistence')
+
+__all__ = ('PickleStore', 'LogStore', 'SqliteStore', 'LazyDict')
+
+class PickleStore:
+    r"""PickleStore(dir[, ext[, fsync]]) -> PickleStore instance.
+
+    Keep each object in a separate pickle file, named after the object (plus
+    the extension ext, '.pkl' by default) in the directory dir.
+
+    Files are never modified in place: a new file is written (with the extra
+    extension tmp_ext) and then renamed over the old one, so a crash while
+    writing leaves the old file intact. If fsync is True (the default), the
+    new files are flushed to disk (all at once) before renaming them, and
+    the directory is flushed after renaming them, so the new data is on disk
+    when dump() returns.
+
+    The store remembers a digest of the pickle of each object it loads or
+    dumps, so objects that didn't change since then are not written again
+    (unless the changes are known, see dump()).
+    """
+
+    # Extension of the files being written
+    tmp_ext = '.tmp'
+
+    # First and last bytes of the pickles (protocol 2 and STOP opcodes)
+    _pickle_head = '\x80\x02'
+    _pickle_tail = '.'
+
+    def __init__(self, dir, ext='.pkl', fsync=True):
+        r"""Initialize the PickleStore object.
+
+        See PickleStore class documentation for more info.
+        """
+        log.debug(u'PickleStore(%r, %r, %r)', dir, ext, fsync)
+        self.dir = dir
+        self.ext = ext
+        self.fsync = fsync
+        # name -> digest of the pickle in the file
+        self._digests = dict()
+
+    def filename(self, name):
+        r"filename(name) -> str :: Get the name of the file of an object."
+        return path.join(self.dir, name) + self.ext
+
+    def exists(self, name):
+        r"exists(name) -> bool :: Tell if an object was dumped."
+        return path.exists(self.filename(name))
+
+    def verify(self, name):
+        r"""verify(name) -> None :: Check that an object can be loaded.
+
+        Only a cheap check is done (the file should start and end like a
+        complete pickle). An IOError is raised if the object was never
+        dumped or its file is damaged.
+        """
+        fname = self.filename(name)
+        f = file(fname, 'rb')
+        try:
+            head = f.read(len(self._pickle_head))
+            f.seek(0, 2)
+            if f.tell() > len(head):
+                f.seek(-len(self._pickle_tail), 2)
+            tail = f.read()
+        finally:
+            f.close()
+        if head != self._pickle_head or tail != self._pickle_tail:
+            raise IOError(errno.EIO, 'Damaged pickle', fname)
+
+    def load(self, name):
+        r"""load(name) -> object :: Load an object.
+
+        An IOError is raised if the object was never dumped or its file is
+        damaged.
+        """
+        fname = self.filename(name)
+        f = file(fname, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        try:
+            value = pickle.loads(data)
+        except (EOFError, pickle.UnpicklingError), e:
+            raise IOError(errno.EIO, 'Damaged pickle (%r)' % e, fname)
+        log.debug(u'PickleStore.load(%r) -> file=%r, value=%r', name, fname,
+                    value)
+        self._digests[name] = hashlib.sha1(data).digest()
+        return value
+
+    def dump(self, values, changes=None):
+        r"""dump(values[, changes]) -> list :: Dump objects.
+
+        values is a sequence of (name, object) pairs. Only the objects that
+        changed since they were loaded or dumped are written. If changes
+        is given (a dictionary that maps the name of each changed object to
+        the set of keys of its changed items, None in the set meaning the
+        whole object changed), the objects are known to be changed, and
+        they are written without checking it. The names of the written
+        objects are returned.
+        """
+        return self._write([(name, pickle.dumps(value, 2))
+                            for (name, value) in values], changes is None)
+
+    def _write(self, pickles, check=True):
+        r"""_write(pickles[, check]) -> list :: Write pickles to files.
+
+        pickles is a sequence of (name, pickle) pairs. If check is False,
+        the pickles are written even if they didn't change. See dump() for
+        details.
+        """
+        pending = list()
+        try:
+            for (name, data) in pickles:
+                digest = hashlib.sha1(data).digest()
+                if check and self._digests.get(name) == digest:
+                    log.debug(u'PickleStore.dump: %r unchanged', name)
+                    continue
+                fname = self.filename(name)
+                log.debug(u'PickleStore.dump: %r -> file=%r, %d bytes',
+                            name, fname, len(data))
+                f = file(fname + self.tmp_ext, 'wb')
+                pending.append((name, digest, f))
+                f.write(data)
+                f.flush()
+            if self.fsync:
+                for (name, digest, f) in pending:
+                    os.fsync(f.fileno())
+            for (name, digest, f) in pending:
+                f.close()
+            written = list()
+            while pending:
+                (name, digest, f) = pending.pop(0)
+                os.rename(f.name, self.filename(name))
+                self._digests[name] = digest
+                written.append(name)
+        except:
+            for (name, digest, f) in pending:
+                f.close()
+                try:
+                    os.unlink(f.name)
+                except OSError:
+                    pass
+            raise
+        if written and self.fsync:
+            self._fsync_dir()
+        return written
+
+    def _fsync_dir(self):
+        r"_fsync_dir() -> None :: Flush the directory entries to disk."
+        try:
+            fd = os.open(self.dir, os.O_RDONLY)
+        except OSError, e:
+            log.debug(u'PickleStore._fsync_dir: %s', e)
+            return
+        try:
+            try:
+                os.fsync(fd)
+            except OSError, e:
+                # not all the platforms can fsync() a directory
+                if e.errno not in (errno.EINVAL, errno.EBADF):
+                    raise
+        finally:
+            os.close(fd)
+
+class LogStore(PickleStore):
+    r"""LogStore(dir[, ext[, fsync[, compact_size]]]) -> LogStore instance.
+
+    Keep each object in a pickle file (a snapshot, like PickleStore does)
+    plus a log file (with the extra extension log_ext), where the changes
+    made to the object after the snapshot are appended as soon as they are
+    recorded (see record()). Dumping a changed object only appends a commit
+    mark to its log (and flushes the log to disk if fsync is True). When an
+    object is loaded again (on a rollback, for example), the changes recorded
+    after the last commit mark are discarded, truncating the log, and the
+    object is rebuilt from the snapshot and the log.
+
+    If the changes are known when dumping (see PickleStore.dump()), all of
+    them are trusted to be recorded, and the log is used if there are changes
+    recorded. If not, the log is used only if replaying the recorded changes
+    over the last dumped state reproduces the object exactly, so changes that
+    were not recorded are never lost (the last dumped state of these objects
+    is kept in memory, pickled, and they are rebuilt from it when loaded
+    again). If the log can't be used, or if it's bigger than the snapshot
+    (and than compact_size bytes, 64KiB by default), a new snapshot is
+    written and the log is started again (compacted).
+
+    Each log starts with the digest of the snapshot it applies to, so a log
+    left behind by a crash while compacting is ignored.
+    """
+
+    # Extension of the log files (appended to the snapshot file name)
+    log_ext = '.log'
+
+    def __init__(self, dir, ext='.pkl', fsync=True, compact_size=65536):
+        r"""Initialize the LogStore object.
+
+        See LogStore class documentation for more info.
+        """
+        log.debug(u'LogStore(%r, %r, %r, %r)', dir, ext, fsync, compact_size)
+        PickleStore.__init__(self, dir, ext, fsync)
+        self.compact_size = compact_size
+        # name -> pickle of the object as it was last dumped (only for the
+        # objects dumped without knowing the changes)
+        self._committed = dict()
+        # name -> log file (open)
+        self._logs = dict()
+        # name -> size of the log up to the last commit mark
+        self._log_sizes = dict()
+        # name -> pickles of the changes recorded after the last commit mark
+        self._pending = dict()
+        # names of the objects which logs were created since the last dump
+        self._new_logs = set()
+
+    def logname(self, name):
+        r"logname(name) -> str :: Get the name of the log file of an object."
+        return self.filename(name) + self.log_ext
+
+    def record(self, name, change):
+        r"""record(name, change) -> None :: Record a change of an object.
+
+        change is a tuple, one of:
+
+        ('set', key, value) - object[key] = value
+        ('del', key) - del object[key]
+        ('append', value) - object.append(value)
+        ('replace', value) - object = value
+        ('attr', key, attr, change) - change object[key].attr (change is
+                                      one of these tuples)
+
+        Changes of objects that were never loaded or dumped are not recorded
+        (the object will be dumped as a new snapshot anyway).
+        """
+        if name not in self._digests:
+            return
+        f = self._logs.get(name)
+        if f is None:
+            f = self._create_log(name)
+        data = pickle.dumps(change, 2)
+        f.write(data)
+        self._pending.setdefault(name, list()).append(data)
+
+    def load(self, name):
+        r"""load(name) -> object :: Load an object.
+
+        The object is loaded from its snapshot, and the changes committed to
+        its log are replayed. If the last dumped state of the object is kept
+        in memory, it's used instead. In both cases, the changes recorded
+        after the last commit are discarded. An IOError is raised if the
+        object was never dumped.
+        """
+        log.debug(u'LogStore.load(%r): discarding %d changes', name,
+                    len(self._pending.get(name, ())))
+        self._discard(name)
+        if name in self._committed:
+            return pickle.loads(self._committed[name])
+        f = self._logs.pop(name, None)
+        if f is not None:
+            f.close()
+        return self._replay(name, PickleStore.load(self, name))
+
+    def dump(self, values, changes=None):
+        r"""dump(values[, changes]) -> list :: Dump objects.
+
+        values is a sequence of (name, object) pairs. Only the objects that
+        changed since they were loaded or dumped are written, appending
+        a commit mark to their logs or writing a new snapshot. If changes is
+        given (see PickleStore.dump()), the objects are known to be changed,
+        and the changes recorded are trusted (see LogStore class
+        documentation). The names of the written objects are returned.
+        """
+        commits = list()
+        snapshots = list()
+        for (name, value) in values:
+            if changes is not None:
+                # trust the log, the object is pickled only for a snapshot
+                self._committed.pop(name, None)
+                if name in self._pending and self._log_fits(name,
+                        path.getsize(self.filename(name))):
+                    commits.append((name, None))
+                else:
+                    snapshots.append((name, pickle.dumps(value, 2)))
+                continue
+            data = pickle.dumps(value, 2)
+            if data == self._committed.get(name):
+                log.debug(u'LogStore.dump: %r unchanged', name)
+                self._discard(name)
+            elif self._can_commit(name, data):
+                commits.append((name, data))
+            else:
+                snapshots.append((name, data))
+        written = list()
+        if commits:
+            mark = pickle.dumps(('commit',), 2)
+            for (name, data) in commits:
+                log.debug(u'LogStore.dump: %r -> %d changes logged', name,
+                            len(self._pending[name]))
+                self._logs[name].write(mark)
+            if self.fsync:
+                for (name, data) in commits:
+                    os.fsync(self._logs[name].fileno())
+            for (name, data) in commits:
+                self._log_sizes[name] = self._logs[name].tell()
+                del self._pending[name]
+                if data is not None:
+                    self._committed[name] = data
+                written.append(name)
+        if snapshots:
+            # logs of snapshots that don't need to be written are removed
+            # first, the others only when the new snapshot is written
+            if changes is None:
+                for (name, data) in snapshots:
+                    if self._digests.get(name) == hashlib.sha1(data).digest():
+                        self._remove_log(name)
+            written.extend(self._write(snapshots, changes is None))
+            for (name, data) in snapshots:
+                self._remove_log(name)
+                if changes is None:
+                    self._committed[name] = data
+        if self.fsync and (self._new_logs or snapshots):
+            self._fsync_dir()
+        self._new_logs.clear()
+        return written
+
+    def _log_fits(self, name, size):
+        r"""_log_fits(name, size) -> bool :: Tell if the log can be used.
+
+        size is the size of the snapshot. The log can be used if there are
+        changes recorded and it's not too big (see LogStore class
+        documentation).
+        """
+        changes = self._pending.get(name)
+        if not changes:
+            return False
+        size = max(self.compact_size, size)
+        if self._log_sizes[name] + sum([len(c) for c in changes]) > size:
+            log.debug(u'LogStore.dump: %r log too big, compacting', name)
+            return False
+        return True
+
+    def _can_commit(self, name, data):
+        r"""_can_commit(name, data) -> bool :: Tell if the log can be used.
+
+        data is the pickle of the object, which changes are not known. See
+        LogStore class documentation for details.
+        """
+        if name not in self._committed or not self._log_fits(name, len(data)):
+            return False
+        changes = self._pending[name]
+        value = pickle.loads(self._committed[name])
+        try:
+            for change in changes:
+                value = _apply(value, pickle.loads(change))
+        except Exception, e:
+            log.debug(u"LogStore.dump: %r changes can't be replayed: %r",
+                        name, e)
+            return False
+        if pickle.dumps(value, 2) != data:
+            log.debug(u'LogStore.dump: %r has changes not recorded', name)
+            return False
+        return True
+
+    def _replay(self, name, value):
+        r"""_replay(name, value) -> object :: Replay the log of an object.
+
+        value is the object loaded from the snapshot. The changes committed
+        to the log are applied to it, and the rest of the log is truncated.
+        """
+        fname = self.logname(name)
+        try:
+            f = file(fname, 'r+b', 0)
+        except IOError:
+            return value
+        s = StringIO(f.read())
+        committed = list()
+        changes = list()
+        size = 0
+        try:
+            if pickle.load(s) != ('snapshot', self._digests[name]):
+                log.info(u'LogStore.load: %r is outdated, ignored', fname)
+                f.close()
+                return value
+            size = s.tell()
+            while True:
+                change = pickle.load(s)
+                if change == ('commit',):
+                    committed.extend(changes)
+                    changes = list()
+                    size = s.tell()
+                else:
+                    changes.append(change)
+        except Exception, e:
+            # end of file, or a change partially written by a crash
+            log.debug(u'LogStore.load: end of %r: %r', fname, e)
+        log.debug(u'LogStore.load(%r): replaying %d changes, discarding %d',
+                    name, len(committed), len(changes))
+        for change in committed:
+            value = _apply(value, change)
+        f.truncate(size)
+        f.seek(size)
+        self._logs[name] = f
+        self._log_sizes[name] = size
+        return value
+
+    def _create_log(self, name):
+        r"_create_log(name) -> file :: Start the log of an object."
+        fname = self.logname(name)
+        log.debug(u'LogStore: creating log %r', fname)
+        f = file(fname, 'w+b', 0)
+        f.write(pickle.dumps(('snapshot', self._digests[name]), 2))
+        self._logs[name] = f
+        self._log_sizes[name] = f.tell()
+        self._new_logs.add(name)
+        return f
+
+    def _discard(self, name):
+        r"_discard(name) -> None :: Discard the changes not committed."
+        if self._pending.pop(name, None) is not None:
+            f = self._logs[name]
+            f.truncate(self._log_sizes[name])
+            f.seek(self._log_sizes[name])
+
+    def _remove_log(self, name):
+        r"_remove_log(name) -> None :: Remove the log of an object."
+        self._pending.pop(name, None)
+        self._log_sizes.pop(name, None)
+        self._new_logs.discard(name)
+        f = self._logs.pop(name, None)
+        if f is not None:
+            f.close()
+        try:
+            os.unlink(self.logname(name))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+def _apply(obj, change):
+    r"_apply(obj, change) -> object :: Apply a change (see LogStore.record())."
+    op = change[0]
+    if op == 'set':
+        obj[change[1]] = change[2]
+    elif op == 'del':
+        del obj[change[1]]
+    elif op == 'append':
+        obj.append(change[1])
+    elif op == 'replace':
+        obj = change[1]
+    elif op == 'attr':
+        item = obj[change[1]]
+        setattr(item, change[2], _apply(getattr(item, change[2]), change[3]))
+    else:
+        raise ValueError('Unknown change: %r' % (change,))
+    return obj
+
+class SqliteStore:
+    r"""SqliteStore(dir[, ext[, fsync[, lazy_size]]]) -> SqliteStore instance.
+
+    Keep the objects in a SQLite database (the file db_name, in the directory
+    dir; ext is not used). Dictionaries are stored one row per item (indexed
+    by key), other objects are stored pickled in a single row.
+
+    Dictionaries with more than lazy_size items (1000 by default) are loaded
+    lazily, as a LazyDict, which gets the items from the database only when
+    they are used. Smaller dictionaries are loaded as regular dicts.
+
+    Only the items (and objects) that changed since they were loaded or
+    dumped are written when dumping, all in a single transaction (the
+    statements are prepared only once, by the sqlite3 module statements
+    cache). If fsync is True (the default), the transaction is on disk when
+    dump() returns.
+
+    The store can be used from many threads, and it reopens the database
+    after a fork().
+    """
+
+    # Name of the database file
+    db_name = 'persistent.sqlite'
+
+    def __init__(self, dir, ext='.pkl', fsync=True, lazy_size=1000):
+        r"""Initialize the SqliteStore object.
+
+        See SqliteStore class documentation for more info.
+        """
+        log.debug(u'SqliteStore(%r, %r, %r, %r)', dir, ext, fsync, lazy_size)
+        if sqlite3 is None:
+            raise ImportError('SqliteStore needs the sqlite3 module')
+        self.dir = dir
+        self.ext = ext
+        self.fsync = fsync
+        self.lazy_size = lazy_size
+        self._lock = threading.RLock()
+        self._db = None
+        self._pid = None
+        # name -> digest of the pickle of the object (not dictionaries)
+        self._digests = dict()
+        # name -> key -> digest of the pickle of the item (dictionaries
+        # loaded as regular dicts, LazyDicts keep their own)
+        self._rows = dict()
+
+    def _connection(self):
+        r"_connection() -> sqlite3.Connection :: Get the database connection."
+        if self._db is None or self._pid != os.getpid():
+            fname = path.join(self.dir, self.db_name)
+            log.debug(u'SqliteStore: opening %r', fname)
+            # transactions are handled explicitly
+            db = sqlite3.connect(fname, isolation_level=None,
+                                 check_same_thread=False)
+            db.text_factory = str
+            db.execute('PRAGMA journal_mode = WAL')
+            if self.fsync:
+                db.execute('PRAGMA synchronous = FULL')
+            else:
+                db.execute('PRAGMA synchronous = OFF')
+            db.execute('CREATE TABLE IF NOT EXISTS objects ('
+                            'name TEXT PRIMARY KEY, value BLOB)')
+            db.execute('CREATE TABLE IF NOT EXISTS items ('
+                            'name TEXT, key, value BLOB, '
+                            'PRIMARY KEY (name, key))')
+            self._db = db
+            self._pid = os.getpid()
+        return self._db
+
+    def exists(self, name):
+        r"exists(name) -> bool :: Tell if an object was dumped."
+        self._lock.acquire()
+        try:
+            row = self._connection().execute('SELECT 1 FROM objects '
+                    'WHERE name = ?', (name,)).fetchone()
+        finally:
+            self._lock.release()
+        return row is not None
+
+    def verify(self, name):
+        r"""verify(name) -> None :: Check that an object can be loaded.
+
+        Only the existence of the object is checked (the database is kept
+        consistent by SQLite). An IOError is raised if it was never dumped.
+        """
+        if not self.exists(name):
+            raise IOError(errno.ENOENT, 'Object not found in %s' %
+                          path.join(self.dir, self.db_name), name)
+
+    def load(self, name):
+        r"""load(name) -> object :: Load an object.
+
+        An IOError is raised if the object was never dumped.
+        """
+        self._lock.acquire()
+        try:
+            db = self._connection()
+            row = db.execute('SELECT value FROM objects WHERE name = ?',
+                             (name,)).fetchone()
+            if row is None:
+                raise IOError(errno.ENOENT, 'Object not found in %s' %
+                              path.join(self.dir, self.db_name), name)
+            if row[0] is not None:
+                data = str(row[0])
+                self._digests[name] = hashlib.sha1(data).digest()
+                self._rows.pop(name, None)
+                value = pickle.loads(data)
+                log.debug(u'SqliteStore.load(%r) -> value=%r', name, value)
+                return value
+            self._digests.pop(name, None)
+            (size,) = db.execute('SELECT count(*) FROM items WHERE name = ?',
+                                 (name,)).fetchone()
+            if size > self.lazy_size:
+                log.debug(u'SqliteStore.load(%r) -> %d items, lazy', name,
+                            size)
+                self._rows.pop(name, None)
+                return LazyDict(self, name)
+            value = dict()
+            rows = dict()
+            for (key, data) in self.items(name):
+                value[key] = pickle.loads(data)
+                rows[key] = hashlib.sha1(data).digest()
+            self._rows[name] = rows
+            log.debug(u'SqliteStore.load(%r) -> %d items', name, size)
+            return value
+        finally:
+            self._lock.release()
+
+    def item(self, name, key):
+        r"""item(name, key) -> str/None :: Get the pickle of an item.
+
+        None is returned if the dictionary name has no item key.
+        """
+        self._lock.acquire()
+        try:
+            row = self._connection().execute('SELECT value FROM items '
+                    'WHERE name = ? AND key = ?',
+                    (name, _to_column(key))).fetchone()
+        finally:
+            self._lock.release()
+        if row is None:
+            return None
+        return str(row[0])
+
+    def items(self, name):
+        r"""items(name) -> list :: Get the (key, pickle) pairs of the items."""
+        self._lock.acquire()
+        try:
+            return [(_from_column(key), str(data)) for (key, data) in
+                    self._connection().execute('SELECT key, value FROM items '
+                                               'WHERE name = ?', (name,))]
+        finally:
+            self._lock.release()
+
+    def dump(self, values, changes=None):
+        r"""dump(values[, changes]) -> list :: Dump objects.
+
+        values is a sequence of (name, object) pairs. Only the objects (or
+        dictionary items) that changed since they were loaded or dumped are
+        written. If changes is given (see PickleStore.dump()), only the
+        changed items of the dictionaries are looked at, and the objects are
+        written without checking if they changed. The names of the written
+        objects are returned.
+        """
+        self._lock.acquire()
+        try:
+            db = self._connection()
+            written = list()
+            # changes to remember when the transaction is committed
+            digests = dict()
+            rows = list()
+            db.execute('BEGIN')
+            try:
+                for (name, value) in values:
+                    keys = None
+                    if changes is not None and None not in changes[name]:
+                        keys = changes[name]
+                    if isinstance(value, dict):
+                        diff = self._dump_dict(db, name, value, keys)
+                        if diff is not None:
+                            rows.append((name, value, diff))
+                            written.append(name)
+                        continue
+                    data = pickle.dumps(value, 2)
+                    digest = hashlib.sha1(data).digest()
+                    if changes is None and self._digests.get(name) == digest:
+                        log.debug(u'SqliteStore.dump: %r unchanged', name)
+                        continue
+                    log.debug(u'SqliteStore.dump: %r -> %d bytes', name,
+                                len(data))
+                    db.execute('DELETE FROM items WHERE name = ?', (name,))
+                    db.execute('INSERT OR REPLACE INTO objects (name, value) '
+                               'VALUES (?, ?)', (name, buffer(data)))
+                    digests[name] = digest
+                    written.append(name)
+                db.execute('COMMIT')
+            except:
+                db.execute('ROLLBACK')
+                raise
+            for (name, digest) in digests.items():
+                self._digests[name] = digest
+                self._rows.pop(name, None)
+            for (name, value, (baseline, diff)) in rows:
+                self._digests.pop(name, None)
+                for (key, digest) in diff:
+                    if digest is None:
+                        baseline.pop(key, None)
+                    else:
+                        baseline[key] = digest
+                if not isinstance(value, LazyDict) or value._store is not self:
+                    self._rows[name] = baseline
+            return written
+        finally:
+            self._lock.release()
+
+    def _dump_dict(self, db, name, value, keys=None):
+        r"""_dump_dict(db, name, value[, keys]) -> (dict, list)/None.
+
+        The changed items are written (inside the current transaction) and
+        the dictionary of the digests of the stored items plus a list of
+        (key, digest) pairs with the changes to make to it (digest is None
+        for removed items) is returned (or None if nothing changed). If
+        keys is given, only the items with those keys could have changed,
+        and they are written without checking it.
+        """
+        if isinstance(value, LazyDict) and value._store is self \
+                and value._name == name:
+            # only the items loaded could have changed
+            baseline = value._rows
+            items = dict.items(value)
+        else:
+            baseline = self._rows.get(name)
+            items = value.items()
+        changes = list()
+        rewrite = baseline is None
+        if rewrite:
+            log.debug(u'SqliteStore.dump: %r -> rewriting all the items',
+                        name)
+            baseline = dict()
+            db.execute('DELETE FROM items WHERE name = ?', (name,))
+            db.execute('INSERT OR REPLACE INTO objects (name, value) '
+                       'VALUES (?, NULL)', (name,))
+        elif keys is not None:
+            items = list()
+            for key in keys:
+                if dict.__contains__(value, key):
+                    items.append((key, dict.__getitem__(value, key)))
+                elif key in baseline:
+                    db.execute('DELETE FROM items WHERE name = ? AND key = ?',
+                               (name, _to_column(key)))
+                    changes.append((key, None))
+        else:
+            for key in baseline:
+                if not dict.__contains__(value, key):
+                    db.execute('DELETE FROM items WHERE name = ? AND key = ?',
+                               (name, _to_column(key)))
+                    changes.append((key, None))
+        for (key, item) in items:
+            data = pickle.dumps(item, 2)
+            digest = hashlib.sha1(data).digest()
+            if keys is None and baseline.get(key) == digest:
+                continue
+            db.execute('INSERT OR REPLACE INTO items (name, key, value) '
+                       'VALUES (?, ?, ?)', (name, _to_column(key),
+                                            buffer(data)))
+            changes.append((key, digest))
+        if not changes and not rewrite:
+            log.debug(u'SqliteStore.dump: %r unchanged', name)
+            return None
+        log.debug(u'SqliteStore.dump: %r -> %d items changed', name,
+                    len(changes))
+        return (baseline, changes)
+
+def _to_column(key):
+    r"""_to_column(key) -> object :: Convert a dictionary key to a column.
+
+    Strings (ASCII only if they are not unicode) and integers are stored as
+    they are, so equal keys are stored the same way, other keys are stored
+    pickled.
+    """
+    if isinstance(key, unicode) or isinstance(key, (int, long)) \
+            and not isinstance(key, bool):
+        return key
+    if isinstance(key, str):
+        try:
+            return key.decode('ascii')
+        except UnicodeDecodeError:
+            pass
+    return buffer(pickle.dumps(key, 2))
+
+def _from_column(key):
+    r"_from_column(key) -> object :: Convert a column to a dictionary key."
+    if isinstance(key, str):
+        # text_factory is str, BLOBs are returned as buffers
+        return key.decode('utf-8')
+    if isinstance(key, buffer):
+        return pickle.loads(str(key))
+    return key
+
+class LazyDict(dict):
+    r"""LazyDict(store, name) -> LazyDict instance :: Lazy dictionary.
+
+    Dictionary with the items of the dictionary name of the SqliteStore
+    store, which are got from the database only when they are used: getting,
+    setting, deleting or looking for a key only gets that item, everything
+    else (like iterating or getting the length) gets all the items.
+
+    The code implemented in C that uses the dictionary internals (like
+    dict(d), some_dict.update(d) or f(**d)) only sees the items already got.
+    """
+
+    def __init__(self, store, name):
+        r"""Initialize the LazyDict object.
+
+        See LazyDict class documentation for more info.
+        """
+        dict.__init__(self)
+        self._store = store
+        self._name = name
+        # key -> digest of the pickle of the stored item, for all the items
+        # got (even if they were removed later)
+        self._rows = dict()
+        self._loaded = False
+
+    def _get(self, key):
+        r"_get(key) -> bool :: Get the item key if needed, tell if it's here."
+        if dict.__contains__(self, key):
+            return True
+        if self._loaded or key in self._rows:
+            return False
+        data = self._store.item(self._name, key)
+        if data is None:
+            return False
+        dict.__setitem__(self, key, pickle.loads(data))
+        self._rows[key] = hashlib.sha1(data).digest()
+        return True
+
+    def _load(self):
+        r"_load() -> None :: Get all the items not got yet."
+        if self._loaded:
+            return
+        log.debug(u'LazyDict(%r): loading all the items', self._name)
+        for (key, data) in self._store.items(self._name):
+            if key not in self._rows and not dict.__contains__(self, key):
+                dict.__setitem__(self, key, pickle.loads(data))
+                self._rows[key] = hashlib.sha1(data).digest()
+        self._loaded = True
+
+    def __getitem__(self, key):
+        if not self._get(key):
+            raise KeyError(key)
+        return dict.__getitem__(self, key)
+
+    def __delitem__(self, key):
+        if not self._get(key):
+            raise KeyError(key)
+        dict.__delitem__(self, key)
+
+    def __contains__(self, key):
+        return self._get(key)
+
+    def has_key(self, key):
+        return self._get(key)
+
+    def get(self, key, default=None):
+        if not self._get(key):
+            return default
+        return dict.__getitem__(self, key)
+
+    def setdefault(self, key, default=None):
+        if not self._get(key):
+            dict.__setitem__(self, key, default)
+        return dict.__getitem__(self, key)
+
+    def pop(self, key, *default):
+        self._get(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        self._load()
+        return dict.popitem(self)
+
+    def update(self, *args, **kwargs):
+        for other in args + (kwargs,):
+            if hasattr(other, 'keys'):
+                other = [(k, other[k]) for k in other.keys()]
+            for (key, value) in other:
+                dict.__setitem__(self, key, value)
+
+    def clear(self):
+        self._load()
+        dict.clear(self)
+
+    def copy(self):
+        return dict(self.items())
+
+    def __len__(self):
+        self._load()
+        return dict.__len__(self)
+
+    def __iter__(self):
+        self._load()
+        return dict.__iter__(self)
+
+    def keys(self):
+        self._load()
+        return dict.keys(self)
+
+    def values(self):
+        self._load()
+        return dict.values(self)
+
+    def items(self):
+        self._load()
+        return dict.items(self)
+
+    def iterkeys(self):
+        self._load()
+        return dict.iterkeys(self)
+
+    def itervalues(self):
+        self._load()
+        return dict.itervalues(self)
+
+    def iteritems(self):
+        self._load()
+        return dict.iteritems(self)
+
+    def __eq__(self, other):
+        self._load()
+        if isinstance(other, LazyDict):
+            other._load()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        self._load()
+        return dict.__repr__(self)
+
+    def __reduce__(self):
+        r"Pickle (and copy) LazyDicts as regular dicts."
+        return (dict, (self.items(),))
+
+
+if __name__ == '__main__':
+
+    import shutil
+    import tempfile
+
+    d = tempfile.mkdtemp()
+    try:
+        s = PickleStore(d)
+        try:
+            s.load('a')
+            assert False, 'It should raised an IOError'
+        except IOError, e:
+            print 'Not found:', e
+        assert not s.exists('a')
+        assert s.dump([('a', dict(x=1)), ('b', [1, 2])]) == ['a', 'b']
+        assert s.exists('a')
+        s.verify('a')
+        assert s.dump([('a', dict(x=1)), ('b', [1, 2, 3])]) == ['b']
+        assert sorted(os.listdir(d)) == ['a.pkl', 'b.pkl'], os.listdir(d)
+        s = PickleStore(d)
+        assert s.load('a') == dict(x=1)
+        assert s.load('b') == [1, 2, 3]
+        assert s.dump([('a', dict(x=1))]) == []
+        assert s.dump([('a', dict(x=1))], dict(a=set([None]))) == ['a']
+        # a failed dump leaves the old data
+        try:
+            s.dump([('a', dict(x=2)), ('b', [lambda: None])])
+            assert False, 'It should raised a PicklingError'
+        except pickle.PicklingError, e:
+            print 'Not dumped:', e
+        assert sorted(os.listdir(d)) == ['a.pkl', 'b.pkl'], os.listdir(d)
+        assert PickleStore(d).load('a') == dict(x=1)
+        # damaged files
+        file(s.filename('c'), 'wb').write(pickle.dumps([1], 2)[:-1])
+        for check in (s.verify, s.load):
+            try:
+                check('c')
+                assert False, 'It should raised an IOError'
+            except IOError, e:
+                print 'Damaged:', e
+        os.unlink(s.filename('c'))
+        # LogStore
+        s = LogStore(d)
+        hosts = s.load('a')
+        rules = s.load('b')
+        hosts['y'] = 2
+        s.record('a', ('set', 'y', 2))
+        rules.append(4)
+        s.record('b', ('append', 4))
+        snapshot = file(s.filename('a')).read()
+        assert s.dump([('a', hosts), ('b', rules)],
+                      dict(a=set(['y']), b=set([None]))) == ['a', 'b']
+        assert file(s.filename('a')).read() == snapshot
+        assert not s._committed
+        assert sorted(os.listdir(d)) == ['a.pkl', 'a.pkl.log', 'b.pkl',
+                                         'b.pkl.log'], os.listdir(d)
+        # rollback
+        del hosts['x']
+        s.record('a', ('del', 'x'))
+        hosts = s.load('a')
+        assert hosts == dict(x=1, y=2), hosts
+        # changes not recorded are not lost
+        hosts['z'] = 3
+        hosts['w'] = 4
+        s.record('a', ('set', 'w', 4))
+        # (b is compacted, its last dumped state is not kept in memory)
+        assert s.dump([('a', hosts), ('b', rules)]) == ['a', 'b']
+        assert not path.exists(s.logname('a'))
+        assert s.dump([('a', hosts), ('b', rules)]) == []
+        # uncommitted and partially written changes are discarded
+        s.record('b', ('replace', [5]))
+        s._logs['b'].write(pickle.dumps(('append', 6), 2)[:-3])
+        s = LogStore(d)
+        assert s.load('a') == dict(x=1, y=2, z=3, w=4)
+        assert s.load('b') == [1, 2, 3, 4]
+        # compaction
+        s.compact_size = 0
+        rules = s.load('b')
+        rules.append(5)
+        s.record('b', ('append', 5))
+        assert s.dump([('b', rules)]) == ['b']
+        assert not path.exists(s.logname('b'))
+        assert LogStore(d).load('b') == [1, 2, 3, 4, 5]
+        # outdated logs are ignored
+        s.compact_size = 65536
+        rules.append(6)
+        s.record('b', ('append', 6))
+        assert s.dump([('b', rules)]) == ['b']
+        assert path.exists(s.logname('b'))
+        assert LogStore(d).load('b') == [1, 2, 3, 4, 5, 6]
+        PickleStore(d).dump([('b', [0])])
+        assert LogStore(d).load('b') == [0]
+        # changes of attributes of the items
+        class Zone:
+            def __init__(self):
+                self.hosts = dict()
+        s = LogStore(d)
+        assert s.dump([('zones', dict(z=Zone()))]) == ['zones']
+        zones = s.load('zones')
+        zones['z'].hosts['h'] = 1
+        s.record('zones', ('attr', 'z', 'hosts', ('set', 'h', 1)))
+        assert s.dump([('zones', zones)], dict(zones=set(['z']))) \
+                == ['zones']
+        assert path.exists(s.logname('zones'))
+        assert LogStore(d).load('zones')['z'].hosts == dict(h=1)
+        # SqliteStore
+        s = SqliteStore(d, lazy_size=2)
+        try:
+            s.load('hosts')
+            assert False, 'It should raised an IOError'
+        except IOError, e:
+            print 'Not found:', e
+        hosts = dict(a=[1], b=[2], c=[3])
+        hosts[u'\xf1'] = [4]
+        hosts[(1, 2)] = [5]
+        assert s.dump([('hosts', hosts), ('params', dict(x=1)),
+                       ('rules', [1])]) == ['hosts', 'params', 'rules']
+        assert s.dump([('hosts', hosts), ('params', dict(x=1)),
+                       ('rules', [1])]) == []
+        s = SqliteStore(d, lazy_size=2)
+        assert s.exists('hosts') and not s.exists('users')
+        s.verify('hosts')
+        h = s.load('hosts')
+        assert isinstance(h, LazyDict) and dict.__len__(h) == 0
+        assert h['a'] == [1] and h.get(u'b') == [2] and (1, 2) in h
+        assert 'x' not in h and h.get('x') is None
+        assert dict.__len__(h) == 3, dict.__len__(h)
+        h['b'].append(2)
+        del h['c']
+        h['d'] = [6]
+        assert dict.__len__(h) == 4, dict.__len__(h)
+        assert s.dump([('hosts', h)]) == ['hosts']
+        assert dict.__len__(h) == 4, dict.__len__(h)
+        # known changes: only the changed items are looked at
+        h['a'].append(1)
+        h['b'].append(3)
+        assert s.dump([('hosts', h)], dict(hosts=set(['b', 'c']))) \
+                == ['hosts']
+        assert SqliteStore(d).load('hosts')['a'] == [1]
+        h['a'].pop()
+        h['b'].pop()
+        assert s.dump([('hosts', h)], dict(hosts=set(['b']))) == ['hosts']
+        params = s.load('params')
+        assert type(params) is dict and params == dict(x=1)
+        assert s.load('rules') == [1]
+        h2 = SqliteStore(d).load('hosts')
+        hosts = dict(a=[1], b=[2, 2], d=[6])
+        hosts[u'\xf1'] = [4]
+        hosts[(1, 2)] = [5]
+        assert h2 == hosts, h2
+        assert pickle.loads(pickle.dumps(h2, 2)) == h2
+        assert type(pickle.loads(pickle.dumps(h2, 2))) is dict
+        # object type changes
+        assert s.dump([('hosts', [1, 2])]) == ['hosts']
+        assert SqliteStore(d).load('hosts') == [1, 2]
+        assert s.dump([('hosts', dict(y=1))]) == ['hosts']
+        assert SqliteStore(d).load('hosts') == dict(y=1)
+        print 'OK'
+    finally:
+        shutil.rmtree(d)
+
@@ -0,0 +1,649 @@
+# vim: set encoding=utf-8 et sw=4 sts=4 :
+
+r"""
+Pre-forked workers to serve read-only commands in parallel.
+
+This module provides a WorkerPool class, used by PyminDaemon to fork
+a number of worker processes that listen to the same UDP port as the
+daemon (using SO_REUSEPORT, so the kernel distributes the requests between
+them).
+
+The daemon process is the only writer: it's the only one that modifies the
+handlers state. Each worker has a snapshot of the handlers state (taken when
+it was forked, as fork() copies the whole process) and serves the read-only
+commands (see PyminDaemon.readonly_commands) using it, as long as the
+snapshot is up to date. All other commands (and read-only commands when the
+snapshot is out of date) are forwarded to the writer through a UNIX socket.
+
+Snapshots are versioned using a counter in a memory region shared by all the
+processes. The writer increments the counter each time a command that can
+modify the state is received, so workers stop using their snapshots
+immediately. When the writer has been idle for a while, new workers (with
+a fresh snapshot) are forked and the old ones are retired. Retired workers
+handle the requests already queued in their sockets and close them, so no
+requests are lost while the workers are replaced.
+
+Please see WorkerPool and Worker classes documentation for more info.
+"""
+
+import os
+import mmap
+import errno
+import struct
+import signal
+import socket
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import logging ; log = logging.getLogger('pymin.prefork')
+
+from pymin import eventloop
+from pymin import transport
+from pymin import metrics
+from pymin.executor import Future
+
+__all__ = ('WorkerPool', 'Worker', 'SharedCounter')
+
+# Message sent by the writer to retire a worker (it's sent through the link,
+# not as a signal, so it's not lost if the worker is not ready to handle
+# signals yet)
+_retire_message = 'retire\n'
+
+# Prefix of the messages sent by workers to the writer with the metrics of the
+# requests they served (a pickled metrics.Metrics object follows)
+_metrics_message = 'metrics\n'
+
+# Size of the buffers of the sockets used to talk to the writer (big enough
+# to hold several maximum sized requests and responses)
+LINK_BUFFER = 1048576
+
+def reuseport_available():
+    r"reuseport_available() -> bool :: Tell if SO_REUSEPORT is available."
+    return hasattr(socket, 'SO_REUSEPORT')
+
+def udp_socket(addr, reuseport=False):
+    r"""udp_socket(addr[, reuseport]) -> socket :: Create a UDP socket.
+
+    addr is a tuple of (ip, port) where to bind the socket to. If reuseport is
+    True, the SO_REUSEPORT option is set before binding the socket, so many
+    sockets can be bound to the same address.
+    """
+    log.debug(u'udp_socket(%r, %r)', addr, reuseport)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(addr)
+    return sock
+
+def _link_pair():
+    r"_link_pair() -> (socket, socket) :: Create a writer-worker link."
+    pair = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    for s in pair:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, LINK_BUFFER)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, LINK_BUFFER)
+        s.setblocking(False)
+    return pair
+
+class SharedCounter:
+    r"""SharedCounter() -> SharedCounter instance.
+
+    A 64 bits counter stored in an anonymous shared memory region, so it's
+    shared by the process that created it and all its (forked) children.
+    Only one process should increment it.
+    """
+
+    def __init__(self):
+        r"""Initialize the SharedCounter object.
+
+        See SharedCounter class documentation for more info.
+        """
+        self._map = mmap.mmap(-1, 8)
+        self.set(0)
+
+    def get(self):
+        r"get() -> int :: Get the counter value."
+        return struct.unpack('Q', self._map[0:8])[0]
+
+    def set(self, value):
+        r"set(value) -> None :: Set the counter value."
+        self._map[0:8] = struct.pack('Q', value)
+
+    def increment(self):
+        r"increment() -> int :: Increment the counter, return the new value."
+        value = self.get() + 1
+        self.set(value)
+        return value
+
+    def close(self):
+        r"close() -> None :: Release the shared memory region."
+        self._map.close()
+
+class Worker(eventloop.EventLoop):
+    r"""Worker(daemon, sock, link, version[, out]) -> Worker instance.
+
+    Event loop of a worker process. It serves the UDP requests received in
+    'sock' using the (forked) PyminDaemon 'daemon' handlers. 'link' is the
+    socket connected to the writer and 'version' is the SharedCounter with
+    the current state version. Responses are sent using the socket 'out'
+    (a copy of the writer socket, bound to the same address), or 'sock' if
+    it's None.
+
+    Read-only commands are served locally while the state version is the
+    same as when the worker was created. Everything else is forwarded to
+    the writer. The metrics of the requests served locally are sent to the
+    writer every 'metrics_interval' seconds (and when the worker is retired),
+    which adds them to the daemon metrics (see pymin.metrics).
+
+    When the writer retires the worker (or a SIGTERM or SIGINT is received),
+    the worker handles the requests already queued in 'sock' and closes it
+    (so the kernel sends new requests to the other sockets bound to the
+    address), and then it exits as soon as there are no forwarded requests
+    waiting for a response (or after 'linger' seconds). If 'out' is None,
+    'sock' can't be closed until then, and requests received in the meantime
+    are lost, as it happens with any UDP datagram, the client should retry.
+    """
+
+    # Seconds to wait for pending forwarded requests before exiting
+    linger = 5
+
+    # Seconds between sending the metrics to the writer
+    metrics_interval = 1
+
+    def __init__(self, daemon, sock, link, version, out=None):
+        r"""Initialize the Worker object.
+
+        See Worker class documentation for more info.
+        """
+        log.debug(u'Worker(%r, %r, %r, %r, %r)', daemon, sock, link, version,
+                    out)
+        def quit(loop, signum):
+            log.debug(u'Worker quit() handler: signal %r', signum)
+            loop.retire()
+        eventloop.EventLoop.__init__(self, sock, signals={
+                signal.SIGINT: quit,
+                signal.SIGTERM: quit,
+            })
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        self.daemon = daemon
+        self.link = link
+        self.version = version
+        sock.setblocking(False)
+        self.out = out
+        if out is None:
+            out = sock
+        self.sender = transport.DatagramSender(self, out, daemon.sender.limit,
+                                               daemon.sender.policy)
+        # version of the snapshot of the state this worker has
+        self.snapshot = version.get()
+        # metrics of the requests served locally, not sent to the writer yet
+        self.metrics = metrics.Metrics()
+        self.call_every(self.metrics_interval, self._send_metrics)
+        # id -> addr of requests forwarded to the writer
+        self._pending = dict()
+        self._next_id = 0
+        self._retired = False
+        self.add_reader(link, self._handle_link)
+
+    def handle(self):
+        r"handle() -> None :: Handle an incoming request."
+        self._receive()
+
+    def _receive(self):
+        r"""_receive() -> bool :: Handle a request queued in the socket.
+
+        Returns False if there were no requests queued.
+        """
+        try:
+            (msg, addr) = self.file.recvfrom(65535)
+        except socket.error, e:
+            if e.args[0] in transport._retry_errors:
+                return False
+            raise
+        log.debug(u'Worker.handle: message %r from %r', msg, addr)
+        sample = self.metrics.sample()
+        (response, path) = self._serve(msg, sample)
+        if response is None:
+            # the writer takes note of its metrics
+            self.forward(msg, addr)
+        else:
+            self.sender.send(addr, self.daemon.datagram(response))
+            sample.lap('send')
+            sample.done(path, response[0].startswith('ERROR'))
+        return True
+
+    def _serve(self, msg, sample=None):
+        r"""_serve(msg[, sample]) -> (list/None, unicode) :: Serve a request.
+
+        The request is served using the snapshot. The response is returned
+        if the request can be served locally, otherwise None is returned
+        (asynchronous commands can't be served locally). The command path is
+        returned too, and the request timings are taken in the
+        metrics.Sample sample (if not None).
+        """
+        if self.version.get() != self.snapshot:
+            return (None, None)
+        if msg.split('\n', 1)[0].strip() == self.daemon.batch_start:
+            return (None, None)
+        try:
+            (format, msg) = self.daemon.split_format(msg)
+            (handler, command, args, kwargs) = self.daemon.dispatcher.resolve(
+                                                    unicode(msg, 'utf-8'))
+        except Exception, e:
+            return (self.daemon.error_response(e), u'<invalid>')
+        if (command[-1] not in self.daemon.readonly_commands
+                or command[-1] in self.daemon.live_commands):
+            return (None, None)
+        if sample is not None:
+            sample.lap('route')
+        log.debug(u'Worker._serve: serving %r locally', command)
+        response = self.daemon.cached_call(handler, command, args, kwargs,
+                                           sample, format)
+        if isinstance(response, Future):
+            # the worker has no executor threads to complete it
+            log.debug(u'Worker._serve: %r is asynchronous', command)
+            return (None, None)
+        return (response, u' '.join(command))
+
+    def _send_metrics(self):
+        r"""_send_metrics() -> None :: Send the metrics to the writer.
+
+        The metrics are kept (and sent later) if the link is full.
+        """
+        if not self.metrics.counters:
+            return
+        try:
+            self.link.send(_metrics_message + pickle.dumps(self.metrics,
+                                                    pickle.HIGHEST_PROTOCOL))
+        except socket.error, e:
+            log.debug(u"Worker._send_metrics: can't send metrics: %s", e)
+            return
+        self.metrics = metrics.Metrics()
+
+    def forward(self, msg, addr):
+        r"forward(msg, addr) -> None :: Forward a request to the writer."
+        req_id = self._next_id
+        self._next_id += 1
+        log.debug(u'Worker.forward: request %r from %r forwarded as %d',
+                    msg, addr, req_id)
+        try:
+            self.link.send('%d\n%s' % (req_id, msg))
+        except socket.error, e:
+            # UDP semantics, the client will retry
+            log.warning(u"Worker.forward: can't forward request: %s", e)
+            return
+        self._pending[req_id] = addr
+
+    def _leave_group(self):
+        r"""_leave_group() -> None :: Stop getting requests, keep the queued.
+
+        The socket is connected to its own address, so the kernel sends new
+        requests to the other sockets bound to the address (connected sockets
+        only get the datagrams sent by their peer, on Linux 5.1 or newer),
+        and the requests already queued can still be received (closing the
+        socket right away would discard them).
+        """
+        (ip, port) = self.file.getsockname()
+        if ip == '0.0.0.0':
+            ip = '127.0.0.1'
+        try:
+            self.file.connect((ip, port))
+        except socket.error, e:
+            log.warning(u"Worker._leave_group: can't connect socket: %s", e)
+
+    def _handle_link(self):
+        r"_handle_link() -> None :: Handle the writer responses."
+        while True:
+            try:
+                data = self.link.recv(LINK_BUFFER)
+            except socket.error, e:
+                if e.args[0] in transport._retry_errors:
+                    break
+                raise
+            if not data:
+                log.debug(u'Worker._handle_link: writer is gone')
+                self.remove_reader(self.link)
+                self.stop()
+                return
+            if data == _retire_message:
+                self.retire()
+                continue
+            (req_id, response) = data.split('\n', 1)
+            addr = self._pending.pop(int(req_id), None)
+            if addr is None:
+                continue
+            log.debug(u'Worker._handle_link: response %d to %r', int(req_id),
+                        addr)
+            self.sender.send(addr, response)
+        if self._retired and not self._pending:
+            self.stop()
+
+    def retire(self):
+        r"""retire() -> None :: Stop receiving requests and exit when done.
+
+        The requests already received are handled and the socket is closed (if
+        responses don't go through it). The worker exits when all the
+        forwarded requests are replied, or after 'linger' seconds.
+        """
+        if self._retired:
+            return
+        log.debug(u'Worker.retire()')
+        self._retired = True
+        self.remove_reader(self.file)
+        if self.out is not None:
+            self._leave_group()
+        while self._receive():
+            pass
+        if self.out is not None:
+            self.file.close()
+        self._send_metrics()
+        if not self._pending:
+            self.stop()
+        else:
+            self.call_later(self.linger, self.stop)
+
+class WorkerPool:
+    r"""WorkerPool(daemon, workers[, refork_delay[, max_age]]) -> WorkerPool.
+
+    Manage 'workers' worker processes for the PyminDaemon 'daemon' (the
+    writer). Workers listen to the same UDP address the daemon socket is
+    bound to (the daemon socket must have been bound with SO_REUSEPORT, see
+    udp_socket()).
+
+    The writer must call changed() every time a command that can modify the
+    handlers state is received. When the state changed and then nothing
+    changed for 'refork_delay' seconds (and there are no background jobs
+    running), the workers are replaced with new ones, with a fresh snapshot
+    of the state. Workers are replaced too when their snapshot is 'max_age'
+    seconds old, so changes not made through commands (like the ones made by
+    handle_timer(), for example, the running status of services) are not
+    hidden for too long.
+
+    Dead workers are replaced too. Workers are reaped by the pool when they
+    close their link (on exit).
+    """
+
+    def __init__(self, daemon, workers, refork_delay=1, max_age=10):
+        r"""Initialize the WorkerPool object.
+
+        See WorkerPool class documentation for more info.
+        """
+        log.debug(u'WorkerPool(%r, %r, %r, %r)', daemon, workers, refork_delay,
+                    max_age)
+        if not reuseport_available():
+            raise RuntimeError('SO_REUSEPORT is not available')
+        self.daemon = daemon
+        self.size = workers
+        self.refork_delay = refork_delay
+        self.max_age = max_age
+        self.version = SharedCounter()
+        # link -> pid of the active workers
+        self.workers = dict()
+        # link -> pid of the retired workers (still finishing their jobs)
+        self.retired = dict()
+        self._snapshot = None
+        self._snapshot_time = None
+        self._changed_time = None
+        self._timer = None
+
+    def start(self):
+        r"""start() -> None :: Fork the workers and start monitoring them.
+
+        Workers are forked only when there are no background jobs running,
+        so they might be forked later.
+        """
+        log.debug(u'WorkerPool.start()')
+        self._timer = self.daemon.call_every(self.refork_delay, self.check)
+        self.check()
+
+    def changed(self):
+        r"""changed() -> None :: Tell the pool the state (may have) changed.
+
+        Workers stop serving requests from their snapshot immediately.
+        """
+        self.version.increment()
+        self._changed_time = eventloop.monotonic()
+
+    def check(self):
+        r"""check() -> None :: Replace stale and dead workers.
+
+        This is called periodically by the daemon event loop, and when the
+        daemon finishes its background jobs.
+        """
+        if not self.daemon.idle():
+            # don't fork while the state is being modified
+            return
+        now = eventloop.monotonic()
+        if self._snapshot is None:
+            self.refork()
+        elif self.version.get() != self._snapshot:
+            if now - self._changed_time >= self.refork_delay:
+                self.refork()
+        elif now - self._snapshot_time >= self.max_age:
+            self.refork()
+        elif len(self.workers) < self.size:
+            log.info(u'WorkerPool: %d workers died, replacing them',
+                        self.size - len(self.workers))
+            self.refork()
+
+    def refork(self):
+        r"""refork() -> None :: Replace all the workers with new ones.
+
+        The old workers are retired and new ones (with a fresh snapshot of the
+        state, with the persistent data preloaded, see PyminDaemon.preload())
+        are forked.
+        """
+        log.debug(u'WorkerPool.refork()')
+        self.daemon.preload()
+        self._retire()
+        self._snapshot = self.version.get()
+        self._snapshot_time = eventloop.monotonic()
+        for i in range(self.size):
+            self._spawn()
+
+    def _spawn(self):
+        r"_spawn() -> None :: Fork a new worker."
+        (link, child_link) = _link_pair()
+        pid = os.fork()
+        if pid == 0:
+            self._worker_main(child_link)
+        log.debug(u'WorkerPool._spawn: worker %d forked', pid)
+        child_link.close()
+        self.workers[link] = pid
+        self.daemon.add_reader(link, self._handle_link, link)
+
+    def _worker_main(self, link):
+        r"_worker_main(link) -> never returns :: Worker process entry point."
+        status = 0
+        try:
+            addr = self.daemon.file.getsockname()
+            # responses are sent using the writer socket, so the worker socket
+            # can be closed when the worker is retired
+            out = socket.fromfd(self.daemon.file.fileno(), socket.AF_INET,
+                                socket.SOCK_DGRAM)
+            self.close_after_fork()
+            self.daemon.close_after_fork()
+            sock = udp_socket(addr, reuseport=True)
+            worker = Worker(self.daemon, sock, link, self.version, out)
+            worker.loop()
+        except eventloop.LoopInterruptedError, e:
+            log.debug(u'Worker: interrupted')
+        except:
+            log.exception(u'Worker: unhandled exception')
+            status = 1
+        os._exit(status)
+
+    def _retire(self):
+        r"_retire() -> None :: Retire all the active workers."
+        for (link, pid) in self.workers.items():
+            log.debug(u'WorkerPool._retire: retiring worker %d', pid)
+            try:
+                link.send(_retire_message)
+            except socket.error, e:
+                log.debug(u'WorkerPool._retire: error %r', e)
+                self._kill(pid)
+            self.retired[link] = pid
+        self.workers.clear()
+
+    def _kill(self, pid):
+        r"_kill(pid) -> None :: Ask a worker to exit."
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _reap(self, pid):
+        r"""_reap(pid) -> None :: Wait for a worker that closed its link.
+
+        Workers are reaped here (not by the daemon SIGCHLD handler, which
+        only reaps the processes it started, see pymin.procman). The link is
+        closed only when the worker exits, so this doesn't block.
+        """
+        while True:
+            try:
+                os.waitpid(pid, 0)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+            return
+
+    def _handle_link(self, link):
+        r"_handle_link(link) -> None :: Handle requests forwarded by a worker."
+        while True:
+            try:
+                data = link.recv(LINK_BUFFER)
+            except socket.error, e:
+                if e.args[0] in transport._retry_errors:
+                    return
+                log.debug(u'WorkerPool._handle_link: error %r', e)
+                data = ''
+            if not data:
+                pid = self.workers.pop(link, None) or self.retired.pop(link)
+                log.debug(u'WorkerPool._handle_link: worker %d exited', pid)
+                self.daemon.remove_reader(link)
+                link.close()
+                self._reap(pid)
+                return
+            if data.startswith(_metrics_message):
+                self.daemon.metrics.merge(pickle.loads(
+                                        data[len(_metrics_message):]))
+                continue
+            (req_id, msg) = data.split('\n', 1)
+            log.debug(u'WorkerPool._handle_link: request %s: %r', req_id, msg)
+            self.daemon.process(msg, self._make_reply(link, req_id))
+
+    def _make_reply(self, link, req_id):
+        r"_make_reply(link, req_id) -> callable :: Make a reply() function."
+        def reply(response):
+            if link not in self.workers and link not in self.retired:
+                # the worker is gone
+                return
+            try:
+                link.send('%s\n%s' % (req_id, self.daemon.datagram(response)))
+            except socket.error, e:
+                log.warning(u"WorkerPool: can't send response to worker: %s",
+                                e)
+        return reply
+
+    def close(self):
+        r"close() -> None :: Ask all the workers to exit."
+        log.debug(u'WorkerPool.close()')
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._retire()
+        for link in self.retired.keys():
+            self.daemon.remove_reader(link)
+            link.close()
+        self.retired.clear()
+
+    def close_after_fork(self):
+        r"""close_after_fork() -> None :: Release the pool in a child process.
+
+        Only the child's copies of the links are closed (see
+        EventLoop.close_after_fork()).
+        """
+        for link in self.workers.keys() + self.retired.keys():
+            link.close()
+        self.workers.clear()
+        self.retired.clear()
+
+
+if __name__ == '__main__':
+
+    import time
+    import random
+    from pymin import dispatcher
+    from pymin.pymindaemon import PyminDaemon
+
+    logging.basicConfig(level=logging.ERROR)
+
+    class Root(dispatcher.Handler):
+        value = 0
+        @dispatcher.handler(u'Show the value and the pid of the process.')
+        def show(self):
+            # slow, so there are requests queued when workers are retired
+            time.sleep(0.001)
+            return (self.value, os.getpid())
+        @dispatcher.handler(u'Set the value.')
+        def set(self, value):
+            self.value = int(value)
+
+    if not reuseport_available():
+        print 'SO_REUSEPORT is not available, skipping'
+        raise SystemExit(0)
+    addr = ('127.0.0.1', random.randint(20000, 40000))
+    pid = os.fork()
+    if pid == 0:
+        # no cache, so responses tell which process served them
+        d = PyminDaemon(Root(), addr, workers=3, cache_size=0)
+        # replace the workers all the time
+        d.pool.refork_delay = 0.05
+        d.pool.max_age = 0.1
+        d.run()
+        os._exit(0)
+    try:
+        time.sleep(1)
+        # several clients, so the requests are spread over all the workers
+        socks = list()
+        for i in range(16):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.settimeout(2)
+            socks.append(sock)
+        pids = set()
+        lost = 0
+        end = time.time() + 3
+        n = 0
+        while time.time() < end:
+            n += 1
+            if n % 50 == 0:
+                socks[0].sendto('set %d' % n, addr)
+                assert socks[0].recvfrom(65535)[0] == 'OK 0\n'
+            for sock in socks:
+                for i in range(2):
+                    sock.sendto('show', addr)
+            for sock in socks:
+                for i in range(2):
+                    try:
+                        r = sock.recvfrom(65535)[0]
+                    except socket.timeout:
+                        lost += 1
+                        continue
+                    assert r.startswith('OK '), r
+                    pids.add(int(r.split('\n')[1].split(',')[1]))
+        print 'requests:', n * 32, 'lost:', lost, 'processes:', len(pids)
+        assert lost == 0, lost
+        assert len(pids) > 4, pids
+        # the requests served by the workers are in the daemon metrics
+        time.sleep(Worker.metrics_interval * 1.5)
+        socks[0].sendto('pymin stats', addr)
+        stats = socks[0].recvfrom(65535)[0].split('\n', 1)[1]
+        shows = [l for l in stats.split('\r\n') if l.startswith('show,')]
+        assert shows and shows[0].split(',')[1] == str(n * 32), (stats, n)
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
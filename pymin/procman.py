@@ -168,53 +168,55 @@ class ProcessManager:
         return False
 
     def sigchild_handler(self, signum, stack_frame=None):
+        r"""sigchild_handler(signum[, stack_frame]) -> None :: Reap children.
+
+        Only the processes started by the manager are reaped (waiting for
+        each registered PID), so children created by others (like commands
+        run by subprocess in other threads, which wait for them themselves)
+        are never stolen from them.
+        """
         log.debug(u'ProcessManager.sigchild_handler(%s)', signum)
-        try:
-            (pid, status) = os.waitpid(-1, os.WNOHANG)
-        except OSError, e:
-            log.debug(u'ProcessManager.sigchild_handler(): OSError')
-            if e.errno is errno.ECHILD:
-                log.debug(u'ProcessManager.sigchild_handler(): OSError ECHILD')
-                return
-            raise
-        log.debug(u'ProcessManager.sigchild_handler: pid=%s, status=%s',
-                      pid, status)
-        while pid:
-            if pid in self.pidmap:
-                p = self.pidmap[pid]
-                p.process.returncode = status
-                if p.callback is not None:
-                    log.debug(u'ProcessManager.sigchild_handler: '
-                                  u'calling %s(%s)', p.callback.__name__, p)
-                    p.callback(self, p)
-                if (p._dont_run or not p.persist
-                                or p._error_count >= p.max_errors):
-                    log.debug(u"ProcessManager.sigchild_handler: can't "
-                            u'persist, dont_run=%s, persist=%s, error_cout=%s, '
-                            u'max_errors=%s', p._dont_run, p.persist,
-                            p._error_count, p.max_errors)
-                    del self.namemap[p.name]
-                    del self.pidmap[pid]
-                    p.clear()
-                else:
-                    log.debug(u'ProcessManager.sigchild_handler: persist')
-                    if p.process.returncode == 0:
-                        p._error_count = 0
-                        log.debug(u'ProcessManager.sigchild_handler: '
-                                u'return OK, resetting error_count')
-                    else:
-                        p._error_count += 1
-                        log.debug(u'ProcessManager.sigchild_handler: return'
-                                u'not 0, error_count + 1 = %s', p._error_count)
-                    del self.pidmap[pid]
-                    p.restart()
-                    self.pidmap[p.process.pid] = p
+        for pid in self.pidmap.keys():
             try:
-                (pid, status) = os.waitpid(-1, os.WNOHANG)
+                (pid, status) = os.waitpid(pid, os.WNOHANG)
             except OSError, e:
                 if e.errno == errno.ECHILD:
-                    return
+                    log.debug(u'ProcessManager.sigchild_handler(): OSError '
+                                u'ECHILD for pid %s', pid)
+                    continue
                 raise
+            if not pid:
+                continue
+            log.debug(u'ProcessManager.sigchild_handler: pid=%s, status=%s',
+                          pid, status)
+            p = self.pidmap[pid]
+            p.process.returncode = status
+            if p.callback is not None:
+                log.debug(u'ProcessManager.sigchild_handler: '
+                              u'calling %s(%s)', p.callback.__name__, p)
+                p.callback(self, p)
+            if (p._dont_run or not p.persist
+                            or p._error_count >= p.max_errors):
+                log.debug(u"ProcessManager.sigchild_handler: can't "
+                        u'persist, dont_run=%s, persist=%s, error_cout=%s, '
+                        u'max_errors=%s', p._dont_run, p.persist,
+                        p._error_count, p.max_errors)
+                del self.namemap[p.name]
+                del self.pidmap[pid]
+                p.clear()
+            else:
+                log.debug(u'ProcessManager.sigchild_handler: persist')
+                if p.process.returncode == 0:
+                    p._error_count = 0
+                    log.debug(u'ProcessManager.sigchild_handler: '
+                            u'return OK, resetting error_count')
+                else:
+                    p._error_count += 1
+                    log.debug(u'ProcessManager.sigchild_handler: return'
+                            u'not 0, error_count + 1 = %s', p._error_count)
+                del self.pidmap[pid]
+                p.restart()
+                self.pidmap[p.process.pid] = p
 
     def get(self, name):
         if isinstance(name, basestring): # is a name
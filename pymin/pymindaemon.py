@@ -8,7 +8,9 @@ to administrate a set of services remotely (or localy) throw a simple
 command-line.
 """
 
+import errno
 import signal
+import collections
 import socket
 import formencode
 import logging ; log = logging.getLogger('pymin.pymindaemon')
@@ -18,9 +20,50 @@ from pymin import dispatcher
 from pymin import eventloop
 from pymin import serializer
 from pymin import procman
+from pymin import transport
+from pymin import prefork
+from pymin import metrics
+from pymin import cache
+from pymin.executor import Executor, Future, Return, coroutine, chain
+
+class PyminHandler(dispatcher.Handler):
+    r"""PyminHandler(daemon) -> PyminHandler instance :: Daemon commands.
+
+    Handler with commands about the PyminDaemon 'daemon' itself. The daemon
+    adds it to the root handler as 'pymin'.
+    """
+
+    handler_help = u"Show the pymin daemon status"
+
+    def __init__(self, daemon):
+        r"""Initialize the PyminHandler object.
+
+        See PyminHandler class documentation for more info.
+        """
+        self.daemon = daemon
+
+    @handler(u'Show requests metrics: command, requests, errors, and mean, '
+             u'50 and 99 percentiles and maximum time (in milliseconds) spent '
+             u'in PHASE (parse, route, queue, execute, serialize, send or '
+             u'total, the default). Requests served by workers are included '
+             u'about a second after they are served')
+    def stats(self, phase=u'total'):
+        if phase not in metrics.Metrics.phases:
+            raise dispatcher.HandlerError(u'Unknown phase "%s"' % phase)
+        return self.daemon.metrics.rows(phase)
+
+    @handler(u'Show the responses cache status: responses, bytes used, '
+             u'maximum bytes, hits and misses')
+    def cache(self):
+        c = self.daemon.cache
+        if c is None:
+            raise dispatcher.HandlerError(u'Responses cache disabled')
+        return (len(c), c.size, c.max_size, c.hits, c.misses)
 
 class PyminDaemon(eventloop.EventLoop):
-    r"""PyminDaemon(root, bind_addr) -> PyminDaemon instance
+    r"""PyminDaemon(root[, bind_addr[, timer[, background[, stream_addr[,
+    unix_path[, workers[, send_limit[, send_policy[, metrics_path[,
+    cache_size]]]]]]]]]]) -> PyminDaemon instance
 
     This class is well suited to run as a single process. It handles
     signals for controlled termination (SIGINT and SIGTERM), as well as
@@ -30,6 +73,54 @@ class PyminDaemon(eventloop.EventLoop):
 
     bind_addr - is a tuple of (ip, port) where to bind the UDP socket to.
 
+    timer - is the number of seconds between handle_timer() calls.
+
+    background - if True (the default), slow commands (see blocking_commands)
+    and the periodic handle_timer() calls are run in a background worker
+    thread, so they don't block other clients' requests. To keep the
+    handlers state consistent, only one background job runs at a time, and
+    while there are background jobs pending, all other commands that are not
+    read-only (see readonly_commands) are queued behind them. Read-only
+    commands are served immediately if their response is cached, if not,
+    they wait until no background job is running (so they never see the
+    handlers state while it's being modified).
+
+    stream_addr - is a tuple of (ip, port) where to bind a TCP socket to (see
+    bellow). If it's None (the default), no TCP socket is used.
+
+    unix_path - is the path where to bind a UNIX stream socket to (see
+    bellow). If it's None (the default), no UNIX socket is used.
+
+    workers - is the number of worker processes to fork to serve read-only
+    commands received using UDP in parallel (see pymin.prefork). Workers
+    use a snapshot of the handlers state, and forward all the other commands
+    to this process, which is the only one that modifies the state. The
+    persistent data not loaded yet is loaded before forking them (see
+    preload()). If it's 0 (the default), no workers are used.
+
+    send_limit - is the maximum number of bytes of UDP responses to queue
+    when the socket can't send them right away (because the socket send
+    buffer is full), so a slow network never blocks the daemon.
+
+    send_policy - is the policy used to drop responses when there are
+    send_limit bytes queued. 'oldest' (the default) drops the oldest queued
+    responses, 'newest' drops the new ones (see
+    pymin.transport.DatagramSender).
+
+    metrics_path - is the path of a UNIX socket where to serve the requests
+    metrics in Prometheus text format (see pymin.metrics). If it's None (the
+    default), the metrics are only available using the 'pymin stats'
+    command. The metrics include the requests served by the workers (see
+    pymin.prefork).
+
+    cache_size - is the maximum number of bytes used to cache the responses
+    of read-only commands (see pymin.cache). The cache is valid while the
+    state doesn't change: it's discarded each time a command that is not
+    read-only is received, each time a background job finishes and each
+    time the periodic handle_timer() calls report the handlers state changed
+    (see dispatcher.Handler.handle_timer()). If it's 0, responses are not
+    cached. The default is 4MiB.
+
     Here is a simple usage example:
 
     >>> from pymin import dispatcher
@@ -49,7 +140,35 @@ class PyminDaemon(eventloop.EventLoop):
         CSV MESSAGE
 
     So, first is a response code (OK or ERROR), then it comes the length of
-    the CSV MESSAGE (the bufer needed to receive the rest of the message).
+    the CSV MESSAGE in bytes (the bufer needed to receive the rest of the
+    message).
+
+    UDP messages are limited in size, so large responses can't be sent using
+    UDP. That's why the daemon can listen for connections in a TCP and/or
+    UNIX stream socket too (see stream_addr and unix_path). In that case,
+    requests are newline terminated commands and responses use the same
+    syntax used for UDP. Connections are persistent and many commands can be
+    sent without waiting for the responses (see pymin.transport for details).
+
+    Many commands can be executed using a single request (and getting
+    a single response) using a batch request. A batch request starts with
+    a line with '@batch', followed by one command per line, and ends with
+    a line with '@end' (which can be omitted in UDP messages). The commands
+    are executed in order and the response is an OK response whose CSV
+    MESSAGE is the concatenation of the responses of each command (with the
+    format described above). For example::
+
+        @batch
+        dhcp host add my-pc 192.168.0.10 00:11:22:33:44:55
+        dhcp host show my-pc
+        @end
+
+    Could be replied with::
+
+        OK 49
+        OK 0
+        OK 38
+        my-pc,192.168.0.10,00:11:22:33:44:55\r\n
 
     CSV MESSAGE is the body of the response, which it could be void (if lenght
     is 0), a simple string (a CVS with only one column and row), a single row
@@ -66,20 +185,63 @@ class PyminDaemon(eventloop.EventLoop):
 
     All messages (requests and responses) should be UTF-8 encoded and the CVS
     responses are formated in "Excel" format, as known by the csv module.
+
+    A command can be prefixed with '@FORMAT' to get the body of an OK
+    response in another format (ERROR responses are not affected). FORMAT
+    can be any of the pymin.serializer formats, for now 'csv' (the default)
+    or 'msgpack' (a MessagePack array of rows, where each row is an array
+    of typed values). For example::
+
+        @msgpack dhcp host show my-pc
+
+    Inside a batch request, each command can use its own format.
+
+    Handlers can be asynchronous, returning a pymin.executor.Future (see
+    pymin.executor.coroutine for an easy way to write them). The response is
+    sent when the future is done, and meanwhile other requests are served.
+    While commands that are not read-only are pending, other commands that
+    are not read-only are queued behind them (read-only commands are served
+    immediately). Asynchronous commands are always served by this process
+    (never by the workers).
     """
 
-    def __init__(self, root, bind_addr=('', 9999), timer=1):
+    # Commands that can take a long time (usually because they run external
+    # programs), executed in background
+    blocking_commands = frozenset(('commit', 'start', 'stop', 'restart',
+                                   'reload'))
+
+    # Commands that don't modify the handlers state, always executed
+    # immediately
+    readonly_commands = frozenset(('help', 'commands', 'show', 'list', 'get',
+                                   'len', 'running', 'stats', 'cache'))
+
+    # Read-only commands about the daemon itself, always executed by the main
+    # process (never by the workers, see pymin.prefork) and never cached
+    live_commands = frozenset(('stats', 'cache'))
+
+    # Lines that start and end a batch request
+    batch_start = '@batch'
+    batch_end = '@end'
+
+    # Prefix of a command to select the response format
+    format_prefix = '@'
+
+    def __init__(self, root, bind_addr=('', 9999), timer=1, background=True,
+                 stream_addr=None, unix_path=None, workers=0,
+                 send_limit=1048576, send_policy='oldest', metrics_path=None,
+                 cache_size=4194304):
         r"""Initialize the PyminDaemon object.
 
         See PyminDaemon class documentation for more info.
         """
-        log.debug(u'PyminDaemon(%r, %r, %r)', root, bind_addr, timer)
+        log.debug(u'PyminDaemon(%r, %r, %r, %r, %r, %r, %r, %r, %r, %r, %r)',
+                    root, bind_addr, timer, background, stream_addr,
+                    unix_path, workers, send_limit, send_policy, metrics_path,
+                    cache_size)
         # Timer timeout time
         self.timer = timer
         # Create and bind socket
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind(bind_addr)
+        sock = prefork.udp_socket(bind_addr, reuseport=bool(workers))
         # Signal handling
         def quit(loop, signum):
             log.debug(u'PyminDaemon quit() handler: signal %r', signum)
@@ -89,9 +251,6 @@ class PyminDaemon(eventloop.EventLoop):
             log.debug(u'PyminDaemon reload_config() handler: signal %r', signum)
             log.info(u'Reloading configuration...')
             # TODO iterate handlers list propagating reload action
-        def timer(loop, signum):
-            loop.handle_timer()
-            signal.alarm(loop.timer)
         def child(loop, signum):
             procman.sigchild_handler(signum)
         # Create EventLoop
@@ -99,57 +258,607 @@ class PyminDaemon(eventloop.EventLoop):
                 signal.SIGINT: quit,
                 signal.SIGTERM: quit,
                 signal.SIGUSR1: reload_config,
-                signal.SIGALRM: timer,
                 signal.SIGCHLD: child,
             })
+        # Queue of responses waiting to be sent
+        self.sender = transport.DatagramSender(self, sock, send_limit,
+                                               send_policy)
+        # Requests metrics
+        self.metrics = metrics.Metrics()
+        self.metrics_server = None
+        if metrics_path is not None:
+            self.metrics_server = metrics.PrometheusServer(self, metrics_path,
+                                                           self.metrics)
+        # Responses cache, and version of the handlers state (incremented
+        # each time the state may have changed)
+        self.cache = None
+        if cache_size:
+            self.cache = cache.ResponseCache(cache_size)
+        self.version = 0
         # Create Dispatcher
-        #TODO root.pymin = PyminHandler()
+        root.pymin = PyminHandler(self)
         self.dispatcher = dispatcher.Dispatcher(root)
+        # Background jobs executor
+        self.executor = None
+        if background:
+            self.executor = Executor(self)
+        # Number of background jobs not finished yet
+        self._background_jobs = 0
+        self._timer_pending = False
+        # Number of asynchronous commands (that are not read-only) not
+        # finished yet, and functions waiting for them to finish
+        self._async_jobs = 0
+        self._deferred = collections.deque()
+        # Read-only commands waiting for the background jobs to finish
+        self._idle_waiters = collections.deque()
+        # Stream servers
+        self.servers = list()
+        if stream_addr is not None:
+            self.servers.append(transport.StreamServer(self,
+                        transport.tcp_listener(stream_addr), self.process))
+        if unix_path is not None:
+            self.servers.append(transport.StreamServer(self,
+                        transport.unix_listener(unix_path), self.process))
+        # Worker processes
+        self.pool = None
+        if workers:
+            self.pool = prefork.WorkerPool(self, workers)
 
     def handle(self):
         r"handle() -> None :: Handle incoming events using the dispatcher."
-        (msg, addr) = self.file.recvfrom(65535)
+        try:
+            (msg, addr) = self.file.recvfrom(65535)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            raise
         log.debug(u'PyminDaemon.handle: message %r from %r', msg, addr)
-        response = u'ERROR'
+        def reply(response):
+            response = self.datagram(response)
+            log.debug(u'PyminDaemon.handle: response %r to %r', response,
+                        addr)
+            self.sender.send(addr, response)
+        self.process(msg, reply)
+
+    def datagram(self, response):
+        r"""datagram(response) -> str :: Build a UDP response datagram.
+
+        response is a list of strings, as built by response(). If it's too
+        big to fit in a UDP datagram, an ERROR response is returned instead,
+        so at least the client knows what happened.
+        """
+        response = ''.join(response)
+        if len(response) > 65507:
+            log.warning(u'PyminDaemon.datagram: response too big (%d bytes)',
+                        len(response))
+            response = ''.join(self._format_response('ERROR',
+                                'Response too big, use a stream socket.\n'))
+        return response
+
+    def process(self, msg, reply):
+        r"""process(msg, reply) -> None :: Process a request message.
+
+        The (UTF-8 encoded) message is dispatched and reply(response) is
+        called with the response, a list of (UTF-8 encoded) strings. If the
+        command is executed in background, reply() is called after this method
+        returns.
+        """
+        sample = self.metrics.sample()
+        if msg.split('\n', 1)[0].strip() == self.batch_start:
+            self.process_batch(msg, reply, sample)
+            return
+        try:
+            (format, msg) = self.split_format(msg)
+            (route, kwargs) = dispatcher.parse_command(unicode(msg, 'utf-8'))
+            sample.lap('parse')
+            (handler, command, args, kwargs) = self.dispatcher.lookup(route,
+                                                                    kwargs)
+            sample.lap('route')
+        except Exception, e:
+            self._reply(reply, self.error_response(e), sample, u'<invalid>')
+            return
+        changing = self._changing(command)
+        if changing and self._async_jobs:
+            log.debug(u'PyminDaemon.process: %r waits for asynchronous '
+                        u'commands', command)
+            def deferred():
+                sample.lap('queue')
+                self._execute(handler, command, args, kwargs, sample, format,
+                              reply, changing)
+            self._deferred.append(deferred)
+            return
+        if not changing and self._background_jobs \
+                and command[-1] not in self.live_commands:
+            response = self.cached_response(command, args, kwargs, format)
+            if response is not None:
+                self._reply(reply, response, sample, u' '.join(command))
+                return
+            log.debug(u'PyminDaemon.process: %r waits for background jobs',
+                        command)
+            def waiter():
+                sample.lap('queue')
+                self._execute(handler, command, args, kwargs, sample, format,
+                              reply, changing)
+            self._idle_waiters.append(waiter)
+            return
+        self._execute(handler, command, args, kwargs, sample, format, reply,
+                      changing)
+
+    def _execute(self, handler, command, args, kwargs, sample, format, reply,
+                 changing):
+        r"""_execute(handler, command, args, kwargs, sample, format, reply,
+        changing) -> None :: Execute a resolved command.
+
+        See process() for details.
+        """
+        if changing:
+            # responses cached since the command was received (while it was
+            # deferred) are about to be stale too
+            self.version += 1
+        path = u' '.join(command)
+        if self.in_background(command):
+            log.debug(u'PyminDaemon.process: running %r in background',
+                        command)
+            def job():
+                sample.lap('queue')
+                return self.call(handler, args, kwargs, sample, format)
+            future = self._submit(job)
+            future.add_done_callback(lambda f: self._reply(reply, f.result(),
+                                                    sample, path, changing))
+            return
+        self._reply(reply, self.cached_call(handler, command, args, kwargs,
+                                    sample, format), sample, path, changing)
+
+    def split_format(self, msg):
+        r"""split_format(msg) -> (format, msg) :: Get the response format.
+
+        If the (UTF-8 encoded) command msg starts with the format prefix,
+        the format name and the rest of the command are returned. If not,
+        the default format ('csv') and the command are returned. A
+        dispatcher.ParseError is raised if the format is unknown.
+        """
+        msg = msg.lstrip()
+        if not msg.startswith(self.format_prefix):
+            return ('csv', msg)
+        parts = msg.split(None, 1)
+        format = parts[0][len(self.format_prefix):]
+        if format not in serializer.formats:
+            raise dispatcher.ParseError(unicode(parts[0], 'utf-8', 'replace'),
+                                        u'unknown response format')
+        return (format, ''.join(parts[1:]))
+
+    def _reply(self, reply, response, sample, path, changing=False):
+        r"""_reply(reply, response, sample, path[, changing]) -> None :: Reply.
+
+        reply(response) is called and the request metrics are recorded (using
+        the metrics.Sample sample) for the command path. If response is
+        a Future (the command is asynchronous), this is done when the future
+        is done, and if the command can change the handlers state (changing
+        is True), it's considered a background job until then, and other
+        commands that can change the state wait for it (see process()).
+        """
+        if isinstance(response, Future):
+            log.debug(u'PyminDaemon._reply: waiting for %r', path)
+            response.add_done_callback(lambda f: self._reply(reply,
+                                                    f.result(), sample, path))
+            if changing:
+                self._async_jobs += 1
+                self._track(response)
+                response.add_done_callback(self._async_done)
+            return
+        reply(response)
+        sample.lap('send')
+        sample.done(path, response[0].startswith('ERROR'))
+
+    def _async_done(self, future):
+        r"""_async_done(future) -> None :: An asynchronous command finished.
+
+        When there are no more asynchronous commands pending, the deferred
+        commands are executed (in order) until one of them is asynchronous.
+        """
+        self._async_jobs -= 1
+        while self._deferred and not self._async_jobs:
+            self._deferred.popleft()()
+
+    def process_batch(self, msg, reply, sample):
+        r"""process_batch(msg, reply, sample) -> None :: Process a batch.
+
+        The first line of the message is the batch start line and each of the
+        following lines (up to an optional batch end line) is a command.
+        Commands are executed in order and reply(response) is called only
+        once, when all of them are done (see call_batch() for the response
+        format).
+
+        If any of the commands should be executed in background, the whole
+        batch is executed in background. The metrics of the batch are recorded
+        as a whole (using the metrics.Sample sample) as the '@batch' command.
+        """
+        commands = list()
+        changing = False
+        for line in msg.split('\n')[1:]:
+            line = line.strip()
+            if line == self.batch_end:
+                break
+            if not line:
+                continue
+            try:
+                (format, line) = self.split_format(line)
+                c = self.dispatcher.resolve(unicode(line, 'utf-8'))
+            except Exception, e:
+                commands.append(self.error_response(e))
+                continue
+            commands.append(c + (format,))
+            changing = self._changing(c[1]) or changing
+        log.debug(u'PyminDaemon.process_batch: %d commands', len(commands))
+        sample.lap('route')
+        if changing and self._async_jobs:
+            log.debug(u'PyminDaemon.process_batch: waits for asynchronous '
+                        u'commands')
+            def deferred():
+                sample.lap('queue')
+                self._execute_batch(commands, sample, reply, changing)
+            self._deferred.append(deferred)
+            return
+        if not changing and self._background_jobs:
+            log.debug(u'PyminDaemon.process_batch: waits for background jobs')
+            def waiter():
+                sample.lap('queue')
+                self._execute_batch(commands, sample, reply, changing)
+            self._idle_waiters.append(waiter)
+            return
+        self._execute_batch(commands, sample, reply, changing)
+
+    def _execute_batch(self, commands, sample, reply, changing):
+        r"""_execute_batch(commands, sample, reply, changing) -> None
+
+        Execute a batch of resolved commands, see process_batch() for details.
+        """
+        if changing:
+            # see _execute()
+            self.version += 1
+        background = False
+        for c in commands:
+            if isinstance(c, tuple):
+                background = background or self.in_background(c[1])
+        if background:
+            log.debug(u'PyminDaemon.process_batch: running in background')
+            def job():
+                sample.lap('queue')
+                return self.call_batch(commands, sample)
+            future = self._submit(job)
+            future.add_done_callback(lambda f: self._reply(reply, f.result(),
+                                                sample, u'@batch', changing))
+            return
+        self._reply(reply, self.call_batch(commands, sample), sample,
+                    u'@batch', changing)
+
+    def call_batch(self, commands, sample=None):
+        r"""call_batch(commands[, sample]) -> list :: Call handlers, get response.
+
+        commands is a list of (handler, command, args, kwargs, format) tuples
+        (as returned by Dispatcher.resolve(), plus the response format) or
+        already built responses (for commands that couldn't be resolved).
+        The handlers are called in order and the response is an OK response
+        whose body is the concatenation of the responses of all the commands
+        (in the same order), so the status of each command is reported.
+
+        If sample (a metrics.Sample) is not None, the time spent executing
+        the commands is recorded.
+
+        If any of the commands is asynchronous, a Future is returned instead,
+        and the following commands are called when it's done.
+        """
+        future = self._call_batch(commands, sample)
+        if future.done():
+            return future.result()
+        return future
+
+    @coroutine
+    def _call_batch(self, commands, sample):
+        r"_call_batch(commands, sample) -> Future :: See call_batch()."
+        body = list()
+        for c in commands:
+            if isinstance(c, tuple):
+                (handler, command, args, kwargs, format) = c
+                c = self.call(handler, args, kwargs, format=format)
+                if isinstance(c, Future):
+                    c = yield c
+            body.extend(c)
+        if sample is not None:
+            sample.lap('execute')
+        raise Return(['OK %d\n' % sum([len(chunk) for chunk in body])]
+                     + body)
+
+    def _changing(self, command):
+        r"""_changing(command) -> bool :: Take note of commands to be executed.
+
+        If the command can modify the handlers state, the state version is
+        incremented (so cached responses are discarded), the workers (if
+        any) are told to stop using their snapshots of the state and True is
+        returned.
+        """
+        if command[-1] in self.readonly_commands:
+            return False
+        self.version += 1
+        if self.pool is not None:
+            self.pool.changed()
+        return True
+
+    def idle(self):
+        r"idle() -> bool :: Tell if there are no background jobs running."
+        return self._background_jobs == 0
+
+    def preload(self):
+        r"""preload() -> None :: Load the persistent data of the handlers.
+
+        The hot persistent attributes of the handlers not loaded yet are
+        loaded (see pymin.service.util.Persistent), so the workers forked
+        later share them instead of loading them again each one. Errors are
+        only logged (they will show up when the data is used).
+        """
+        seen = set()
+        pending = [self.dispatcher.root]
+        while pending:
+            h = pending.pop()
+            if id(h) in seen:
+                continue
+            seen.add(id(h))
+            if hasattr(h, '_persistent_preload'):
+                try:
+                    h._persistent_preload()
+                except Exception:
+                    log.exception(u'PyminDaemon.preload: error loading %r', h)
+            pending.extend([s for (a, s) in h._routes()
+                                if isinstance(s, dispatcher.Handler)])
+
+    def in_background(self, command):
+        r"""in_background(command) -> bool :: Tell if command goes background.
+
+        command is the list of path components of the command (as returned
+        by Dispatcher.resolve()).
+        """
+        if self.executor is None:
+            return False
+        name = command[-1]
+        if name in self.readonly_commands:
+            return False
+        return name in self.blocking_commands or self._background_jobs > 0
+
+    def cached_call(self, handler, command, args, kwargs, sample=None,
+                    format='csv'):
+        r"""cached_call(handler, command, args, kwargs[, sample[, format]])
+
+        Same as call(), but OK responses of read-only commands (except the
+        live_commands) are cached, so calling the same command (with the same
+        arguments and format) again returns the cached response while the
+        state version doesn't change. command is the list of path components
+        of the command (as returned by Dispatcher.resolve()). Responses of
+        asynchronous commands are cached when they are done.
+        """
+        key = self._cache_key(command, args, kwargs, format)
+        if key is None:
+            return self.call(handler, args, kwargs, sample, format)
+        response = self.cache.get(self.version, key)
+        if response is not None:
+            log.debug(u'PyminDaemon.cached_call: %r cached', command)
+            return response
+        version = self.version
+        response = self.call(handler, args, kwargs, sample, format)
+        if isinstance(response, Future):
+            def done(f):
+                if f.result()[0].startswith('OK'):
+                    self.cache.put(version, key, f.result())
+            response.add_done_callback(done)
+        elif response[0].startswith('OK'):
+            self.cache.put(version, key, response)
+        return response
+
+    def cached_response(self, command, args, kwargs, format='csv'):
+        r"""cached_response(command, args, kwargs[, format]) -> list/None
+
+        Get the cached response of a command (see cached_call()), or None if
+        it's not cached.
+        """
+        key = self._cache_key(command, args, kwargs, format)
+        if key is None:
+            return None
+        return self.cache.get(self.version, key)
+
+    def _cache_key(self, command, args, kwargs, format):
+        r"""_cache_key(command, args, kwargs, format) -> tuple/None
+
+        Get the key of the cached response of a command, or None if the
+        response of the command can't be cached.
+        """
+        name = command[-1]
+        if (self.cache is None or name not in self.readonly_commands
+                or name in self.live_commands):
+            return None
+        kwitems = kwargs.items()
+        kwitems.sort()
+        return (format, tuple(command), tuple(args), tuple(kwitems))
+
+    def call(self, handler, args, kwargs, sample=None, format='csv'):
+        r"""call(handler, args, kwargs[, sample[, format]]) -> list :: Call.
+
+        The handler is called with the positional and keyword arguments args
+        and kwargs. The result (or error) is serialized (using the format
+        format) to build a response. If sample (a metrics.Sample) is not
+        None, the time spent executing the handler and serializing the result
+        is recorded.
+
+        If the handler is asynchronous (it returns a Future), a Future is
+        returned, which holds the response when the handler is done.
+        """
+        return self._respond(lambda: handler(*args, **kwargs), sample, format)
+
+    def _respond(self, get_result, sample, format):
+        r"""_respond(get_result, sample, format) -> list/Future :: Respond.
+
+        Build the response for the result returned by get_result() (or the
+        exception raised by it). See call() for details.
+        """
+        try:
+            result = get_result()
+        except Exception, e:
+            if sample is not None:
+                sample.lap('execute')
+            return self.error_response(e)
+        if isinstance(result, Future):
+            log.debug(u'PyminDaemon.call: waiting for %r', result)
+            return chain(result,
+                         lambda f: self._respond(f.result, sample, format))
+        if sample is not None:
+            sample.lap('execute')
         try:
-            result = self.dispatcher.dispatch(unicode(msg, 'utf-8'))
-            if result is not None:
-                result = unicode(serializer.serialize(result), 'utf-8')
-            response = u'OK'
-        except dispatcher.Error, e:
+            response = self.response(result, format)
+        except Exception, e:
+            response = self.error_response(e)
+        if sample is not None:
+            sample.lap('serialize')
+        return response
+
+    def response(self, result, format='csv'):
+        r"""response(result[, format]) -> list :: Build an OK response.
+
+        result is the value returned by a handler, serialized using the
+        format format (see pymin.serializer). The response is returned as
+        a list of (UTF-8 encoded) strings.
+        """
+        if result is not None:
+            result = list(serializer.iterserialize(result, format=format))
+        return self._format_response('OK', result)
+
+    def error_response(self, e):
+        r"""error_response(e) -> list :: Build an ERROR response.
+
+        This method should be called inside the except clause that caught the
+        exception e, so unexpected errors are properly logged. The response is
+        returned as a list of (UTF-8 encoded) strings.
+        """
+        if isinstance(e, dispatcher.Error):
             result = unicode(e) + u'\n'
-        except formencode.Invalid, e:
+        elif isinstance(e, formencode.Invalid):
             if e.error_dict:
-                result = unicode(serializer.serialize(e.error_dict), 'utf-8')
+                result = list(serializer.iterserialize(e.error_dict))
             else:
                 result = unicode(e) + u'\n'
-        except Exception, e:
-            import traceback
+        else:
             result = u'Internal server error\n'
             log.exception(u'PyminDaemon.handle: unhandled exception')
+        if isinstance(result, unicode):
+            result = result.encode('utf-8')
+        return self._format_response('ERROR', result)
+
+    def _format_response(self, status, result):
+        r"""_format_response(status, result) -> list :: Frame a response.
+
+        result is the (UTF-8 encoded) body of the response, as a string or a
+        list of strings (chunks), or None if there is no body. The chunks are
+        used as they are, without joining them.
+        """
         if result is None:
-            response += u' 0\n'
-        else:
-            response += u' %d\n%s' % (len(result), result)
-        log.debug(u'PyminDaemon.handle: response %r to %r', response, addr)
-        self.file.sendto(response.encode('utf-8'), addr)
+            return ['%s 0\n' % status]
+        if isinstance(result, str):
+            result = [result]
+        size = 0
+        for chunk in result:
+            size += len(chunk)
+        return ['%s %d\n' % (status, size)] + result
+
+    def _submit(self, func, *args):
+        r"_submit(func[, *args]) -> Future :: Run func in background."
+        future = self.executor.submit(func, *args)
+        self._track(future)
+        return future
+
+    def _track(self, future, changed=None):
+        r"""_track(future[, changed]) -> None :: Track a background job.
+
+        The job is considered finished when the future is done, and then the
+        handlers state is assumed to be changed, unless changed(future)
+        returns False.
+        """
+        self._background_jobs += 1
+        def done(future):
+            if changed is None or changed(future):
+                # the job could have changed the state
+                self.version += 1
+            self._background_jobs -= 1
+            while self._idle_waiters and not self._background_jobs:
+                self._idle_waiters.popleft()()
+            if self._background_jobs == 0 and self.pool is not None:
+                # the workers may be waiting for us to be idle
+                self.pool.check()
+        future.add_done_callback(done)
 
     def handle_timer(self):
-        r"handle_timer() -> None :: Call handle_timer() on handlers."
-        self.dispatcher.root.handle_timer()
+        r"""handle_timer() -> None :: Call handle_timer() on handlers.
+
+        If background execution is enabled, the call is done in background
+        (unless the previous call is still pending). The state version is
+        incremented only if the handlers report their state changed.
+        """
+        if self.executor is None:
+            if self.dispatcher.root.handle_timer() is not False:
+                self.version += 1
+            return
+        if self._timer_pending:
+            log.debug(u'PyminDaemon.handle_timer: previous call pending')
+            return
+        self._timer_pending = True
+        future = self.executor.submit(self.dispatcher.root.handle_timer)
+        def changed(future):
+            try:
+                return future.result() is not False
+            except Exception:
+                return True
+        self._track(future, changed)
+        def done(future):
+            self._timer_pending = False
+            try:
+                future.result()
+            except Exception, e:
+                log.exception(u'PyminDaemon.handle_timer: unhandled exception')
+        future.add_done_callback(done)
 
     def run(self):
         r"run() -> None :: Run the event loop (shortcut to loop())"
         log.debug(u'PyminDaemon.loop()')
         # Start the timer
         self.handle_timer()
-        signal.alarm(self.timer)
+        self.call_every(self.timer, self.handle_timer)
+        # Start the workers
+        if self.pool is not None:
+            self.pool.start()
         # Loop
         try:
             return self.loop()
         except eventloop.LoopInterruptedError, e:
             log.debug(u'PyminDaemon.loop: interrupted')
             pass
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+            for server in self.servers:
+                server.close()
+            if self.metrics_server is not None:
+                self.metrics_server.close()
+            self.sender.close()
+            if self.executor is not None:
+                self.executor.shutdown()
+
+    def close_after_fork(self):
+        r"""close_after_fork() -> None :: Release the sockets in a child.
+
+        See EventLoop.close_after_fork() for details.
+        """
+        eventloop.EventLoop.close_after_fork(self)
+        self.file.close()
+        for server in self.servers:
+            server.close_after_fork()
+        if self.metrics_server is not None:
+            self.metrics_server.close_after_fork()
 
 if __name__ == '__main__':
 
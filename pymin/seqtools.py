@@ -28,8 +28,7 @@ class Sequence:
 
     def __iter__(self):
         r"iter(obj) -> iterator object :: Get iterator."
-        for i in self.as_tuple():
-            yield i
+        return iter(self.as_tuple())
 
     def __len__(self):
         r"len(obj) -> int :: Get object length."
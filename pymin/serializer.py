@@ -1,9 +1,21 @@
 # vim: set encoding=utf-8 et sw=4 sts=4 :
 
+import struct
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
 from pymin import ucsv
 from pymin import seqtools
 
-r"UTF-8 encoded CSV serializer."
+r"""UTF-8 encoded CSV serializer.
+
+Tables can be serialized in MessagePack format too (see iterserialize()), for
+clients that prefer typed values and don't want to parse CSV.
+"""
+
+__all__ = ('serialize', 'iterserialize', 'formats', 'msgpack_unpack')
 
 def serialize(obj, output=None):
     r"""serialize(obj[, output]) -> None/unicode string
@@ -14,17 +26,217 @@ def serialize(obj, output=None):
 
     obj is expected to be a sequence of sequences, i.e. a list of rows.
     """
-    stringio = False
     if output is None:
-        stringio = True
-        try:
-            from cStringIO import StringIO
-        except ImportError:
-            from StringIO import StringIO
-        output = StringIO()
-    ucsv.writer(output).writerows(seqtools.as_table(obj))
-    if stringio:
-        return output.getvalue()
+        return ''.join(iterserialize(obj))
+    for chunk in iterserialize(obj):
+        output.write(chunk)
+
+def iterserialize(obj, chunk_size=16384, format='csv'):
+    r"""iterserialize(obj[, chunk_size[, format]]) -> iterator :: Serialize.
+
+    Serialize the object obj to a UTF-8 encoded CSV string, like serialize(),
+    but the string is generated in chunks (strings) of about chunk_size
+    bytes (rows are never split), so the whole string is never built.
+
+    format is the name of the serialization format (see the 'formats'
+    dictionary). 'csv' is the default. Using 'msgpack', the table is
+    serialized as a MessagePack array of rows, where each row is an array of
+    values. None, booleans, integers (of up to 64 bits), floats and strings
+    keep their types, any other value is converted to a string using
+    unicode(). A KeyError is raised if the format is unknown.
+    """
+    return formats[format](seqtools.as_table(obj), chunk_size)
+
+def _iter_csv(table, chunk_size):
+    r"_iter_csv(table, chunk_size) -> generator :: Serialize a table as CSV."
+    buff = StringIO()
+    writer = ucsv.writer(buff)
+    # rows are written in small batches, checking the size after each one
+    for i in xrange(0, len(table), _csv_batch):
+        writer.writerows(table[i:i+_csv_batch])
+        if buff.tell() >= chunk_size:
+            yield buff.getvalue()
+            buff.seek(0)
+            buff.truncate()
+    if buff.tell():
+        yield buff.getvalue()
+
+# Number of rows written at once by _iter_csv()
+_csv_batch = 32
+
+def _iter_msgpack(table, chunk_size):
+    r"_iter_msgpack(table, chunk_size) -> generator :: Serialize a table."
+    parts = [_msgpack_array_header(len(table))]
+    size = 0
+    pack = _msgpack_pack
+    for row in table:
+        if isinstance(row, seqtools.Sequence):
+            row = row.as_tuple()
+        else:
+            row = tuple(row)
+        parts.append(_msgpack_array_header(len(row)))
+        for value in row:
+            size += pack(value, parts)
+        if size >= chunk_size:
+            yield ''.join(parts)
+            parts = []
+            size = 0
+    if parts:
+        yield ''.join(parts)
+
+def _msgpack_array_header(n):
+    r"_msgpack_array_header(n) -> str :: Encode an array header."
+    if n < 0x10:
+        return chr(0x90 | n)
+    if n < 0x10000:
+        return '\xdc' + struct.pack('>H', n)
+    return '\xdd' + struct.pack('>I', n)
+
+def _msgpack_str_header(n):
+    r"_msgpack_str_header(n) -> str :: Encode a string header."
+    if n < 0x20:
+        return chr(0xa0 | n)
+    if n < 0x100:
+        return '\xd9' + chr(n)
+    if n < 0x10000:
+        return '\xda' + struct.pack('>H', n)
+    return '\xdb' + struct.pack('>I', n)
+
+def _msgpack_pack(value, parts):
+    r"""_msgpack_pack(value, parts) -> int :: Encode a single value.
+
+    The encoded value is appended to the list parts and its size returned.
+    """
+    # Fast paths for the most common values
+    t = type(value)
+    if t is unicode:
+        return _msgpack_pack_str(value.encode('utf-8'), parts)
+    if t is str:
+        return _msgpack_pack_str(value, parts)
+    if t is int and 0 <= value < 0x80:
+        parts.append(_msgpack_fixint[value])
+        return 1
+    if value is None:
+        data = '\xc0'
+    elif value is True:
+        data = '\xc3'
+    elif value is False:
+        data = '\xc2'
+    elif isinstance(value, (int, long)) and -2**63 <= value < 2**64:
+        if 0 <= value < 0x80:
+            data = _msgpack_fixint[value]
+        elif -0x20 <= value < 0:
+            data = struct.pack('b', value)
+        elif value >= 0:
+            if value < 0x100:
+                data = '\xcc' + chr(value)
+            elif value < 0x10000:
+                data = '\xcd' + struct.pack('>H', value)
+            elif value < 0x100000000:
+                data = '\xce' + struct.pack('>I', value)
+            else:
+                data = '\xcf' + struct.pack('>Q', value)
+        elif value >= -0x80:
+            data = '\xd0' + struct.pack('>b', value)
+        elif value >= -0x8000:
+            data = '\xd1' + struct.pack('>h', value)
+        elif value >= -0x80000000:
+            data = '\xd2' + struct.pack('>i', value)
+        else:
+            data = '\xd3' + struct.pack('>q', value)
+    elif isinstance(value, float):
+        data = '\xcb' + struct.pack('>d', value)
+    elif isinstance(value, str):
+        return _msgpack_pack_str(str(value), parts)
+    else:
+        return _msgpack_pack_str(unicode(value).encode('utf-8'), parts)
+    parts.append(data)
+    return len(data)
+
+def _msgpack_pack_str(data, parts):
+    r"_msgpack_pack_str(data, parts) -> int :: Encode a (UTF-8) string."
+    n = len(data)
+    if n < 0x20:
+        parts.append(_msgpack_fixstr[n] + data)
+        return n + 1
+    header = _msgpack_str_header(n)
+    parts.append(header)
+    parts.append(data)
+    return len(header) + n
+
+# Encoded small integers and short strings headers
+_msgpack_fixint = [chr(i) for i in xrange(0x80)]
+_msgpack_fixstr = [chr(0xa0 | n) for n in xrange(0x20)]
+
+def msgpack_unpack(data):
+    r"""msgpack_unpack(data) -> object :: Decode a MessagePack string.
+
+    Only the types generated by iterserialize() are supported (strings are
+    decoded to unicode), so it can be used by clients to decode 'msgpack'
+    responses. A ValueError is raised if the data can't be decoded.
+    """
+    try:
+        (value, pos) = _msgpack_unpack(data, 0)
+    except (IndexError, struct.error):
+        raise ValueError('truncated MessagePack data')
+    if pos != len(data):
+        raise ValueError('extra data after MessagePack value')
+    return value
+
+# Fixed size MessagePack types: type byte -> (struct format, size)
+_msgpack_fixed = {
+    '\xcb': ('>d', 8), '\xcc': ('>B', 1), '\xcd': ('>H', 2), '\xce': ('>I', 4),
+    '\xcf': ('>Q', 8), '\xd0': ('>b', 1), '\xd1': ('>h', 2), '\xd2': ('>i', 4),
+    '\xd3': ('>q', 8),
+}
+
+# MessagePack strings and arrays headers: type byte -> (kind, length size)
+_msgpack_sized = {
+    '\xd9': ('str', 1), '\xda': ('str', 2), '\xdb': ('str', 4),
+    '\xdc': ('array', 2), '\xdd': ('array', 4),
+}
+
+def _msgpack_unpack(data, pos):
+    r"_msgpack_unpack(data, pos) -> (object, pos) :: Decode a value at pos."
+    t = data[pos]
+    b = ord(t)
+    pos += 1
+    if b < 0x80:
+        return (b, pos)
+    if b >= 0xe0:
+        return (b - 0x100, pos)
+    if t == '\xc0':
+        return (None, pos)
+    if t == '\xc2':
+        return (False, pos)
+    if t == '\xc3':
+        return (True, pos)
+    if t in _msgpack_fixed:
+        (fmt, size) = _msgpack_fixed[t]
+        return (struct.unpack(fmt, data[pos:pos+size])[0], pos + size)
+    if 0xa0 <= b < 0xc0:
+        (kind, n) = ('str', b & 0x1f)
+    elif 0x90 <= b < 0xa0:
+        (kind, n) = ('array', b & 0x0f)
+    elif t in _msgpack_sized:
+        (kind, size) = _msgpack_sized[t]
+        n = struct.unpack({1: '>B', 2: '>H', 4: '>I'}[size],
+                          data[pos:pos+size])[0]
+        pos += size
+    else:
+        raise ValueError('unsupported MessagePack type 0x%02x' % b)
+    if kind == 'str':
+        if pos + n > len(data):
+            raise IndexError(pos + n)
+        return (data[pos:pos+n].decode('utf-8'), pos + n)
+    items = list()
+    for i in xrange(n):
+        (value, pos) = _msgpack_unpack(data, pos)
+        items.append(value)
+    return (items, pos)
+
+# Serialization formats: name -> function(table, chunk_size) -> generator
+formats = dict(csv=_iter_csv, msgpack=_iter_msgpack)
 
 
 if __name__ == '__main__':
@@ -83,3 +295,39 @@ if __name__ == '__main__':
 
     for i in h: print i
 
+    table = [[i, u'ñandú %d' % i, 'x' * (i % 7)] for i in range(1000)]
+    chunks = list(iterserialize(table, 1024))
+    assert len(chunks) > 1, chunks
+    for c in chunks[:-1]:
+        assert 1024 <= len(c) < 1024 + _csv_batch * 20, len(c)
+    assert ''.join(chunks) == serialize(table)
+    assert list(iterserialize([])) == ['\r\n'], list(iterserialize([]))
+
+    values = [None, True, False, 0, 1, 127, 128, 255, 256, 65535, 65536,
+              2**32, 2**64 - 1, 2**64, -1, -32, -33, -128, -129, -2**15 - 1,
+              -2**31 - 1, -2**63, -2**63 - 1, 0.5, '', 'a' * 31, 'a' * 32,
+              'b' * 255, 'c' * 256, 'd' * 65536, u'ñandú', h]
+    data = ''.join(iterserialize([values], format='msgpack'))
+    expected = list(values)
+    expected[13] = u'18446744073709551616' # 2**64 is too big
+    expected[22] = u'-9223372036854775809' # -2**63 - 1 is too small
+    expected[-1] = u'no anda' # unicode(h)
+    for (i, v) in enumerate(expected):
+        if isinstance(v, str):
+            expected[i] = unicode(v)
+    assert msgpack_unpack(data) == [expected], msgpack_unpack(data)
+    assert msgpack_unpack(''.join(iterserialize([h, h], format='msgpack'))) \
+                == [[u'name', u'ip', u'mac']] * 2
+    assert msgpack_unpack(''.join(iterserialize(u'lala', format='msgpack'))) \
+                == [[u'lala']]
+    chunks = list(iterserialize(table, 1024, format='msgpack'))
+    assert len(chunks) > 1, chunks
+    rows = msgpack_unpack(''.join(chunks))
+    assert rows[999] == [999, u'ñandú 999', u'xxxxx'], rows[999]
+    for bad in ('\x92\x01', '\xc1', '\x01\x02', '\xa5abc'):
+        try:
+            msgpack_unpack(bad)
+            assert False, 'It should raised a ValueError'
+        except ValueError, e:
+            print 'Bad msgpack:', repr(bad), e
+
@@ -1,20 +1,21 @@
 # vim: set encoding=utf-8 et sw=4 sts=4 :
 
+import copy
+import errno
+import threading
 import subprocess
 from mako.template import Template
 from mako.runtime import Context
 from formencode.validators import Int
 from formencode.schema import Schema
 from os import path
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
 import logging ; log = logging.getLogger('pymin.service.util')
 
 from pymin.dispatcher import Handler, handler, HandlerError, \
                                 CommandNotFoundError
 from pymin.seqtools import Sequence
+from pymin.persistence import PickleStore
+from pymin.eventloop import monotonic
 
 #DEBUG = False
 DEBUG = True
@@ -255,6 +256,28 @@ class Persistent:
     attribute a separated pickle file is generated in the pickle directory.
 
     You can call _dump() and _load() to write and read the data respectively.
+
+    The data is kept in a store created by calling _persistent_backend with
+    the directory and extension (pymin.persistence.PickleStore by default).
+    Files are replaced atomically, and attributes that didn't change since
+    they were loaded or dumped are not written again. If the changes are
+    known (TransactionalHandler.commit() passes them to _dump()), the other
+    attributes are not even looked at.
+
+    Changes made to the attributes can be reported calling _persistent_log()
+    (ContainerSubHandler and ComposedSubHandler do it), so stores that keep
+    a log of changes, like pymin.persistence.LogStore, can dump them quickly.
+
+    If _persistent_lazy is True (the default), _load() only checks that the
+    data of all the attributes is in the store (and doesn't look damaged),
+    and removes the attributes, so each one is really loaded the first time
+    it's used (see __getattr__(), which can be called from any thread).
+    Attributes not loaded yet can't be changed, so _dump() skips them. The
+    time spent loading each attribute is logged and kept in the
+    _persistent_load_times dictionary (attribute name -> seconds). The
+    attributes in _persistent_hot (all of them if it's None, the default)
+    are loaded by _persistent_preload(), which PyminDaemon calls before
+    forking its workers, so they are loaded only once.
     """
     # TODO implement it using metaclasses to add the handlers method by demand
     # (only for specifieds commands).
@@ -262,6 +285,9 @@ class Persistent:
     _persistent_attrs = ()
     _persistent_dir = '.'
     _persistent_ext = '.pkl'
+    _persistent_backend = PickleStore
+    _persistent_lazy = True
+    _persistent_hot = None
 
     def __init__(self, attrs=None, dir=None, ext=None):
         r"Initialize the object, see the class documentation for details."
@@ -272,39 +298,140 @@ class Persistent:
         if ext is not None:
             self._persistent_ext = ext
 
-    def _dump(self):
-        r"_dump() -> None :: Dump all persistent data to pickle files."
+    def _dump(self, changes=None):
+        r"""_dump([changes]) -> None :: Dump all persistent data to the store.
+
+        changes is a change set (see TransactionalHandler): if given, only
+        the attributes in it are dumped (without checking if they really
+        changed).
+        """
         if isinstance(self._persistent_attrs, basestring):
             self._persistent_attrs = (self._persistent_attrs,)
-        for attrname in self._persistent_attrs:
-            self._dump_attr(attrname)
+        unloaded = self.__dict__.get('_persistent_unloaded', ())
+        attrs = [a for a in self._persistent_attrs
+                    if a not in unloaded or a in self.__dict__]
+        if changes is not None:
+            changes = dict([(a, changes[a]) for a in attrs if a in changes])
+            if not changes:
+                log.debug(u'Persistent._dump: nothing changed')
+                return
+            attrs = [a for a in attrs if a in changes]
+        self._persistent_store().dump([(a, getattr(self, a)) for a in attrs],
+                                      changes)
 
     def _load(self):
-        r"_load() -> None :: Load all persistent data from pickle files."
+        r"""_load() -> None :: Load all persistent data from pickle files.
+
+        An IOError is raised if the data of some attribute is missing or
+        damaged. If _persistent_lazy is True, the attributes are loaded when
+        used (and only a cheap check is done to tell if they are damaged).
+        """
         if isinstance(self._persistent_attrs, basestring):
             self._persistent_attrs = (self._persistent_attrs,)
+        if not self._persistent_lazy:
+            for attrname in self._persistent_attrs:
+                self._load_attr(attrname)
+            return
+        store = self._persistent_store()
         for attrname in self._persistent_attrs:
-            self._load_attr(attrname)
+            store.verify(attrname)
+        if '_persistent_lock' not in self.__dict__:
+            self._persistent_lock = threading.Lock()
+        for attrname in self._persistent_attrs:
+            if attrname in self.__dict__:
+                delattr(self, attrname)
+        log.debug(u'Persistent._load: %r will be loaded when used',
+                    self._persistent_attrs)
+        self._persistent_unloaded = set(self._persistent_attrs)
+
+    def __getattr__(self, name):
+        r"""__getattr__(name) -> object :: Load a persistent attribute.
+
+        This is called only for attributes not found the usual way, so the
+        persistent attributes removed by _load() are loaded the first time
+        they are used. AttributeError is raised for any other attribute.
+        """
+        unloaded = self.__dict__.get('_persistent_unloaded')
+        if not unloaded or name not in unloaded:
+            raise AttributeError(name)
+        self._persistent_lock.acquire()
+        try:
+            # another thread could have loaded it meanwhile
+            if name in unloaded:
+                self._load_attr(name)
+        finally:
+            self._persistent_lock.release()
+        return self.__dict__[name]
+
+    def _persistent_preload(self):
+        r"""_persistent_preload() -> None :: Load the hot attributes now.
+
+        The attributes in _persistent_hot (all of them if it's None) not
+        loaded yet are loaded.
+        """
+        unloaded = self.__dict__.get('_persistent_unloaded')
+        if not unloaded:
+            return
+        hot = self._persistent_hot
+        if hot is None:
+            hot = self._persistent_attrs
+        elif isinstance(hot, basestring):
+            hot = (hot,)
+        for attrname in hot:
+            if attrname in unloaded:
+                log.debug(u'Persistent._persistent_preload: loading %r',
+                            attrname)
+                getattr(self, attrname)
 
     def _dump_attr(self, attrname):
         r"_dump_attr() -> None :: Dump a specific variable to a pickle file."
-        fname = self._pickle_filename(attrname)
-        attr = getattr(self, attrname)
-        log.debug(u'Persistent._dump_attr(%r) -> file=%r, value=%r',
-                attrname, fname, attr)
-        f = file(self._pickle_filename(attrname), 'wb')
-        pickle.dump(attr, f, 2)
-        f.close()
+        log.debug(u'Persistent._dump_attr(%r)', attrname)
+        self._persistent_store().dump([(attrname, getattr(self, attrname))])
 
     def _load_attr(self, attrname):
         r"_load_attr() -> object :: Load a specific pickle file."
-        fname = self._pickle_filename(attrname)
-        f = file(fname)
-        attr = pickle.load(f)
-        log.debug(u'Persistent._load_attr(%r) -> file=%r, value=%r',
-                attrname, fname, attr)
-        setattr(self, attrname, attr)
-        f.close()
+        log.debug(u'Persistent._load_attr(%r)', attrname)
+        start = monotonic()
+        setattr(self, attrname, self._persistent_store().load(attrname))
+        elapsed = monotonic() - start
+        unloaded = self.__dict__.get('_persistent_unloaded')
+        if unloaded:
+            unloaded.discard(attrname)
+        times = self.__dict__.get('_persistent_load_times')
+        if times is None:
+            times = self._persistent_load_times = dict()
+        times[attrname] = elapsed
+        log.debug(u'Persistent._load_attr: %r loaded in %.6f seconds',
+                    attrname, elapsed)
+
+    def _persistent_log(self, attrname, op, *args):
+        r"""_persistent_log(attrname, op[, *args]) -> None :: Log a change.
+
+        Report a change made to a persistent attribute to the store, if it
+        keeps a log of changes (see pymin.persistence.LogStore.record() for
+        the operations).
+        """
+        if isinstance(self._persistent_attrs, basestring):
+            self._persistent_attrs = (self._persistent_attrs,)
+        if attrname not in self._persistent_attrs:
+            return
+        store = self._persistent_store()
+        if hasattr(store, 'record'):
+            store.record(attrname, (op,) + args)
+
+    def _persistent_store(self):
+        r"""_persistent_store() -> store :: Get the persistent data store.
+
+        The store is created the first time, and again if the directory or
+        the extension changes.
+        """
+        store = self.__dict__.get('_persistent_storage')
+        if store is None or store.dir != self._persistent_dir \
+                or store.ext != self._persistent_ext:
+            store = self._persistent_backend(self._persistent_dir,
+                                             self._persistent_ext)
+            self._persistent_storage = store
+        return store
 
     def _pickle_filename(self, name):
         r"_pickle_filename() -> string :: Construct a pickle filename."
@@ -333,7 +460,8 @@ class Restorable(Persistent):
     The _restore() method returns True if the data was restored successfully
     or False if the defaults were loaded (in case you want to take further
     actions). If a _write_config method if found, it's executed when a restore
-    fails too.
+    fails too. The data is restored lazily (see Persistent), so attributes
+    that are never used are never loaded.
     """
     # TODO implement it using metaclasses to add the handlers method by demand
     # (only for specifieds commands).
@@ -353,18 +481,18 @@ class Restorable(Persistent):
             self._load()
             log.debug(u'Restorable._restore: load OK')
             return True
-        except IOError:
-            log.debug(u'Restorable._restore: load FAILED, making defaults: %r',
-                        self._restorable_defaults)
+        except IOError, e:
+            log.debug(u'Restorable._restore: load FAILED (%s), making '
+                        u'defaults: %r', e, self._restorable_defaults)
             for (k, v) in self._restorable_defaults.items():
                 setattr(self, k, v)
+            log.debug(u'Restorable._restore: dumping new defaults...')
+            self._dump()
             # TODO tener en cuenta servicios que hay que levantar y los que no
             if hasattr(self, 'commit'):
                 log.debug(u'Restorable._restore: commit() found, commiting...')
                 self.commit()
                 return False
-            log.debug(u'Restorable._restore: dumping new defaults...')
-            self._dump()
             if hasattr(self, '_write_config'):
                 log.debug(u'Restorable._restore: _write_config() found, '
                             u'writing new config...')
@@ -496,8 +624,13 @@ class ConfigWriter:
         self._config_writer_templates[template_name].render_context(ctx)
         f.close()
 
-    def _write_config(self):
-        r"_write_config() -> None :: Generate all the configuration files."
+    def _write_config(self, changes=None):
+        r"""_write_config([changes]) -> None :: Generate all the config files.
+
+        changes is the set of changes made to the persistent data since the
+        last time the configuration was written (see TransactionalHandler),
+        or None if it's unknown. All the files are written anyway.
+        """
         for t in self._config_writer_files:
             self._write_single_config(t)
 
@@ -673,17 +806,22 @@ class InitdHandler(ServiceHandler):
         ServiceHandler.__init__(self, **actions)
 
     def handle_timer(self):
-        # TODO documentation
+        r"""handle_timer() -> bool :: Update the service running status.
+
+        Returns True if the running status changed.
+        """
         log.debug(u'InitdHandler.handle_timer(): self=%r', self)
         p = subprocess.Popen(('pgrep', '-f', self._initd_name),
                                 stdout=subprocess.PIPE)
         pid = p.communicate()[0]
+        running = self._service_running
         if p.returncode == 0 and len(pid) > 0:
             log.debug(u'InitdHandler.handle_timer: pid present, running')
             self._service_running = True
         else:
             log.debug(u'InitdHandler.handle_timer: pid absent, NOT running')
             self._service_running = False
+        return self._service_running != running
 
 class TransactionalHandler(Handler):
     r"""Handle command transactions providing a commit and rollback commands.
@@ -697,23 +835,67 @@ class TransactionalHandler(Handler):
     The persistent data will be written too (if a _dump() method is provided,
     see Persistent and Restorable for that), and the configuration files
     will be generated (if a _write_config method is present, see ConfigWriter).
+
+    A transaction starts with the first change made to the state after a
+    commit or rollback. Changes should be made using _transaction_container(),
+    _transaction_item() and _transaction_replace() (ContainerSubHandler,
+    ComposedSubHandler and ParametersHandler do it), which keep the original
+    objects untouched (copy on write) and remember them, so a rollback only
+    puts the original objects back (without loading the persistent data
+    again). Items of dictionaries are copied only when changed, lists are
+    copied (shallowly) the first time they are changed.
+
+    The changes are recorded too, and the change set is passed to
+    _write_config() on commit, so only what changed needs to be generated.
+    The changes of the transaction are passed to _dump() too, so only what
+    changed is written (all the attributes are looked at if the handler is
+    not tracked, see below). _write_config() is called after _dump(), so if
+    it changes the state too (removing the items marked as deleted, for
+    example), it should do it the same way (and report the changes with
+    _transaction_log()); those changes are dumped when it returns.
+    The change set is a dictionary that maps the name of each changed
+    attribute to the set of keys of the changed items (None in the set means
+    the whole attribute changed). None is passed instead if the changes are
+    unknown (the first time, or if the handler changes its state by other
+    means, setting the _transaction_tracked class attribute to False; then
+    rollback() loads the persistent data again too).
     """
     # TODO implement it using metaclasses to add the handlers method by demand
     # (only for specifieds commands).
 
+    # Tell if all the state changes are made using the _transaction_*()
+    # methods (if not, the change set is unknown and rollback() must load
+    # the persistent data again)
+    _transaction_tracked = True
+    # Changes made since the configuration was written (None if unknown)
+    _transaction_changes = None
+    # List of the changes to undo on rollback (None if not in a transaction)
+    _transaction_undo = None
+
     @handler(u'Commit the changes (reloading the service, if necessary).')
     def commit(self):
         r"commit() -> None :: Commit the changes and reload the service."
         log.debug(u'TransactionalHandler.commit()')
         if hasattr(self, '_dump'):
+            dirty = self._transaction_dirty()
             log.debug(u'TransactionalHandler.commit: _dump() present, '
-                        u'dumping...')
-            self._dump()
+                        u'dumping (changes: %r)...', dirty)
+            self._dump(dirty)
+        changes = self._transaction_end()
         unchanged = False
         if hasattr(self, '_write_config'):
             log.debug(u'TransactionalHandler.commit: _write_config() present, '
-                        u'writing config...')
-            unchanged = self._write_config()
+                        u'writing config (changes: %r)...', changes)
+            unchanged = self._write_config(changes)
+            if self._transaction_undo is not None:
+                if hasattr(self, '_dump'):
+                    dirty = self._transaction_dirty()
+                    log.debug(u'TransactionalHandler.commit: _write_config() '
+                                u'changed the state, dumping (changes: %r)...',
+                                dirty)
+                    self._dump(dirty)
+                self._transaction_end()
+        self._transaction_changes = dict()
         if not unchanged and hasattr(self, 'reload'):
             log.debug(u'TransactionalHandler.commit: reload() present, and'
                         u'configuration changed, reloading...')
@@ -723,10 +905,138 @@ class TransactionalHandler(Handler):
     def rollback(self):
         r"rollback() -> None :: Discard the changes not yet commited."
         log.debug(u'TransactionalHandler.reload()')
-        if hasattr(self, '_load'):
-            log.debug(u'TransactionalHandler.reload: _load() present, loading'
-                        u'pickled values...')
-            self._load()
+        undo = self._transaction_undo
+        if undo is not None:
+            self._transaction_pending.clear()
+            self._transaction_end()
+        if not self._transaction_tracked:
+            if hasattr(self, '_load'):
+                log.debug(u'TransactionalHandler.reload: _load() present, '
+                            u'loading pickled values...')
+                self._load()
+            return
+        if undo is None:
+            return
+        log.debug(u'TransactionalHandler.reload: undoing %d changes',
+                    len(undo))
+        undo.reverse()
+        for change in undo:
+            (op, attrname) = change[:2]
+            if op == 'attr':
+                setattr(self, attrname, change[2])
+                self._transaction_log(attrname, 'replace', change[2])
+            elif op == 'set':
+                change[2][change[3]] = change[4]
+                self._transaction_log(attrname, 'set', change[3], change[4])
+            else:
+                del change[2][change[3]]
+                self._transaction_log(attrname, 'del', change[3])
+
+    def _transaction_dirty(self):
+        r"""_transaction_dirty() -> dict/None :: Get the transaction changes.
+
+        The changes made in the current transaction are returned (in the same
+        format as the change set), or None if the handler is not tracked.
+        """
+        if not self._transaction_tracked:
+            return None
+        if self._transaction_undo is None:
+            return dict()
+        return self._transaction_pending
+
+    def _transaction_begin(self):
+        r"_transaction_begin() -> None :: Start a transaction, if not started."
+        if self._transaction_undo is not None:
+            return
+        log.debug(u'TransactionalHandler: starting a transaction')
+        self._transaction_undo = list()
+        # (id(container), key) of the items already remembered
+        self._transaction_seen = set()
+        # id -> object, for the objects created in the transaction
+        self._transaction_copies = dict()
+        # attribute name -> set of keys changed in the transaction
+        self._transaction_pending = dict()
+
+    def _transaction_end(self):
+        r"""_transaction_end() -> dict/None :: Forget the original objects.
+
+        The changes made in the transaction are added to the change set,
+        which is returned.
+        """
+        changes = self._transaction_changes
+        if not self._transaction_tracked:
+            changes = None
+        if self._transaction_undo is not None:
+            log.debug(u'TransactionalHandler: ending the transaction, '
+                        u'%d changes', len(self._transaction_undo))
+            if changes is not None:
+                for (attrname, keys) in self._transaction_pending.items():
+                    changes.setdefault(attrname, set()).update(keys)
+            self._transaction_undo = None
+            self._transaction_seen = None
+            self._transaction_copies = None
+            self._transaction_pending = None
+        return changes
+
+    def _transaction_log(self, attrname, op, *args):
+        r"_transaction_log(attrname, op[, *args]) -> None :: Report a change."
+        if hasattr(self, '_persistent_log'):
+            self._persistent_log(attrname, op, *args)
+
+    def _transaction_container(self, attrname, key=None):
+        r"""_transaction_container(attrname[, key]) -> container.
+
+        Get the container (a dictionary or list) of the attribute attrname, to
+        change the item key (or add it, or delete it) or to add items (if key
+        is None). The original item is remembered (for dictionaries) or the
+        whole list is copied (the first time), and the change is recorded.
+        """
+        self._transaction_begin()
+        cont = getattr(self, attrname)
+        if not isinstance(cont, dict):
+            if id(cont) not in self._transaction_copies:
+                self._transaction_replace(attrname, list(cont))
+                cont = getattr(self, attrname)
+            key = None
+        elif key is not None and id(cont) not in self._transaction_copies \
+                and (id(cont), key) not in self._transaction_seen:
+            self._transaction_seen.add((id(cont), key))
+            if key in cont:
+                self._transaction_undo.append(('set', attrname, cont, key,
+                                               cont[key]))
+            else:
+                self._transaction_undo.append(('del', attrname, cont, key))
+        self._transaction_pending.setdefault(attrname, set()).add(key)
+        return cont
+
+    def _transaction_item(self, attrname, key):
+        r"""_transaction_item(attrname, key) -> item :: Get an item to change.
+
+        The item key of the container of the attribute attrname is replaced
+        by a copy (the first time in the transaction), which is returned. The
+        original item is remembered, and the change is recorded (see
+        _transaction_container()). LookupError is raised if there is no such
+        item.
+        """
+        cont = self._transaction_container(attrname, key)
+        item = cont[key]
+        if id(item) not in self._transaction_copies:
+            item = copy.deepcopy(item)
+            self._transaction_copies[id(item)] = item
+            cont[key] = item
+        return item
+
+    def _transaction_replace(self, attrname, value):
+        r"""_transaction_replace(attrname, value) -> None :: Replace a value.
+
+        The original value is remembered, and the change is recorded.
+        """
+        self._transaction_begin()
+        self._transaction_undo.append(('attr', attrname,
+                                       getattr(self, attrname)))
+        self._transaction_copies[id(value)] = value
+        setattr(self, attrname, value)
+        self._transaction_pending.setdefault(attrname, set()).add(None)
 
 class ParametersHandler(Handler):
     r"""ParametersHandler([attr]) -> ParametersHandler.
@@ -760,7 +1070,12 @@ class ParametersHandler(Handler):
         if not param in self.params:
             log.debug(u'ParametersHandler.set: parameter not found')
             raise ParameterNotFoundError(param)
-        self.params[param] = value
+        params = self.params
+        if hasattr(self, '_transaction_container'):
+            params = self._transaction_container(self._parameters_attr, param)
+        params[param] = value
+        if hasattr(self, '_persistent_log'):
+            self._persistent_log(self._parameters_attr, 'set', param, value)
         if hasattr(self, '_update'):
             log.debug(u'ParametersHandler.set: _update found, setting to True')
             self._update = True
@@ -839,6 +1154,49 @@ class ContainerSubHandler(SubHandler):
             return getattr(self.parent, self._cont_subhandler_attr)
         setattr(self.parent, self._cont_subhandler_attr, attr)
 
+    def _log_change(self, op, *args):
+        r"_log_change(op[, *args]) -> None :: Report a change to the parent."
+        if hasattr(self.parent, '_persistent_log'):
+            self.parent._persistent_log(self._cont_subhandler_attr, op, *args)
+
+    def _change(self, key=None):
+        r"""_change([key]) -> dict/list :: Get the container to change it.
+
+        If the parent is a TransactionalHandler, the change is made in its
+        transaction (see TransactionalHandler._transaction_container()).
+        """
+        if hasattr(self.parent, '_transaction_container'):
+            return self.parent._transaction_container(
+                                            self._cont_subhandler_attr, key)
+        return self._attr()
+
+    def _change_item(self, key):
+        r"_change_item(key) -> item :: Get an item to change it (see _change)."
+        if hasattr(self.parent, '_transaction_item'):
+            return self.parent._transaction_item(self._cont_subhandler_attr,
+                                                 key)
+        return self._attr()[key]
+
+    def _replace(self, cont):
+        r"_replace(cont) -> None :: Replace the container (see _change)."
+        if hasattr(self.parent, '_transaction_replace'):
+            self.parent._transaction_replace(self._cont_subhandler_attr, cont)
+        else:
+            self._attr(cont)
+
+    def _index(self, index, item):
+        r"""_index(index, item) -> key/int :: Get the real index of an item.
+
+        index is the index of the item among the items not deleted (see
+        _vattr()), which is the same for dictionaries.
+        """
+        if isinstance(self._attr(), dict):
+            return index
+        for (i, x) in enumerate(self._attr()):
+            if x is item:
+                return i
+        raise ItemNotFoundError(index)
+
     def _vattr(self):
         if isinstance(self._attr(), dict):
             return dict([(k, i) for (k, i) in self._attr().items()
@@ -846,6 +1204,29 @@ class ContainerSubHandler(SubHandler):
         return [i for i in self._attr()
                 if not hasattr(i, '_delete') or not i._delete]
 
+    def _vitem(self, index):
+        r"""_vitem(index) -> item :: Get an item that is not deleted.
+
+        Same as self._vattr()[index], but dictionaries are not copied (so
+        big lazily loaded dictionaries are not loaded completely).
+        """
+        if not isinstance(self._attr(), dict):
+            return self._vattr()[index]
+        item = self._attr()[index]
+        if hasattr(item, '_delete') and item._delete:
+            raise KeyError(index)
+        return item
+
+    def _vhas(self, key):
+        r"_vhas(key) -> bool :: Same as key in self._vattr(), but faster."
+        if not isinstance(self._attr(), dict):
+            return key in self._vattr()
+        try:
+            self._vitem(key)
+        except KeyError:
+            return False
+        return True
+
     @handler(u'Add a new item')
     def add(self, *args, **kwargs):
         r"add(...) -> None :: Add an item to the list."
@@ -858,7 +1239,7 @@ class ContainerSubHandler(SubHandler):
         if isinstance(self._attr(), dict):
             key = item.as_tuple()[0]
         # do we have the same item? then raise an error
-        if key in self._vattr():
+        if self._vhas(key):
             log.debug(u'ContainerSubHandler.add: allready exists')
             if not isinstance(self._attr(), dict):
                 key = self._attr().index(item)
@@ -869,15 +1250,19 @@ class ContainerSubHandler(SubHandler):
             index = key
             if not isinstance(self._attr(), dict):
                 index = self._attr().index(item)
+            old = self._change_item(index)
             if hasattr(item, '_add'):
-                self._attr()[index]._add = False
+                old._add = False
             if hasattr(item, '_delete'):
-                self._attr()[index]._delete = False
+                old._delete = False
+            self._log_change('set', index, old)
         else: # it's *really* new
             if isinstance(self._attr(), dict):
-                self._attr()[key] = item
+                self._change(key)[key] = item
+                self._log_change('set', key, item)
             else:
-                self._attr().append(item)
+                self._change().append(item)
+                self._log_change('append', item)
 
     @handler(u'Update an item')
     def update(self, index, *args, **kwargs):
@@ -893,12 +1278,15 @@ class ContainerSubHandler(SubHandler):
                         u"can't really update, raising command not found")
             raise CommandNotFoundError(('update',))
         try:
-            item = self._vattr()[index]
+            item = self._vitem(index)
+            key = self._index(index, item)
+            item = self._change_item(key)
             item.update(*args, **kwargs)
             if hasattr(item, '_update'):
                 log.debug(u'ContainerSubHandler.update: _update found, '
                             u'setting to True')
                 item._update = True
+            self._log_change('set', key, item)
         except LookupError:
             log.debug(u'ContainerSubHandler.update: item not found')
             raise ItemNotFoundError(index)
@@ -910,13 +1298,17 @@ class ContainerSubHandler(SubHandler):
         if not isinstance(self._attr(), dict):
             index = IndexValidator.to_python(index)
         try:
-            item = self._vattr()[index]
+            item = self._vitem(index)
             if hasattr(item, '_delete'):
                 log.debug(u'ContainerSubHandler.delete: _delete found, '
                             u'setting to True')
+                key = self._index(index, item)
+                item = self._change_item(key)
                 item._delete = True
+                self._log_change('set', key, item)
             else:
-                del self._attr()[index]
+                del self._change(index)[index]
+                self._log_change('del', index)
             return item
         except LookupError:
             log.debug(u'ContainerSubHandler.delete: item not found')
@@ -928,9 +1320,10 @@ class ContainerSubHandler(SubHandler):
         log.debug(u'ContainerSubHandler.clear()')
         # FIXME broken really, no _delete attribute is setted :S
         if isinstance(self._attr(), dict):
-            self._attr().clear()
+            self._replace(dict())
         else:
-            self._attr(list())
+            self._replace(list())
+        self._log_change('replace', self._attr())
 
     @handler(u'Get information about an item')
     def get(self, index):
@@ -939,7 +1332,7 @@ class ContainerSubHandler(SubHandler):
         if not isinstance(self._attr(), dict):
             index = IndexValidator.to_python(index)
         try:
-            return self._vattr()[index]
+            return self._vitem(index)
         except LookupError:
             log.debug(u'ContainerSubHandler.get: item not found')
             raise ItemNotFoundError(index)
@@ -1037,6 +1430,48 @@ class ComposedSubHandler(SubHandler):
             return getattr(self._cont()[cont], self._comp_subhandler_attr)
         setattr(self._cont()[cont], self._comp_subhandler_attr, attr)
 
+    def _log_change(self, cont, op, *args):
+        r"""_log_change(cont, op[, *args]) -> None :: Report a change.
+
+        The change is made to the container attribute of the container object
+        cont, and it's reported to the parent (with the container object
+        _update attribute, if present).
+        """
+        if not hasattr(self.parent, '_persistent_log'):
+            return
+        self.parent._persistent_log(self._comp_subhandler_cont, 'attr', cont,
+                                    self._comp_subhandler_attr, (op,) + args)
+        obj = self._cont()[cont]
+        if hasattr(obj, '_update'):
+            self.parent._persistent_log(self._comp_subhandler_cont, 'attr',
+                                        cont, '_update',
+                                        ('replace', obj._update))
+
+    def _index(self, cont, index, item):
+        r"""_index(cont, index, item) -> key/int :: Get the real index.
+
+        index is the index of the item among the items not deleted (see
+        _vattr()), which is the same for dictionaries.
+        """
+        if isinstance(self._attr(cont), dict):
+            return index
+        for (i, x) in enumerate(self._attr(cont)):
+            if x is item:
+                return i
+        raise ItemNotFoundError(index)
+
+    def _change(self, cont):
+        r"""_change(cont) -> object :: Get a container object to change it.
+
+        If the parent is a TransactionalHandler, the change is made in its
+        transaction, so the container object (with all its items) is copied
+        (see TransactionalHandler._transaction_item()).
+        """
+        if hasattr(self.parent, '_transaction_item'):
+            return self.parent._transaction_item(self._comp_subhandler_cont,
+                                                 cont)
+        return self._cont()[cont]
+
     def _vattr(self, cont):
         if isinstance(self._attr(cont), dict):
             return dict([(k, i) for (k, i) in self._attr(cont).items()
@@ -1064,6 +1499,7 @@ class ComposedSubHandler(SubHandler):
             if not isinstance(self._attr(cont), dict):
                 key = self._attr(cont).index(item)
             raise ItemAlreadyExistsError(key)
+        self._change(cont)
         # do we have the same item, but logically deleted? then update flags
         if key in self._attr(cont):
             log.debug(u'ComposedSubHandler.add: was deleted, undeleting it')
@@ -1074,15 +1510,19 @@ class ComposedSubHandler(SubHandler):
                 self._attr(cont)[index]._add = False
             if hasattr(item, '_delete'):
                 self._attr(cont)[index]._delete = False
+            change = ('set', index, self._attr(cont)[index])
         else: # it's *really* new
             if isinstance(self._attr(cont), dict):
                 self._attr(cont)[key] = item
+                change = ('set', key, item)
             else:
                 self._attr(cont).append(item)
+                change = ('append', item)
         if hasattr(self._cont()[cont], '_update'):
             log.debug(u"ComposedSubHandler.add: container's _update found, "
                         u'setting to True')
             self._cont()[cont]._update = True
+        self._log_change(cont, *change)
 
     @handler(u'Update an item')
     def update(self, cont, index, *args, **kwargs):
@@ -1101,6 +1541,8 @@ class ComposedSubHandler(SubHandler):
                         u"can't really update, raising command not found")
             raise CommandNotFoundError(('update',))
         try:
+            self._vattr(cont)[index]
+            self._change(cont)
             item = self._vattr(cont)[index]
             item.update(*args, **kwargs)
             if hasattr(item, '_update'):
@@ -1111,6 +1553,8 @@ class ComposedSubHandler(SubHandler):
                 log.debug(u"ComposedSubHandler.add: container's _update found, "
                             u'setting to True')
                 self._cont()[cont]._update = True
+            self._log_change(cont, 'set', self._index(cont, index, item),
+                             item)
         except LookupError:
             log.debug(u'ComposedSubHandler.update: item not found')
             raise ItemNotFoundError(index)
@@ -1125,17 +1569,22 @@ class ComposedSubHandler(SubHandler):
         if not isinstance(self._attr(cont), dict):
             index = IndexValidator.to_python(index)
         try:
+            self._vattr(cont)[index]
+            self._change(cont)
             item = self._vattr(cont)[index]
             if hasattr(item, '_delete'):
                 log.debug(u'ComposedSubHandler.delete: _delete found, '
                             u'setting to True')
                 item._delete = True
+                change = ('set', self._index(cont, index, item), item)
             else:
                 del self._attr(cont)[index]
+                change = ('del', index)
             if hasattr(self._cont()[cont], '_update'):
                 log.debug(u"ComposedSubHandler.add: container's _update found, "
                             u'setting to True')
                 self._cont()[cont]._update = True
+            self._log_change(cont, *change)
             return item
         except LookupError:
             log.debug(u'ComposedSubHandler.delete: item not found')
@@ -1150,10 +1599,12 @@ class ComposedSubHandler(SubHandler):
         if not cont in self._cont():
             log.debug(u'ComposedSubHandler.add: container not found')
             raise ContainerNotFoundError(cont)
+        self._change(cont)
         if isinstance(self._attr(cont), dict):
             self._attr(cont).clear()
         else:
             self._attr(cont, list())
+        self._log_change(cont, 'replace', self._attr(cont))
 
     @handler(u'Get information about an item')
     def get(self, cont, index):
@@ -1263,6 +1714,8 @@ if __name__ == '__main__':
             print e
         print
 
+    import os
+
     # Persistent test
     print 'PTestHandler'
     class PTestHandler(Persistent):
@@ -1297,12 +1750,227 @@ if __name__ == '__main__':
     h.vars['x'] = 100
     h._dump()
     h = RTestHandler()
+    assert 'vars' not in h.__dict__
     print h.vars
+    assert h._persistent_load_times.keys() == ['vars']
+    h.vars['y'] = 200
+    h._load()
+    assert not hasattr(h, 'nothing')
+    h._dump()
+    assert h.vars == dict(a=1, b=2, x=100), h.vars
+    h._persistent_lazy = False
+    h._load()
+    assert 'vars' in h.__dict__
+    h = RTestHandler()
+    h._persistent_preload()
+    assert 'vars' in h.__dict__
+    # damaged data is detected when restoring
+    data = file('vars.pkl').read()
+    file('vars.pkl', 'w').write(data[:-1])
+    h = RTestHandler()
+    assert 'vars' in h.__dict__ and PickleStore('.').load('vars') == h.vars
+    print
+
+    # LogStore test
+    print 'LTestHandler'
+    from pymin.persistence import LogStore
+    class LItem(Sequence):
+        def __init__(self, name, value):
+            self.name = name
+            self.value = value
+        def as_tuple(self):
+            return (self.name, self.value)
+        def update(self, value):
+            self.value = value
+    class LTestHandler(Restorable):
+        _persistent_attrs = 'items'
+        _persistent_backend = LogStore
+        _restorable_defaults = dict(items=dict())
+        def __init__(self):
+            self.item = DictSubHandler(self, 'items', LItem)
+            self._restore()
+    h = LTestHandler()
+    h.item.add(u'a', u'1')
+    h.item.add(u'b', u'2')
+    h._dump()
+    snapshot = file('items.pkl').read()
+    h.item.delete(u'a')
+    h.item.add(u'c', u'3')
+    h._dump()
+    assert file('items.pkl').read() == snapshot
+    h.item.add(u'd', u'4')
+    h._load()
+    print sorted(h.items.keys())
+    h = LTestHandler()
+    print sorted(h.items.keys())
+    assert sorted(h.items.keys()) == ['b', 'c']
+    os.unlink('items.pkl')
+    os.unlink('items.pkl.log')
+    print
+
+    # SqliteStore test
+    print 'STestHandler'
+    from pymin.persistence import SqliteStore, LazyDict
+    class TestStore(SqliteStore):
+        def __init__(self, dir, ext):
+            SqliteStore.__init__(self, dir, ext, lazy_size=1)
+    class STestHandler(LTestHandler):
+        _persistent_backend = TestStore
+        _restorable_defaults = dict(items=dict())
+    h = STestHandler()
+    for i in range(5):
+        h.item.add(u'i%d' % i, unicode(i))
+    h._dump()
+    h = STestHandler()
+    assert isinstance(h.items, LazyDict)
+    h.item.update(u'i1', u'x')
+    h.item.delete(u'i2')
+    print h.item.get(u'i3')
+    assert dict.__len__(h.items) == 2, dict.__len__(h.items)
+    h._dump()
+    h.item.add(u'i9', u'9')
+    h._load()
+    print sorted(h.item.show())
+    assert sorted(h.items.keys()) == [u'i0', u'i1', u'i3', u'i4']
+    assert h.items[u'i1'].value == u'x'
+    for f in os.listdir('.'):
+        if f.startswith('persistent.sqlite'):
+            os.unlink(f)
+    print
+
+    # TransactionalHandler test
+    print 'TTestHandler'
+    class TItem(LItem):
+        def __init__(self, name, value):
+            LItem.__init__(self, name, value)
+            self._delete = False
+    class TTestHandler(Restorable, TransactionalHandler, ParametersHandler):
+        _persistent_attrs = ('params', 'items', 'rules')
+        _persistent_backend = LogStore
+        _restorable_defaults = dict(params=dict(a=u'1'), items=dict(),
+                                    rules=list())
+        def __init__(self):
+            self.item = DictSubHandler(self, 'items', TItem)
+            self.rule = ListSubHandler(self, 'rules', LItem)
+            self.changes = list()
+            self._restore()
+        def _write_config(self, changes=None):
+            self.changes.append(changes)
+    h = TTestHandler()
+    assert h.changes == [None], h.changes
+    dumped = list()
+    def dump(values, changes=None, dump=h._persistent_store().dump):
+        dumped.append(sorted([n for (n, v) in values]))
+        return dump(values, changes)
+    h._persistent_store().dump = dump
+    h.item.add(u'a', u'1')
+    h.item.add(u'b', u'2')
+    h.rule.add(u'r', u'1')
+    h.commit()
+    assert h.changes[-1] == dict(items=set([u'a', u'b']), rules=set([None]))
+    a = h.items[u'a']
+    rules = h.rules
+    h.item.update(u'a', u'x')
+    h.item.delete(u'b')
+    h.item.add(u'c', u'3')
+    h.rule.update(0, u'x')
+    h.rule.add(u's', u'2')
+    h.set('a', u'2')
+    assert a.value == u'1' and h.items[u'a'].value == u'x'
+    assert len(rules) == 1 and rules[0].value == u'1'
+    print sorted(h.item.show()), h.rule.show(), h.params
+    h.rollback()
+    print sorted(h.item.show()), h.rule.show(), h.params
+    assert h.items[u'a'] is a and sorted(h.items.keys()) == [u'a', u'b']
+    assert not h.items[u'b']._delete
+    assert h.rules is rules and h.params == dict(a=u'1')
+    h.item.update(u'a', u'y')
+    h.item.update(u'a', u'z')
+    h.item.delete(u'b')
+    h.set('a', u'3')
+    h.commit()
+    assert h.changes[-1] == dict(items=set([u'a', u'b']),
+                                 params=set(['a'])), h.changes[-1]
+    assert dumped == [['items', 'rules'], ['items', 'params']], dumped
+    h.commit()
+    assert len(dumped) == 2
+    assert a.value == u'1'
+    h.item.clear()
+    h.rollback()
+    h = TTestHandler()
+    assert h.items[u'a'].value == u'z' and h.items[u'b']._delete
+    assert h.params == dict(a=u'3')
+    for a in h._persistent_attrs:
+        os.unlink(a + '.pkl')
+        if os.path.exists(a + '.pkl.log'):
+            os.unlink(a + '.pkl.log')
+    print
+
+    # ComposedSubHandler test
+    print 'KTestHandler'
+    class KZone(LItem):
+        def __init__(self, name, value):
+            LItem.__init__(self, name, value)
+            self.hosts = dict()
+            self._update = False
+    class KTestHandler(Restorable, TransactionalHandler):
+        _persistent_attrs = 'zones'
+        _persistent_backend = LogStore
+        _restorable_defaults = dict(zones=dict())
+        def __init__(self):
+            self.zone = DictSubHandler(self, 'zones', KZone)
+            self.host = DictComposedSubHandler(self, 'zones', 'hosts', LItem)
+            self._restore()
+    h = KTestHandler()
+    h.zone.add(u'z', u'1')
+    h.commit()
+    h.host.add(u'z', u'a', u'1')
+    h.host.add(u'z', u'b', u'2')
+    h.host.update(u'z', u'a', u'x')
+    h.host.delete(u'z', u'b')
+    h.commit()
+    assert os.path.exists('zones.pkl.log')
+    assert not h._persistent_store()._committed
+    h = KTestHandler()
+    print h.zones[u'z'].hosts
+    assert h.zones[u'z']._update and h.zones[u'z'].hosts.keys() == [u'a']
+    assert h.zones[u'z'].hosts[u'a'].value == u'x'
+    os.unlink('zones.pkl')
+    os.unlink('zones.pkl.log')
+    print
+
+    # changes made by _write_config() are dumped too
+    print 'WTestHandler'
+    class WTestHandler(Restorable, TransactionalHandler):
+        _persistent_attrs = 'items'
+        def __init__(self):
+            self._restorable_defaults = dict(items=dict())
+            self.item = DictSubHandler(self, 'items', TItem)
+            self._restore()
+        def _write_config(self, changes=None):
+            for i in self.items.values():
+                if i._delete:
+                    del self._transaction_container('items', i.name)[i.name]
+                    self._transaction_log('items', 'del', i.name)
+    for backend in (PickleStore, LogStore, TestStore):
+        WTestHandler._persistent_backend = backend
+        h = WTestHandler()
+        h.item.add(u'a', u'1')
+        h.item.add(u'b', u'2')
+        h.commit()
+        h.item.delete(u'a')
+        h.commit()
+        assert h.items.keys() == [u'b']
+        h = WTestHandler()
+        print backend.__name__, h.item.show()
+        assert h.items.keys() == [u'b'], h.items
+        for f in os.listdir('.'):
+            if f.startswith('items.pkl') or f.startswith('persistent.sqlite'):
+                os.unlink(f)
     print
 
     # ConfigWriter test
     print 'CTestHandler'
-    import os
     os.mkdir('templates')
     f = file('templates/config', 'w')
     f.write('Hello, ${name}! You are ${what}.')
@@ -0,0 +1,513 @@
+# vim: set encoding=utf-8 et sw=4 sts=4 :
+
+r"""
+Connection oriented (stream) transports for the pymind protocol.
+
+This module provides the classes to serve the pymind protocol over TCP or
+UNIX stream sockets using an EventLoop. Requests are newline terminated
+commands, and responses use the same framing used for UDP responses:
+
+    (OK|ERROR) LENGTH
+    CSV MESSAGE
+
+Where LENGTH is the length of the CSV MESSAGE in bytes. Connections are
+persistent and clients can send (pipeline) any number of requests without
+waiting for the responses, which are always sent in the same order the
+requests were received.
+
+It also provides a DatagramSender class, to send responses using a UDP
+socket without blocking the event loop.
+
+Please see StreamServer, StreamConnection and DatagramSender classes
+documentation for more info.
+"""
+
+import os
+import stat
+import errno
+import socket
+import collections
+import logging ; log = logging.getLogger('pymin.transport')
+
+__all__ = ('StreamServer', 'StreamConnection', 'DatagramSender',
+           'tcp_listener', 'unix_listener', 'remove_socket_file')
+
+# Errors that mean "try again later" on non-blocking sockets
+_retry_errors = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+# Errors that mean "try again later" when sending datagrams
+_send_retry_errors = _retry_errors + (errno.ENOBUFS,)
+
+def tcp_listener(addr, backlog=128):
+    r"""tcp_listener(addr[, backlog]) -> socket :: Create a TCP listener.
+
+    addr is a tuple of (ip, port) where to bind the socket to.
+    """
+    log.debug(u'tcp_listener(%r, %r)', addr, backlog)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(addr)
+    sock.listen(backlog)
+    return sock
+
+def unix_listener(path, backlog=128):
+    r"""unix_listener(path[, backlog]) -> socket :: Create a UNIX listener.
+
+    If a stale socket file exists in path, it's removed first.
+    """
+    log.debug(u'unix_listener(%r, %r)', path, backlog)
+    remove_socket_file(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(backlog)
+    return sock
+
+def remove_socket_file(path):
+    r"""remove_socket_file(path) -> None :: Remove a UNIX socket file.
+
+    Nothing is done if path doesn't exist or if it's not a socket.
+    """
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+class StreamConnection:
+    r"""StreamConnection(loop, sock, process[, on_close]) -> StreamConnection.
+
+    Handle a connected stream socket 'sock' (TCP or UNIX) using the EventLoop
+    'loop'. Each newline terminated line read from the socket is a request
+    (empty lines are ignored), which is passed to process(msg, reply). The
+    'process' callable must call reply(response) when the response is ready
+    (it can be called after process() returns), where response is a list of
+    strings (chunks) to be sent.
+
+    A '@batch' line starts a batch request: all the following lines, up to
+    an '@end' line, are passed to process() as a single request (including
+    the '@batch' and '@end' lines), so many commands can be executed using
+    only one request and getting only one response.
+
+    Responses are sent in the same order the requests were received, even
+    if they are completed in a different order. Large responses are written
+    in chunks of at most 'chunk_size' bytes, as the socket accepts them, so
+    the event loop is never blocked by a slow client.
+
+    To apply backpressure to clients that send requests faster than they
+    read the responses, no more requests are read from the connection while
+    there are more than 'max_output' bytes waiting to be written or more
+    than 'max_pending' requests waiting for a response.
+
+    When the peer closes its side of the connection, the pending responses
+    are sent and then the connection is closed and on_close(connection) is
+    called.
+    """
+
+    # Maximum request length
+    max_request = 65535
+
+    # Size of the chunks read from and written to the socket
+    chunk_size = 65536
+
+    # Lines that start and end a batch request
+    batch_start = '@batch'
+    batch_end = '@end'
+
+    # Maximum batch request length
+    max_batch = 4194304
+
+    # Maximum bytes waiting to be written before reading is paused
+    max_output = 4194304
+
+    # Maximum requests waiting for a response before reading is paused
+    max_pending = 1024
+
+    def __init__(self, loop, sock, process, on_close=None):
+        r"""Initialize the StreamConnection object.
+
+        See StreamConnection class documentation for more info.
+        """
+        log.debug(u'StreamConnection(%r, %r, %r, %r)', loop, sock, process,
+                    on_close)
+        self.loop = loop
+        self.sock = sock
+        self.process = process
+        self.on_close = on_close
+        sock.setblocking(False)
+        if sock.family == socket.AF_INET:
+            # responses are written as soon as they are ready, don't let
+            # Nagle's algorithm delay them
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # data read but not processed yet (incomplete request)
+        self._inbuf = ''
+        # responses slots, in the same order of the requests
+        self._slots = collections.deque()
+        # chunks to write and position in the first chunk
+        self._outbuf = collections.deque()
+        self._outpos = 0
+        # bytes waiting to be written
+        self._outsize = 0
+        # reading was paused because too much output is pending
+        self._paused = False
+        # the peer closed its side of the connection
+        self._eof = False
+        # processing the requests of a read (don't write yet)
+        self._reading = False
+        # lines of the batch request being received (None if not in a batch)
+        self._batch = None
+        self._batch_size = 0
+        loop.add_reader(sock, self._handle_read)
+
+    def _handle_read(self):
+        r"_handle_read() -> None :: Read requests from the socket."
+        try:
+            data = self.sock.recv(self.chunk_size)
+        except socket.error, e:
+            if e.args[0] in _retry_errors:
+                return
+            log.debug(u'StreamConnection._handle_read: error %r', e)
+            self.close()
+            return
+        if not data:
+            log.debug(u'StreamConnection._handle_read: EOF')
+            self._eof = True
+            self.loop.remove_reader(self.sock)
+            self._flush()
+            return
+        requests = (self._inbuf + data).split('\n')
+        self._inbuf = requests.pop()
+        if len(self._inbuf) > self.max_request:
+            log.debug(u'StreamConnection._handle_read: request too long')
+            requests.append(None)
+        # write the responses of all the requests at once
+        self._reading = True
+        try:
+            for msg in requests:
+                self._request(msg)
+        finally:
+            self._reading = False
+        self._flush()
+
+    def _request(self, msg):
+        r"""_request(msg) -> None :: Process a request.
+
+        Batch requests lines are collected until the end of the batch, and
+        then processed as a single (multi-line) request. If msg is None, the
+        request was too long, so an error is replied and no more requests
+        are read.
+        """
+        if self._eof:
+            return
+        if msg is not None:
+            msg = msg.rstrip('\r')
+            if self._batch is not None:
+                self._batch.append(msg)
+                self._batch_size += len(msg) + 1
+                if msg.strip() == self.batch_end:
+                    msg = '\n'.join(self._batch)
+                    self._batch = None
+                elif self._batch_size > self.max_batch:
+                    log.debug(u'StreamConnection._request: batch too long')
+                    msg = None
+                else:
+                    return
+            elif msg.strip() == self.batch_start:
+                self._batch = [msg]
+                self._batch_size = len(msg) + 1
+                return
+            elif not msg.strip():
+                return
+        slot = [None]
+        self._slots.append(slot)
+        def reply(response):
+            slot[0] = response
+            self._flush()
+        if msg is None:
+            self._eof = True
+            self._batch = None
+            self.loop.remove_reader(self.sock)
+            reply(['ERROR 18\nRequest too long.\n'])
+        else:
+            self.process(msg, reply)
+
+    def _flush(self):
+        r"_flush() -> None :: Queue the ready responses and write them."
+        if self.sock is None or self._reading:
+            # closed while the response was being generated, or more
+            # responses are coming
+            return
+        while self._slots and self._slots[0][0] is not None:
+            response = self._slots.popleft()[0]
+            size = 0
+            for chunk in response:
+                size += len(chunk)
+            if len(response) > 1 and size <= self.chunk_size:
+                # send small responses using only one send() call
+                response = [''.join(response)]
+            self._outbuf.extend(response)
+            self._outsize += size
+        self._handle_write()
+
+    def _handle_write(self):
+        r"_handle_write() -> None :: Write as much pending data as possible."
+        while self._outbuf:
+            chunk = self._outbuf[0]
+            try:
+                sent = self.sock.send(chunk[self._outpos:
+                                            self._outpos + self.chunk_size])
+            except socket.error, e:
+                if e.args[0] in _retry_errors:
+                    self.loop.add_writer(self.sock, self._handle_write)
+                    self._throttle()
+                    return
+                log.debug(u'StreamConnection._handle_write: error %r', e)
+                self.close()
+                return
+            self._outpos += sent
+            self._outsize -= sent
+            if self._outpos >= len(chunk):
+                self._outbuf.popleft()
+                self._outpos = 0
+        self.loop.remove_writer(self.sock)
+        if self._eof and not self._slots:
+            self.close()
+            return
+        self._throttle()
+
+    def _throttle(self):
+        r"_throttle() -> None :: Pause or resume reading requests as needed."
+        if self._eof:
+            return
+        full = (self._outsize > self.max_output
+                    or len(self._slots) > self.max_pending)
+        if full and not self._paused:
+            log.debug(u'StreamConnection: too much pending output, pausing')
+            self.loop.remove_reader(self.sock)
+            self._paused = True
+        elif not full and self._paused:
+            log.debug(u'StreamConnection: resuming')
+            self.loop.add_reader(self.sock, self._handle_read)
+            self._paused = False
+
+    def close(self):
+        r"close() -> None :: Close the connection (pending data is lost)."
+        if self.sock is None:
+            return
+        log.debug(u'StreamConnection.close()')
+        self.loop.remove_reader(self.sock)
+        self.loop.remove_writer(self.sock)
+        self.sock.close()
+        self.sock = None
+        self._slots.clear()
+        self._outbuf.clear()
+        self._outsize = 0
+        if self.on_close is not None:
+            self.on_close(self)
+
+class StreamServer:
+    r"""StreamServer(loop, sock, process) -> StreamServer instance.
+
+    Accept connections on the listening stream socket 'sock' (see
+    tcp_listener() and unix_listener()), using the EventLoop 'loop'. Each
+    connection is handled by a StreamConnection, which uses 'process' to
+    process the requests (see StreamConnection documentation for details).
+    """
+
+    def __init__(self, loop, sock, process):
+        r"""Initialize the StreamServer object.
+
+        See StreamServer class documentation for more info.
+        """
+        log.debug(u'StreamServer(%r, %r, %r)', loop, sock, process)
+        self.loop = loop
+        self.sock = sock
+        self.process = process
+        self.connections = set()
+        sock.setblocking(False)
+        loop.add_reader(sock, self._handle_accept)
+
+    def _handle_accept(self):
+        r"_handle_accept() -> None :: Accept new connections."
+        while True:
+            try:
+                (sock, addr) = self.sock.accept()
+            except socket.error, e:
+                if e.args[0] not in _retry_errors:
+                    log.warning(u"StreamServer: can't accept connection: %s",
+                                    e)
+                return
+            log.debug(u'StreamServer: new connection from %r', addr)
+            self.connections.add(StreamConnection(self.loop, sock,
+                                    self.process, self.connections.discard))
+
+    def close(self):
+        r"close() -> None :: Stop accepting connections and close them all."
+        log.debug(u'StreamServer.close()')
+        self.loop.remove_reader(self.sock)
+        if self.sock.family == socket.AF_UNIX:
+            remove_socket_file(self.sock.getsockname())
+        self.sock.close()
+        for c in list(self.connections):
+            c.close()
+
+    def close_after_fork(self):
+        r"""close_after_fork() -> None :: Close the sockets in a child process.
+
+        Only the child's copies of the sockets are closed, the event loop is
+        not used and the UNIX socket file is not removed (see
+        EventLoop.close_after_fork()).
+        """
+        log.debug(u'StreamServer.close_after_fork()')
+        self.sock.close()
+        for c in self.connections:
+            if c.sock is not None:
+                c.sock.close()
+                c.sock = None
+        self.connections.clear()
+
+class DatagramSender:
+    r"""DatagramSender(loop, sock[, limit[, policy]]) -> DatagramSender.
+
+    Send datagrams using the (non-blocking) socket 'sock' without blocking
+    the EventLoop 'loop'. If the socket send buffer is full, datagrams are
+    queued (in a queue per peer) and sent when the socket is writable again.
+    Queues are flushed in a round-robin fashion, so a peer with a lot of
+    queued data doesn't delay the responses to the other peers.
+
+    Queued data is limited to 'limit' bytes in total, and 'peer_limit' bytes
+    per peer. When a limit is reached, datagrams are dropped according to
+    'policy':
+
+    'oldest' - the oldest datagrams of the peer are dropped to make room
+    for the new one (if the total limit was reached, the oldest datagrams of
+    the peer with more queued data are dropped).
+
+    'newest' - the new datagram is dropped.
+
+    Dropping datagrams is the same as losing them in the network, so clients
+    should be ready to retry anyway.
+    """
+
+    # Queue policies
+    policies = ('oldest', 'newest')
+
+    # Maximum bytes queued for a single peer
+    peer_limit = 262144
+
+    def __init__(self, loop, sock, limit=1048576, policy='oldest'):
+        r"""Initialize the DatagramSender object.
+
+        See DatagramSender class documentation for more info.
+        """
+        log.debug(u'DatagramSender(%r, %r, %r, %r)', loop, sock, limit, policy)
+        if policy not in self.policies:
+            raise ValueError('Unknown policy %r' % policy)
+        self.loop = loop
+        self.sock = sock
+        self.limit = limit
+        self.policy = policy
+        sock.setblocking(False)
+        # addr -> deque of datagrams
+        self._queues = dict()
+        # addr -> bytes queued
+        self._sizes = dict()
+        # peers with queued datagrams, in round-robin order
+        self._peers = collections.deque()
+        # bytes queued in total
+        self.queued = 0
+        # number of datagrams dropped
+        self.dropped = 0
+
+    def send(self, addr, data):
+        r"""send(addr, data) -> None :: Send the datagram data to addr.
+
+        The datagram is sent right away if possible, or queued otherwise.
+        """
+        if not self._peers:
+            try:
+                self.sock.sendto(data, addr)
+                return
+            except socket.error, e:
+                if e.args[0] not in _send_retry_errors:
+                    log.warning(u"DatagramSender: can't send datagram to "
+                                u'%r: %s', addr, e)
+                    return
+            self.loop.add_writer(self.sock, self._handle_write)
+        self._enqueue(addr, data)
+
+    def _enqueue(self, addr, data):
+        r"_enqueue(addr, data) -> None :: Queue a datagram, applying limits."
+        size = len(data)
+        if size > min(self.limit, self.peer_limit):
+            self._drop(addr, size)
+            return
+        while self._sizes.get(addr, 0) + size > self.peer_limit:
+            if self.policy == 'newest':
+                self._drop(addr, size)
+                return
+            self._drop_oldest(addr)
+        while self.queued + size > self.limit:
+            if self.policy == 'newest':
+                self._drop(addr, size)
+                return
+            self._drop_oldest(max(self._sizes, key=self._sizes.get))
+        if addr not in self._queues:
+            self._queues[addr] = collections.deque()
+            self._sizes[addr] = 0
+            self._peers.append(addr)
+        self._queues[addr].append(data)
+        self._sizes[addr] += size
+        self.queued += size
+
+    def _drop(self, addr, size):
+        r"_drop(addr, size) -> None :: Take note of a dropped datagram."
+        log.warning(u'DatagramSender: queue full, datagram of %d bytes to %r '
+                    u'dropped', size, addr)
+        self.dropped += 1
+
+    def _drop_oldest(self, addr):
+        r"_drop_oldest(addr) -> None :: Drop the oldest datagram of a peer."
+        data = self._pop(addr)
+        self._drop(addr, len(data))
+
+    def _pop(self, addr):
+        r"_pop(addr) -> str :: Remove the oldest datagram of a peer queue."
+        queue = self._queues[addr]
+        data = queue.popleft()
+        self._sizes[addr] -= len(data)
+        self.queued -= len(data)
+        if not queue:
+            del self._queues[addr]
+            del self._sizes[addr]
+            self._peers.remove(addr)
+        return data
+
+    def _handle_write(self):
+        r"_handle_write() -> None :: Send as many queued datagrams as possible."
+        while self._peers:
+            addr = self._peers[0]
+            data = self._queues[addr][0]
+            try:
+                self.sock.sendto(data, addr)
+            except socket.error, e:
+                if e.args[0] in _send_retry_errors:
+                    return
+                log.warning(u"DatagramSender: can't send datagram to %r: %s",
+                            addr, e)
+            self._pop(addr)
+            if addr in self._queues:
+                # next peer's turn
+                self._peers.rotate(-1)
+        self.loop.remove_writer(self.sock)
+
+    def close(self):
+        r"close() -> None :: Discard the queued datagrams."
+        log.debug(u'DatagramSender.close()')
+        if self._peers:
+            self.loop.remove_writer(self.sock)
+        self._queues.clear()
+        self._sizes.clear()
+        self._peers.clear()
+        self.queued = 0
+
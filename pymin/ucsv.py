@@ -50,13 +50,22 @@ class UnicodeWriter:
     """
     A CSV writer which will write rows to CSV file "f",
     which is encoded in the given encoding.
+
+    The csv module writes UTF-8 encoded cells as they are, so when the
+    target encoding is UTF-8 rows are written directly to "f" (each cell
+    is encoded only once). For other encodings, rows are written to a
+    queue first and then reencoded.
     """
 
     def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
+        self.stream = f
+        if encoding.lower().replace('_', '-') in ('utf-8', 'utf8'):
+            self.queue = None
+            self.writer = csv.writer(f, dialect=dialect, **kwds)
+            return
         # Redirect output to a queue
         self.queue = StringIO()
         self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
-        self.stream = f
         if hasattr(codecs, 'getincrementalencoder'):
             self.encoder = codecs.getincrementalencoder(encoding)()
         else:
@@ -69,6 +78,8 @@ class UnicodeWriter:
 
     def writerow(self, row):
         self.writer.writerow([unicode(s).encode("utf-8") for s in row])
+        if self.queue is None:
+            return
         # Fetch UTF-8 output from the queue ...
         data = self.queue.getvalue()
         data = data.decode("utf-8")
@@ -80,6 +91,10 @@ class UnicodeWriter:
         self.queue.truncate(0)
 
     def writerows(self, rows):
+        if self.queue is None:
+            self.writer.writerows([[unicode(s).encode("utf-8") for s in row]
+                                    for row in rows])
+            return
         for row in rows:
             self.writerow(row)
 
@@ -97,6 +112,20 @@ if __name__ == '__main__':
 
     print sio.getvalue()
 
+    # Writing UTF-8 directly should give the same output as using the queue
+    rows = [[u"a,b", 'c"d', 1, 0.1, None, u"ñ\r\n"], [], [u"x y"]]
+    direct = StringIO()
+    UnicodeWriter(direct).writerows(rows)
+    queued = StringIO()
+    w = UnicodeWriter(queued, encoding='utf-16')
+    w.encoder = codecs.getincrementalencoder('utf-8')()
+    w.writerows(rows)
+    assert direct.getvalue() == queued.getvalue(), (direct.getvalue(),
+                                                    queued.getvalue())
+    assert direct.getvalue() == \
+            '"a,b","c""d",1,0.1,None,"\xc3\xb1\r\n"\r\n\r\nx y\r\n', \
+            repr(direct.getvalue())
+
     sio.seek(0)
 
     for row in reader(sio):
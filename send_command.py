@@ -1,8 +1,49 @@
 #!/usr/bin/env python
 
+# Usage:
+#   send_command.py HOST PORT     send stdin as a single command using UDP
+#   send_command.py -t HOST PORT  send each stdin line as a command using TCP
+#   send_command.py -u PATH       send each stdin line as a command using
+#                                 a UNIX socket
+#
+# Many commands can be sent as a single batch request putting them between
+# a @batch line and a @end line.
+
 import sys
 import socket
 
+def read_response(f):
+    header = f.readline()
+    (status, length) = header.split()
+    return header + f.read(int(length))
+
+if sys.argv[1] in ('-t', '-u'):
+    if sys.argv[1] == '-t':
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect((sys.argv[2], int(sys.argv[3])))
+    else:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(sys.argv[2])
+    commands = [c for c in sys.stdin.read().splitlines() if c.strip()]
+    # send all the commands at once, the responses come in the same order
+    s.sendall(''.join([c + '\n' for c in commands]))
+    # a batch (from a @batch line to a @end line) gets only one response
+    responses = 0
+    batch = False
+    for c in commands:
+        if batch:
+            batch = (c.strip() != '@end')
+            responses += not batch
+        elif c.strip() == '@batch':
+            batch = True
+        else:
+            responses += 1
+    f = s.makefile('rb')
+    for i in range(responses):
+        print
+        print read_response(f)
+    sys.exit(0)
+
 s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
 host = sys.argv[1]
@@ -14,5 +55,4 @@ s.sendto(sys.stdin.read(), 0, (host, port))
 
 print
 
-print s.recvfrom(4096)[0]
-
+print s.recvfrom(65535)[0]
@@ -69,13 +69,27 @@ class DnsHandler(Restorable, ConfigWriter, InitdHandler, TransactionalHandler,
     def _get_config_vars(self, config_file):
         return dict(zones=self.zones.values(), **self.params)
 
-    def _write_config(self):
-        r"_write_config() -> None :: Generate all the configuration files."
-        log.debug(u'DnsHandler._write_config()')
+    def _write_config(self, changes=None):
+        r"""_write_config([changes]) -> None :: Generate all the config files.
+
+        Only the zones in the change set are processed (all of them if
+        changes is None, see TransactionalHandler), plus the zones still
+        marked as added, updated or deleted (by a previous commit that
+        failed, for example).
+        """
+        log.debug(u'DnsHandler._write_config(%r)', changes)
+        zones = self.zones.values()
+        if changes is not None and None not in changes.get('zones', ()):
+            names = set([z for z in changes.get('zones', ())
+                            if z in self.zones])
+            names.update([z.name for z in zones
+                            if z._add or z._update or z._delete])
+            zones = [self.zones[z] for z in names]
         delete_zones = list()
-        for a_zone in self.zones.values():
+        for a_zone in zones:
             log.debug(u'DnsHandler._write_config: processing zone %s', a_zone)
             if a_zone._update or a_zone._add:
+                a_zone = self._transaction_item('zones', a_zone.name)
                 if not a_zone._add and self._service_running:
                     log.debug(u'DnsHandler._write_config: zone updated and '
                                 u'the service is running, freezing zone')
@@ -95,6 +109,7 @@ class DnsHandler(Restorable, ConfigWriter, InitdHandler, TransactionalHandler,
                 else :
                     self._update = True
                     a_zone._add = False
+                self._transaction_log('zones', 'set', a_zone.name, a_zone)
             if a_zone._delete:
                 #borro el archivo .zone
                 log.debug(u'DnsHandler._write_config: zone deleted, removing '
@@ -110,7 +125,8 @@ class DnsHandler(Restorable, ConfigWriter, InitdHandler, TransactionalHandler,
                 delete_zones.append(a_zone.name)
         #borro las zonas
         for z in delete_zones:
-            del self.zones[z]
+            del self._transaction_container('zones', z)[z]
+            self._transaction_log('zones', 'del', z)
         #archivo general
         if self._update:
             self._write_single_config('named.conf')
@@ -125,12 +141,14 @@ class DnsHandler(Restorable, ConfigWriter, InitdHandler, TransactionalHandler,
         p = subprocess.Popen(('pgrep', '-f', '/usr/sbin/named'),
                                 stdout=subprocess.PIPE)
         pid = p.communicate()[0]
+        running = self._service_running
         if p.returncode == 0 and len(pid) > 0:
             log.debug(u'DnsHandler.handle_timer: pid present, running')
             self._service_running = True
         else:
             log.debug(u'DnsHandler.handle_timer: pid absent, NOT running')
             self._service_running = False
+        return self._service_running != running
 
 
 
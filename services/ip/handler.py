@@ -31,6 +31,9 @@ class IpHandler(Restorable, ConfigWriter, TransactionalHandler):
                             'route_add', 'route_del', 'route_flush', 'hop')
     _config_writer_tpl_dir = path.join(path.dirname(__file__), 'templates')
 
+    # Devices and routes are changed directly by the subhandlers
+    _transaction_tracked = False
+
     def __init__(self, pickle_dir='.', config_dir='.'):
         r"Initialize DhcpHandler object, see class documentation for details."
         log.debug(u'IpHandler(%r, %r)', pickle_dir, config_dir)
@@ -46,8 +49,8 @@ class IpHandler(Restorable, ConfigWriter, TransactionalHandler):
         self.no_device_routes = list()
         self.services = list()
 
-    def _write_config(self):
-        r"_write_config() -> None :: Execute all commands."
+    def _write_config(self, changes=None):
+        r"_write_config([changes]) -> None :: Execute all commands."
         log.debug(u'IpHandler._write_config()')
         for device in self.devices.values():
             log.debug(u'IpHandler._write_config: processing device %s', device)
@@ -148,17 +151,19 @@ class IpHandler(Restorable, ConfigWriter, TransactionalHandler):
 
     def handle_timer(self):
         log.debug(u'IpHandler.handle_timer()')
-        self.refresh_devices()
+        return self.refresh_devices()
 
     def refresh_devices(self):
         log.debug(u'IpHandler.update_devices()')
         devices = get_network_devices()
+        changed = False
         #add not registered and active devices
         go_active = False
         for k,v in devices.items():
             if k not in self.devices:
                 log.debug(u'IpHandler.update_devices: adding %r', v)
                 self.devices[k] = v
+                changed = True
             elif not self.devices[k].active:
                 self.active = True
                 go_active = True
@@ -167,16 +172,20 @@ class IpHandler(Restorable, ConfigWriter, TransactionalHandler):
             self._write_hops()
             self._bring_up_no_dev_routes()
             self._restart_services()
+            changed = True
 
         #mark inactive devices
         for k in self.devices.keys():
             go_down = False
             if k not in devices:
                 log.debug(u'IpHandler.update_devices: removing %s', k)
+                if self.devices[k].active:
+                    changed = True
                 self.devices[k].active = False
                 go_down = True
             if go_down:
                 self._bring_up_no_dev_routes()
+        return changed
 
     def _restart_services(self):
         for s in self.services:
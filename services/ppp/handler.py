@@ -126,20 +126,25 @@ class PppHandler(Restorable, ConfigWriter, ReloadHandler, TransactionalHandler):
 
     def handle_timer(self):
         log.debug(u'PppHandler.handle_timer()')
+        changed = False
         for c in self.conns.values():
             log.debug(u'PppHandler.handle_timer: processing connection %r', c)
             p = subprocess.Popen(('pgrep', '-f', 'pppd call ' + c.name),
                                     stdout=subprocess.PIPE)
             pid = p.communicate()[0]
+            running = c._running
             if p.returncode == 0 and len(pid) > 0:
                 log.debug(u'PppHandler.handle_timer: pid present, running')
                 c._running = True
             else:
                 log.debug(u'PppHandler.handle_timer: pid absent, NOT running')
                 c._running = False
+            if c._running != running:
+                changed = True
+        return changed
 
-    def _write_config(self):
-        r"_write_config() -> None :: Generate all the configuration files."
+    def _write_config(self, changes=None):
+        r"_write_config([changes]) -> None :: Generate all the config files."
         log.debug(u'PppHandler._write_config()')
         #guardo los pass que van el pap-secrets
         vars_pap = dict()
@@ -28,6 +28,9 @@ class QoSHandler(Restorable, ConfigWriter, TransactionalHandler):
 
     _config_writer_tpl_dir = path.join(path.dirname(__file__), 'templates')
 
+    # Devices and classes are changed directly by the subhandlers
+    _transaction_tracked = False
+
     def __init__(self, pickle_dir='.', config_dir='.'):
         r"Initialize QoSHandler object, see class documentation for details."
         self._persistent_dir = pickle_dir
@@ -39,8 +42,8 @@ class QoSHandler(Restorable, ConfigWriter, TransactionalHandler):
         self.cls = ClassHandler(self)
         self.host = HostHandler(self)
 
-    def _write_config(self):
-        r"_write_config() -> None :: Execute all commands."
+    def _write_config(self, changes=None):
+        r"_write_config([changes]) -> None :: Execute all commands."
         for device in self.devices.values():
             try:
                 call(self._render_config('device', dict(dev=device.name, action='del')), shell=True)
@@ -75,18 +78,22 @@ class QoSHandler(Restorable, ConfigWriter, TransactionalHandler):
                         pass
 
     def handle_timer(self):
-        self.refresh_devices()
+        return self.refresh_devices()
 
     def refresh_devices(self):
         devices = get_network_devices()
+        changed = False
         #add not registered devices
         for k, v in devices.items():
             if k not in self.devices:
                 self.devices[k] = Device(k, v)
+                changed = True
         #delete dead devices
         for k in self.devices.keys():
             if k not in devices:
                 del self.devices[k]
+                changed = True
+        return changed
 
 
 if __name__ == '__main__':
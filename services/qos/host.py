@@ -14,7 +14,7 @@ class Host(Sequence):
         self.ip = ip
 
     def as_tuple(self):
-        return (self.ip)
+        return (self.ip,)
 
     def __cmp__(self, other):
         if self.ip == other.ip:
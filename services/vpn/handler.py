@@ -80,7 +80,7 @@ class VpnHandler(Restorable, ConfigWriter,
             else:
                 log.debug(u'VpnHandler.stop: pid file not found')
 
-    def _write_config(self):
+    def _write_config(self, changes=None):
         log.debug(u'VpnHandler._write_config()')
         for v in self.vpns.values():
             log.debug(u'VpnHandler._write_config: processing %r', v)
@@ -119,8 +119,10 @@ class VpnHandler(Restorable, ConfigWriter,
                             raise HandlerError(u"Can't read VPN key '%s' (%s)'"
                                                 % (e.filename, e.strerror))
 
+                        v = self._transaction_item('vpns', v.name)
                         v.public_key = pub
                         v.private_key = priv
+                        self._transaction_log('vpns', 'set', v.name, v)
                     except ExecutionError, e:
                         log.debug(u'VpnHandler._write_config: error executing '
                                     'the command: %r', e)
@@ -140,7 +142,10 @@ class VpnHandler(Restorable, ConfigWriter,
                             # FIXME use os.unlink()
                             call(('rm','-f',
                                     path.join(v.name, 'hosts', h.name)))
+                            v = self._transaction_item('vpns', v.name)
                             del v.hosts[h.name]
+                            self._transaction_log('vpns', 'attr', v.name,
+                                                  'hosts', ('del', h.name))
                         except ExecutionError, e:
                             log.debug(u'VpnHandler._write_config: error '
                                     'removing files: %r', e)
@@ -149,7 +154,8 @@ class VpnHandler(Restorable, ConfigWriter,
                 if path.exists('/etc/tinc/' + v.name):
                     self.stop(v.name)
                     call(('rm','-rf','/etc/tinc/' + v.name))
-                    del self.vpns[v.name]
+                    del self._transaction_container('vpns', v.name)[v.name]
+                    self._transaction_log('vpns', 'del', v.name)
 
 
 if __name__ == '__main__':